@@ -0,0 +1,780 @@
+"""Simulated vCenter for the offline benchmarks.
+
+FakeVCenter holds a synthetic inventory (datacenters, folders, datastores,
+a cluster with hosts, VMs with disks, CD-ROMs and snapshot trees) and
+answers the pyVmomi calls the scripts make through FakeStub, a stub
+adapter that can take the place of the SOAP stub of SmartConnect():
+property accessors, ContainerViews and ListViews, RetrievePropertiesEx with
+paging, PropertyCollector filters with WaitForUpdatesEx, and tasks
+(relocate, rename, snapshot removal, reconfigure) that finish after a
+configurable time and then change the inventory.
+
+Every call sleeps for the configured latency and is counted per method, so
+the benchmark can report round-trips.
+"""
+
+import collections
+import datetime
+import itertools
+import random
+import threading
+import time
+
+from pyVmomi import vim, vmodl, VmomiSupport
+
+GB = 1024 ** 3
+
+# Seconds between two checks of a blocking WaitForUpdatesEx
+POLL_SECONDS = 0.01
+
+
+def bind(value, stub):
+    """Copy of value with all managed objects bound to stub
+
+    The SOAP stub binds every managed object of a result to the stub the call
+    went through (the outer stub of sessions.SessionPool), so later calls on
+    those objects go through the same stub again.
+    """
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return value.__class__(value._moId, stub)
+    if isinstance(value, VmomiSupport.DataObject):
+        fields = {}
+        for info in value._GetPropertyList():
+            field = getattr(value, info.name)
+            if field is not None:
+                fields[info.name] = bind(field, stub)
+        return value.__class__(**fields)
+    if isinstance(value, list):
+        return value.__class__(bind(item, stub) for item in value)
+    return value
+
+
+class FakeStub:
+    """Stub adapter that sends the calls of its managed objects to a FakeVCenter"""
+
+    def __init__(self, vcenter):
+        self.vcenter = vcenter
+        self.version = 'vim.version.version8'
+        self.cookie = 'vmware_soap_session="fake"'
+
+    def InvokeMethod(self, mo, info, args, outerStub=None):
+        # with an outerStub (sessions.SessionPool) the result is (status, obj), like SoapStubAdapter
+        outer = outerStub or self
+        try:
+            result = self.vcenter.invoke(outer, mo, info, args)
+        except vmodl.MethodFault as e:
+            if outer is not self:
+                return 500, e
+            raise
+        if outer is not self:
+            return 200, result
+        return result
+
+    def InvokeAccessor(self, mo, info):
+        return self.InvokeMethod(mo, _FETCH, (info.name,))
+
+    def GetSessionId(self):
+        return 'fake'
+
+    def DropConnections(self):
+        pass
+
+
+class _Fetch:
+    # method info of a property accessor
+    wsdlName = 'Fetch'
+    name = 'Fetch'
+
+
+_FETCH = _Fetch()
+
+
+class FakeVCenter:
+    """Synthetic inventory and the vCenter methods working on it
+
+    datacenters, vms:  size of the inventory (the VMs are spread evenly)
+    datastores:        datastores per datacenter, named ds0, ds1, ... in every datacenter
+    latency:           seconds every call takes
+    task_seconds:      seconds a task runs
+    copy_rate:         bytes per second of a relocation (added to task_seconds)
+    """
+
+    def __init__(self, datacenters=1, vms=100, datastores=4, hosts=4, folders=10, latency=0.0,
+                 task_seconds=0.1, copy_rate=None, iso_ratio=0.2, snapshot_ratio=0.3,
+                 template_ratio=0.01, seed=1):
+        self.latency = latency
+        self.task_seconds = task_seconds
+        self.copy_rate = copy_rate
+        self.lock = threading.RLock()
+        self.calls = collections.Counter()
+        self.home = FakeStub(self)
+        self.objects = {}
+        # moid -> change counter, so WaitForUpdatesEx sees changed data objects
+        self.generation = collections.Counter()
+        self.tasks = {}
+        # VM moId -> task waiting for the answer to runtime.question
+        self.questions = {}
+        self.views = {}
+        self.filters = {}
+        self.pages = {}
+        self.ids = itertools.count(1)
+        self.random = random.Random(seed)
+        self._build(datacenters, vms, datastores, hosts, folders, iso_ratio, snapshot_ratio, template_ratio)
+
+    # -- inventory ---------------------------------------------------------
+
+    def _add(self, cls, prefix, props, moid=None):
+        moid = moid or '%s-%d' % (prefix, next(self.ids))
+        self.objects[moid] = {'type': cls, 'props': props}
+        return cls(moid, self.home)
+
+    def _build(self, datacenters, vms, datastores, hosts, folders, iso_ratio, snapshot_ratio, template_ratio):
+        rnd = self.random
+        self.root = self._add(vim.Folder, 'group-d', {'name': 'Datacenters', 'parent': None, 'childEntity': []},
+                              moid='group-d1')
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.root,
+            propertyCollector=vmodl.query.PropertyCollector('propertyCollector', self.home),
+            viewManager=vim.view.ViewManager('ViewManager', self.home),
+            sessionManager=vim.SessionManager('SessionManager', self.home),
+            about=vim.AboutInfo(name='Fake vCenter', fullName='Fake vCenter', vendor='bench', version='8.0.0',
+                                build='0', apiType='VirtualCenter', apiVersion='8.0.0.0',
+                                instanceUuid='fake-vcenter-0000'))
+        self.vm_count = 0
+        for d in range(datacenters):
+            count = vms // datacenters + (1 if d < vms % datacenters else 0)
+            self._build_datacenter(d, count, datastores, hosts, folders, iso_ratio, snapshot_ratio,
+                                   template_ratio, rnd)
+
+    def _build_datacenter(self, d, vms, datastores, hosts, folders, iso_ratio, snapshot_ratio,
+                          template_ratio, rnd):
+        dc = self._add(vim.Datacenter, 'datacenter', {'name': 'DC%d' % d, 'parent': self.root})
+        self.objects['group-d1']['props']['childEntity'].append(dc)
+        vm_folder = self._add(vim.Folder, 'group-v', {'name': 'vm', 'parent': dc, 'childEntity': []})
+        host_folder = self._add(vim.Folder, 'group-h', {'name': 'host', 'parent': dc, 'childEntity': []})
+        ds_folder = self._add(vim.Folder, 'group-s', {'name': 'datastore', 'parent': dc, 'childEntity': []})
+        props = self.objects[dc._moId]['props']
+        props.update({'vmFolder': vm_folder, 'hostFolder': host_folder, 'datastoreFolder': ds_folder})
+
+        cluster = self._add(vim.ClusterComputeResource, 'domain-c', {'name': 'Cluster', 'parent': host_folder})
+        self.objects[host_folder._moId]['props']['childEntity'].append(cluster)
+        pool = self._add(vim.ResourcePool, 'resgroup', {'name': 'Resources', 'parent': cluster, 'resourcePool': []})
+        host_list = []
+        for h in range(hosts):
+            host_list.append(self._add(vim.HostSystem, 'host', {'name': 'esx%d.dc%d' % (h, d), 'parent': cluster}))
+        self.objects[cluster._moId]['props'].update({'resourcePool': pool, 'host': vim.HostSystem.Array(host_list)})
+
+        ds_list = []
+        for s in range(datastores):
+            ds = self._add(vim.Datastore, 'datastore', {'name': 'ds%d' % s, 'parent': ds_folder})
+            self.objects[ds._moId]['props']['summary'] = vim.Datastore.Summary(
+                datastore=ds, name='ds%d' % s, url='ds:///vmfs/volumes/ds%d-%d/' % (d, s), type='VMFS',
+                accessible=True, capacity=100 * 1024 * GB, freeSpace=100 * 1024 * GB)
+            ds_list.append(ds)
+        props['datastore'] = ds_list
+        self.objects[ds_folder._moId]['props']['childEntity'] = list(ds_list)
+
+        folder_list = []
+        for f in range(folders):
+            folder = self._add(vim.Folder, 'group-v', {'name': 'kunde%d' % f, 'parent': vm_folder, 'childEntity': []})
+            self.objects[vm_folder._moId]['props']['childEntity'].append(folder)
+            folder_list.append(folder)
+        # a vApp in the vm folder: its VMs have no parent, only parentVApp
+        vapp = self._add(vim.VirtualApp, 'resgroup-v', {'name': 'vapp', 'parent': pool, 'parentFolder': vm_folder,
+                                                        'vm': []})
+        self.objects[vm_folder._moId]['props']['childEntity'].append(vapp)
+        self.objects[pool._moId]['props']['resourcePool'].append(vapp)
+
+        for i in range(vms):
+            self.vm_count += 1
+            folder = folder_list[i % len(folder_list)] if folder_list else vm_folder
+            template = rnd.random() < template_ratio
+            if i % 20 == 19:
+                vm = self._add(vim.VirtualMachine, 'vm', {'name': 'vm%05d' % self.vm_count, 'parent': None,
+                                                          'parentVApp': vapp})
+                self.objects[vapp._moId]['props']['vm'].append(vm)
+            else:
+                vm = self._add(vim.VirtualMachine, 'vm', {'name': 'vm%05d' % self.vm_count, 'parent': folder})
+                self.objects[folder._moId]['props']['childEntity'].append(vm)
+            devices = []
+            home = ds_list[i % len(ds_list)]
+            for k in range(rnd.randint(1, 3)):
+                # most disks next to the VM, some on another datastore
+                ds = home if k == 0 or rnd.random() < 0.7 else rnd.choice(ds_list)
+                capacity = rnd.choice((20, 40, 60, 100, 200)) * GB
+                devices.append(vim.vm.device.VirtualDisk(
+                    key=2000 + k, deviceInfo=vim.Description(label='Hard disk %d' % (k + 1), summary=''),
+                    capacityInKB=capacity // 1024, capacityInBytes=capacity,
+                    backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                        fileName='[%s] vm%05d/vm%05d_%d.vmdk' % (self._name(ds), self.vm_count, self.vm_count, k),
+                        datastore=ds, diskMode='persistent', thinProvisioned=rnd.random() < 0.5)))
+            # every third VM with an ISO has the CD-ROM door locked by the guest
+            locked = False
+            if rnd.random() < iso_ratio:
+                backing = vim.vm.device.VirtualCdrom.IsoBackingInfo(
+                    fileName='[%s] iso/install.iso' % self._name(home), datastore=home)
+                locked = self.vm_count % 3 == 0
+            else:
+                backing = vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo(deviceName='', exclusive=False)
+            devices.append(vim.vm.device.VirtualCdrom(
+                key=3000, deviceInfo=vim.Description(label='CD/DVD drive 1', summary=''), backing=backing))
+            self.objects[vm._moId]['props'].update({
+                'config': vim.vm.ConfigInfo(name='vm%05d' % self.vm_count, template=template,
+                                            hardware=vim.vm.VirtualHardware(device=devices),
+                                            files=vim.vm.FileInfo(vmPathName='[%s] vm%05d/vm%05d.vmx' % (
+                                                self._name(home), self.vm_count, self.vm_count))),
+                'home': home._moId,
+                'cdromLocked': locked,
+                'runtime': vim.vm.RuntimeInfo(
+                    powerState='poweredOff' if template or rnd.random() < 0.2 else 'poweredOn',
+                    host=host_list[i % len(host_list)] if host_list else None),
+                'snapshot': None,
+            })
+            if rnd.random() < snapshot_ratio:
+                self.objects[vm._moId]['props']['snapshot'] = vim.vm.SnapshotInfo(
+                    rootSnapshotList=self._snapshot_tree(vm, rnd.randint(1, 3), rnd))
+            self._update_storage(vm._moId)
+
+    def _name(self, mo):
+        return self.objects[mo._moId]['props']['name']
+
+    def _snapshot_tree(self, vm, depth, rnd):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshot = self._add(vim.vm.Snapshot, 'snapshot', {'vm': vm})
+        tree = vim.vm.SnapshotTree(
+            snapshot=snapshot, vm=vm, name='snap-%s' % snapshot._moId, description='',
+            id=next(self.ids), createTime=now - datetime.timedelta(days=rnd.randint(0, 90)),
+            state='poweredOff', quiesced=False,
+            childSnapshotList=self._snapshot_tree(vm, depth - 1, rnd) if depth > 1 else [])
+        return [tree]
+
+    def _layout(self, moid):
+        # layoutEx from the disks and the snapshot tree: every snapshot froze one
+        # delta per disk (a quarter GB per snapshot id modulo 8), the last one
+        # in the tree is the current snapshot the running deltas follow
+        props = self.objects[moid]['props']
+        files = []
+
+        def add(name, kind, size):
+            files.append(vim.vm.FileLayoutEx.FileInfo(key=len(files), name=name, type=kind, size=size))
+            return len(files) - 1
+        disks = [d for d in props['config'].hardware.device if isinstance(d, vim.vm.device.VirtualDisk)]
+        chains = {}
+        for disk in disks:
+            name = disk.backing.fileName
+            chains[disk.key] = [[add(name, 'diskDescriptor', 512),
+                                 add(name[:-5] + '-flat.vmdk', 'diskExtent', disk.capacityInBytes)]]
+        home = props['config'].files.vmPathName.rsplit('/', 1)[0]
+        snapshots = []
+        stack = [(tree, chains) for tree in reversed(props['snapshot'].rootSnapshotList if props['snapshot'] else [])]
+        while stack:
+            tree, parent_chains = stack.pop()
+            own = dict((disk.key, parent_chains[disk.key]) for disk in disks)
+            data = add('%s/%s-Snapshot%d.vmsn' % (home, props['name'], tree.id), 'snapshotData', 32 * 1024)
+            snapshots.append(vim.vm.FileLayoutEx.SnapshotLayout(
+                key=tree.snapshot, dataKey=data, memoryKey=-1,
+                disk=[vim.vm.FileLayoutEx.DiskLayout(key=key, chain=[vim.vm.FileLayoutEx.DiskUnit(fileKey=unit)
+                                                                  for unit in own[key]]) for key in own]))
+            child_chains = {}
+            for disk in disks:
+                name = disk.backing.fileName[:-5] + '-%06d' % tree.id
+                child_chains[disk.key] = own[disk.key] + [[add(name + '.vmdk', 'diskDescriptor', 512),
+                                                            add(name + '-delta.vmdk', 'diskExtent',
+                                                                (tree.id % 8 + 1) * GB // 4)]]
+            for child in reversed(tree.childSnapshotList):
+                stack.append((child, child_chains))
+            current = child_chains
+        if not snapshots:
+            current = chains
+        return vim.vm.FileLayoutEx(
+            file=files, snapshot=snapshots,
+            disk=[vim.vm.FileLayoutEx.DiskLayout(key=key, chain=[vim.vm.FileLayoutEx.DiskUnit(fileKey=unit)
+                                                              for unit in current[key]]) for key in current],
+            timestamp=datetime.datetime.now(datetime.timezone.utc))
+
+    def _update_storage(self, moid):
+        # perDatastoreUsage and datastore list from the disk backings (thin disks half full)
+        props = self.objects[moid]['props']
+        usage = collections.OrderedDict()
+        for device in props['config'].hardware.device:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                committed = device.capacityInBytes // (2 if device.backing.thinProvisioned else 1)
+                key = device.backing.datastore._moId
+                usage[key] = usage.get(key, 0) + committed
+        props['storage'] = vim.vm.StorageInfo(perDatastoreUsage=[
+            vim.vm.StorageInfo.UsageOnDatastore(datastore=vim.Datastore(ds, self.home), committed=committed,
+                                                uncommitted=0, unshared=committed)
+            for ds, committed in usage.items()])
+        datastores = list(usage)
+        if props['home'] not in usage:
+            datastores.append(props['home'])
+        props['datastore'] = [vim.Datastore(ds, self.home) for ds in datastores]
+        self.generation[moid] += 1
+
+    # -- dispatch ----------------------------------------------------------
+
+    def invoke(self, stub, mo, info, args):
+        method = info.wsdlName
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, '_m_' + method, None)
+        if handler is None:
+            raise vmodl.fault.MethodNotFound(receiver=mo, method=method)
+        with self.lock:
+            if method != 'WaitForUpdatesEx':
+                return bind(handler(stub, mo, *args), stub)
+        # blocks, must not hold the lock
+        return bind(handler(stub, mo, *args), stub)
+
+    def _mo(self, moid, stub):
+        if moid in self.tasks:
+            return vim.Task(moid, stub)
+        if moid in self.objects:
+            return self.objects[moid]['type'](moid, stub)
+        return vim.ManagedEntity(moid, stub)
+
+    def _object(self, mo):
+        obj = self.objects.get(mo._moId)
+        if obj is None and mo._moId not in self.tasks and mo._moId not in self.views \
+                and mo._moId not in self.filters:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return obj
+
+    def property(self, moid, path):
+        """Value of a property path of an object (None if it is not set)"""
+        parts = path.split('.')
+        if moid in self.tasks:
+            value = self._task_info(moid)
+            declared = None
+        elif moid in self.views:
+            if path != 'view':
+                return None
+            return vim.view.ManagedObjectView._propInfo['view'].type(self._view_objects(moid))
+        elif parts[0] == 'layoutEx' and self.objects[moid]['type'] is vim.VirtualMachine:
+            value = self._layout(moid)
+            declared = None
+        elif parts[0] == 'vm' and self.objects[moid]['type'] is vim.Datastore:
+            # VMs with files on the datastore
+            value = [vim.VirtualMachine(vm_moid, self.home) for vm_moid, vm in self.objects.items()
+                     if vm['type'] is vim.VirtualMachine and any(ds._moId == moid for ds in vm['props']['datastore'])]
+            declared = vim.Datastore._propInfo['vm'].type
+        else:
+            obj = self.objects[moid]
+            value = obj['props'].get(parts[0])
+            prop_info = getattr(obj['type'], '_propInfo', {}).get(parts[0])
+            declared = prop_info.type if prop_info else None
+        for part in parts[1:]:
+            if value is None:
+                return None
+            declared = value._GetPropertyInfo(part).type
+            value = getattr(value, part, None)
+        if type(value) is list and declared is not None:
+            # typed array, like the deserialized values of the SOAP stub
+            value = declared(value)
+        return value
+
+    def _m_Fetch(self, stub, mo, prop):
+        if mo._moId == 'ServiceInstance':
+            if prop == 'content':
+                return self.content
+            raise vmodl.fault.InvalidArgument(invalidProperty=prop)
+        self._object(mo)
+        return self.property(mo._moId, prop)
+
+    def _m_RetrieveServiceContent(self, stub, mo):
+        return self.content
+
+    def _m_CurrentTime(self, stub, mo):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def _m_Login(self, stub, mo, userName, password, locale=None):
+        return vim.UserSession(key='fake', userName=userName, fullName=userName,
+                               loginTime=datetime.datetime.now(datetime.timezone.utc),
+                               lastActiveTime=datetime.datetime.now(datetime.timezone.utc),
+                               locale='en', messageLocale='en', extensionSession=False)
+
+    def _m_Logout(self, stub, mo):
+        return None
+
+    # -- views -------------------------------------------------------------
+
+    def _m_CreateContainerView(self, stub, mo, container, type, recursive):
+        moid = 'session[fake]view-%d' % next(self.ids)
+        self.views[moid] = {'container': container._moId, 'types': list(type or []), 'recursive': recursive}
+        return vim.view.ContainerView(moid, stub)
+
+    def _m_CreateListView(self, stub, mo, obj):
+        moid = 'session[fake]list-%d' % next(self.ids)
+        self.views[moid] = {'objects': [o._moId for o in obj or []]}
+        return vim.view.ListView(moid, stub)
+
+    def _m_ModifyListView(self, stub, mo, add=None, remove=None):
+        view = self.views[mo._moId]['objects']
+        for obj in add or []:
+            if obj._moId not in view:
+                view.append(obj._moId)
+        for obj in remove or []:
+            if obj._moId in view:
+                view.remove(obj._moId)
+        return []
+
+    def _m_DestroyView(self, stub, mo):
+        self.views.pop(mo._moId, None)
+
+    def _parent(self, moid):
+        props = self.objects[moid]['props']
+        return props.get('parent') or props.get('parentVApp')
+
+    def _in_container(self, moid, container, recursive):
+        parent = self._parent(moid)
+        while parent is not None:
+            if parent._moId == container:
+                return True
+            if not recursive:
+                return False
+            parent = self._parent(parent._moId)
+        return False
+
+    def _view_objects(self, moid):
+        view = self.views[moid]
+        if 'objects' in view:
+            return [self._mo(o, self.home) for o in view['objects'] if o in self.tasks or o in self.objects]
+        result = []
+        for obj_moid, obj in self.objects.items():
+            if any(issubclass(obj['type'], t) for t in view['types']) \
+                    and self._in_container(obj_moid, view['container'], view['recursive']):
+                result.append(obj['type'](obj_moid, self.home))
+        return result
+
+    # -- property collector -----------------------------------------------
+
+    def _select(self, spec):
+        """{moid: (managed object type, [paths])} selected by a FilterSpec"""
+        selected = collections.OrderedDict()
+        for obj_spec in spec.objectSet:
+            moid = obj_spec.obj._moId
+            if obj_spec.selectSet and moid in self.views:
+                moids = [o._moId for o in self._view_objects(moid)]
+            else:
+                moids = [] if obj_spec.skip else [moid]
+                # one level of traversal along a property, e.g. Datastore.vm
+                for traversal in obj_spec.selectSet or []:
+                    if moid in self.objects and issubclass(self.objects[moid]['type'], traversal.type):
+                        moids += [o._moId for o in self.property(moid, traversal.path) or []]
+            for moid in moids:
+                if moid in self.tasks:
+                    cls = vim.Task
+                elif moid in self.objects:
+                    cls = self.objects[moid]['type']
+                else:
+                    continue
+                for prop_spec in spec.propSet:
+                    if issubclass(cls, prop_spec.type):
+                        selected[moid] = (cls, list(prop_spec.pathSet or []))
+        return selected
+
+    def _object_content(self, stub, moid, cls, paths):
+        props = []
+        for path in paths:
+            value = self.property(moid, path)
+            if value is not None:
+                props.append(vmodl.DynamicProperty(name=path, val=value))
+        return vmodl.query.PropertyCollector.ObjectContent(obj=cls(moid, stub), propSet=props)
+
+    def _m_RetrievePropertiesEx(self, stub, mo, specSet, options=None):
+        contents = []
+        for spec in specSet:
+            for moid, (cls, paths) in self._select(spec).items():
+                contents.append(self._object_content(stub, moid, cls, paths))
+        return self._page(contents, options.maxObjects if options and options.maxObjects else None)
+
+    def _m_RetrieveContents(self, stub, mo, specSet):
+        return self._m_RetrievePropertiesEx(stub, mo, specSet).objects
+
+    def _page(self, contents, size):
+        if size is None or len(contents) <= size:
+            return vmodl.query.PropertyCollector.RetrieveResult(objects=contents)
+        token = 'token-%d' % next(self.ids)
+        self.pages[token] = (contents[size:], size)
+        return vmodl.query.PropertyCollector.RetrieveResult(objects=contents[:size], token=token)
+
+    def _m_ContinueRetrievePropertiesEx(self, stub, mo, token):
+        if token not in self.pages:
+            raise vmodl.fault.InvalidArgument(invalidProperty='token')
+        contents, size = self.pages.pop(token)
+        return self._page(contents, size)
+
+    def _m_CreatePropertyCollector(self, stub, mo):
+        moid = 'session[fake]pc-%d' % next(self.ids)
+        self.objects[moid] = {'type': vmodl.query.PropertyCollector, 'props': {}, 'filters': []}
+        return vmodl.query.PropertyCollector(moid, stub)
+
+    def _m_DestroyPropertyCollector(self, stub, mo):
+        collector = self._object(mo)
+        for filter_moid in collector['filters']:
+            self.filters.pop(filter_moid, None)
+        self.objects.pop(mo._moId, None)
+
+    def _m_CreateFilter(self, stub, mo, spec, partialUpdates):
+        moid = 'session[fake]filter-%d' % next(self.ids)
+        self.filters[moid] = {'spec': spec, 'reported': {}}
+        self._collector(mo)['filters'].append(moid)
+        return vmodl.query.PropertyCollector.Filter(moid, stub)
+
+    def _collector(self, mo):
+        if mo._moId == 'propertyCollector':
+            return self.objects.setdefault('propertyCollector', {'type': vmodl.query.PropertyCollector,
+                                                                 'props': {}, 'filters': []})
+        return self._object(mo)
+
+    def _key(self, moid, value):
+        # comparable form of a property value
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        if isinstance(value, VmomiSupport.ManagedObject):
+            return value._moId
+        if isinstance(value, list):
+            return tuple(self._key(moid, v) for v in value)
+        return (id(value), self.generation[moid])
+
+    def _updates(self, stub, filter_moid):
+        current = {}
+        f = self.filters[filter_moid]
+        for moid, (cls, paths) in self._select(f['spec']).items():
+            current[moid] = (cls, dict((path, self.property(moid, path)) for path in paths))
+        object_updates = []
+        reported = f['reported']
+        for moid, (cls, values) in current.items():
+            keys = dict((path, self._key(moid, value)) for path, value in values.items())
+            old = reported.get(moid)
+            if old == keys:
+                continue
+            changes = []
+            for path, value in values.items():
+                if old is None or old.get(path) != keys[path]:
+                    if value is None:
+                        changes.append(vmodl.query.PropertyCollector.Change(name=path, op='remove'))
+                    else:
+                        changes.append(vmodl.query.PropertyCollector.Change(name=path, op='assign', val=value))
+            object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                kind='enter' if old is None else 'modify', obj=cls(moid, stub), changeSet=changes))
+            reported[moid] = keys
+        for moid in list(reported):
+            if moid not in current:
+                del reported[moid]
+                object_updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                    kind='leave', obj=self._mo(moid, stub), changeSet=[]))
+        return object_updates
+
+    def _m_WaitForUpdatesEx(self, stub, mo, version=None, options=None):
+        max_wait = options.maxWaitSeconds if options else None
+        started = time.time()
+        while True:
+            with self.lock:
+                collector = self._collector(mo)
+                if collector.pop('cancelled', False):
+                    raise vmodl.fault.RequestCanceled()
+                if not version:
+                    for filter_moid in collector['filters']:
+                        self.filters[filter_moid]['reported'] = {}
+                filter_updates = []
+                for filter_moid in collector['filters']:
+                    object_updates = self._updates(stub, filter_moid)
+                    if object_updates:
+                        filter_updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+                            filter=vmodl.query.PropertyCollector.Filter(filter_moid, stub), objectSet=object_updates))
+                if filter_updates:
+                    collector['version'] = collector.get('version', 0) + 1
+                    return vmodl.query.PropertyCollector.UpdateSet(
+                        version=str(collector['version']), filterSet=filter_updates, truncated=False)
+            if max_wait is not None and time.time() - started >= max_wait:
+                return None
+            time.sleep(POLL_SECONDS)
+            version = version or 'polled'
+
+    def _m_CancelWaitForUpdates(self, stub, mo):
+        # the waiting WaitForUpdatesEx call of the collector raises RequestCanceled
+        self._collector(mo)['cancelled'] = True
+
+    # -- tasks -------------------------------------------------------------
+
+    def _task(self, stub, entity, name, effect, seconds=None):
+        moid = 'task-%d' % next(self.ids)
+        now = time.time()
+        self.tasks[moid] = {'entity': entity, 'name': name, 'effect': effect, 'start': now,
+                            'end': now + (self.task_seconds if seconds is None else seconds),
+                            'done': False, 'error': None}
+        return vim.Task(moid, stub)
+
+    def _task_state(self, moid):
+        task = self.tasks[moid]
+        now = time.time()
+        if now < task['end']:
+            # progress in steps of 10 percent, like most vCenter tasks
+            progress = int(10 * (now - task['start']) / (task['end'] - task['start'])) * 10
+            return 'running', progress
+        if not task['done']:
+            task['done'] = True
+            try:
+                task['effect']()
+            except vmodl.MethodFault as e:
+                task['error'] = e
+        return ('error' if task['error'] else 'success'), 100
+
+    def _task_info(self, moid):
+        with self.lock:
+            task = self.tasks[moid]
+            state, progress = self._task_state(moid)
+        return vim.TaskInfo(key=moid, task=vim.Task(moid, self.home), descriptionId=task['name'],
+                            entity=task['entity'], state=state, cancelled=False, cancelable=False,
+                            error=task['error'], progress=progress if state == 'running' else None,
+                            queueTime=datetime.datetime.fromtimestamp(task['start'], datetime.timezone.utc),
+                            eventChainId=0)
+
+    def _devices(self, moid):
+        return self.objects[moid]['props']['config'].hardware.device
+
+    def _m_RelocateVM_Task(self, stub, mo, spec, priority=None):
+        self._object(mo)
+        moid = mo._moId
+        locators = dict((locator.diskId, locator) for locator in spec.disk or [])
+        size = sum(u.committed for u in self.objects[moid]['props']['storage'].perDatastoreUsage)
+
+        def relocate():
+            for device in self._devices(moid):
+                if not isinstance(device, vim.vm.device.VirtualDisk):
+                    continue
+                locator = locators.get(device.key)
+                target = locator.datastore if locator else spec.datastore
+                if target is None:
+                    continue
+                old = device.backing.datastore
+                committed = device.capacityInBytes // (2 if device.backing.thinProvisioned else 1)
+                if locator and locator.diskBackingInfo is not None and \
+                        locator.diskBackingInfo.thinProvisioned is not None:
+                    device.backing.thinProvisioned = locator.diskBackingInfo.thinProvisioned
+                new_committed = device.capacityInBytes // (2 if device.backing.thinProvisioned else 1)
+                device.backing.datastore = vim.Datastore(target._moId, self.home)
+                device.backing.fileName = '[%s] %s' % (self._name(target), device.backing.fileName.split('] ', 1)[-1])
+                self._move_space(old._moId, target._moId, committed, new_committed)
+            if spec.datastore is not None:
+                # the VM home (configuration files) moves with spec.datastore
+                props = self.objects[moid]['props']
+                props['home'] = spec.datastore._moId
+                props['config'].files.vmPathName = '[%s] %s' % (
+                    self._name(spec.datastore), props['config'].files.vmPathName.split('] ', 1)[-1])
+            self._update_storage(moid)
+        seconds = self.task_seconds + (size / float(self.copy_rate) if self.copy_rate else 0)
+        return self._task(stub, mo, 'VirtualMachine.relocate', relocate, seconds)
+
+    def _move_space(self, old, new, committed, new_committed):
+        for moid, delta in ((old, committed), (new, -new_committed)):
+            summary = self.objects[moid]['props']['summary']
+            summary.freeSpace += delta
+            self.generation[moid] += 1
+
+    def _m_Rename_Task(self, stub, mo, newName):
+        self._object(mo)
+
+        def rename():
+            # names are unique per folder
+            parent = self._parent(mo._moId)
+            for moid, obj in self.objects.items():
+                if moid != mo._moId and self._parent(moid) == parent and obj['props'].get('name') == newName:
+                    raise vim.fault.DuplicateName(name=newName, object=obj['type'](moid, stub))
+            self.objects[mo._moId]['props']['name'] = newName
+            self.generation[mo._moId] += 1
+        return self._task(stub, mo, 'VirtualMachine.rename', rename)
+
+    def _m_ReconfigVM_Task(self, stub, mo, spec):
+        props = self._object(mo)['props']
+
+        def reconfigure():
+            config = self.objects[mo._moId]['props']['config']
+            devices = list(config.hardware.device)
+            for change in spec.deviceChange or []:
+                keys = [device.key for device in devices]
+                if change.operation == 'edit' and change.device.key in keys:
+                    devices[keys.index(change.device.key)] = change.device
+                elif change.operation == 'remove' and change.device.key in keys:
+                    del devices[keys.index(change.device.key)]
+                elif change.operation == 'add':
+                    devices.append(change.device)
+            config.hardware.device = devices
+            self._update_storage(mo._moId)
+        task = self._task(stub, mo, 'VirtualMachine.reconfigure', reconfigure)
+        if props['cdromLocked'] and props['runtime'].powerState == 'poweredOn' and any(
+                isinstance(change.device, vim.vm.device.VirtualCdrom) for change in spec.deviceChange or []):
+            # the task waits until the question is answered (AnswerVM)
+            self.tasks[task._moId]['end'] = float('inf')
+            props['runtime'].question = vim.vm.QuestionInfo(
+                id='%d' % next(self.ids), text='The guest operating system has locked the CD-ROM door and is '
+                'probably using the CD-ROM. Disconnect anyway and override the lock?',
+                choice=vim.option.ChoiceOption(defaultIndex=1, choiceInfo=[
+                    vim.ElementDescription(key='0', label='button.yes', summary='Yes'),
+                    vim.ElementDescription(key='1', label='button.no', summary='No')]),
+                message=[vim.vm.Message(id='msg.cdromdisconnect.locked', text='')])
+            self.questions[mo._moId] = task._moId
+            self.generation[mo._moId] += 1
+        return task
+
+    def _m_AnswerVM(self, stub, mo, questionId, answerChoice):
+        props = self._object(mo)['props']
+        question = props['runtime'].question
+        if question is None or question.id != questionId:
+            raise vmodl.fault.InvalidArgument(invalidProperty='questionId')
+        task = self.tasks[self.questions.pop(mo._moId)]
+        props['runtime'].question = None
+        props['cdromLocked'] = answerChoice != '0'
+        task['end'] = time.time()
+        if answerChoice != '0':
+            def cancelled():
+                raise vim.fault.GenericVmConfigFault(reason='CD-ROM lock not overridden')
+            task['effect'] = cancelled
+        self.generation[mo._moId] += 1
+
+    def _m_RemoveAllSnapshots_Task(self, stub, mo, consolidate=None, spec=None):
+        self._object(mo)
+
+        def remove_all():
+            self.objects[mo._moId]['props']['snapshot'] = None
+            self.generation[mo._moId] += 1
+        return self._task(stub, mo, 'VirtualMachine.removeAllSnapshots', remove_all)
+
+    def _m_RemoveSnapshot_Task(self, stub, mo, removeChildren, consolidate=None):
+        vm = self._object(mo)['props']['vm']
+
+        def remove():
+            info = self.objects[vm._moId]['props']['snapshot']
+            if info is None or not self._remove_snapshot(info.rootSnapshotList, mo._moId, removeChildren):
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            if not info.rootSnapshotList:
+                self.objects[vm._moId]['props']['snapshot'] = None
+            self.objects.pop(mo._moId, None)
+            self.generation[vm._moId] += 1
+        return self._task(stub, vm, 'VirtualMachine.removeSnapshot', remove)
+
+    def _remove_snapshot(self, trees, moid, children):
+        for i, tree in enumerate(trees):
+            if tree.snapshot._moId == moid:
+                trees[i:i + 1] = [] if children else list(tree.childSnapshotList)
+                return True
+            if self._remove_snapshot(tree.childSnapshotList, moid, children):
+                return True
+        return False
+
+    def _m_MarkAsTemplate(self, stub, mo):
+        self._object(mo)['props']['config'].template = True
+        self.generation[mo._moId] += 1
+
+    def _m_MarkAsVirtualMachine(self, stub, mo, pool, host=None):
+        self._object(mo)['props']['config'].template = False
+        self.generation[mo._moId] += 1
+
+    # -- connections -------------------------------------------------------
+
+    def connect(self):
+        """ServiceInstance on a new stub, like SmartConnect()"""
+        self.calls['Login'] += 1
+        return vim.ServiceInstance('ServiceInstance', FakeStub(self))
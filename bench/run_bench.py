@@ -0,0 +1,148 @@
+#! /usr/bin/env python3
+"""Offline benchmark of the scripts against the simulated vCenter.
+
+Every script runs its dry-run and its execution path against a FakeVCenter
+(bench/fake_vcenter.py) of each requested size. Each run happens in a
+separate process, so the peak memory of one run does not hide the next.
+The report shows wall time, vCenter round-trips, tasks and the peak RSS
+(whole process, including the simulated vCenter) plus the growth of the RSS
+while the script ran.
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+# options of each script; every datacenter of the simulated vCenter has datastores ds0..ds3
+SCRIPTS = {
+    'migrate_datastore': ['-s', 'ds0', '-d', 'ds3'],
+    'migrate_datastore_threaded': ['-s', 'ds0', '-d', 'ds3', '-t', '{threads}'],
+    'remove_iso': ['-s', 'ds0', '--answer-lock', 'yes', '-t', '{threads}'],
+    'remove_snapshots': ['--older', '30', '-t', '{threads}'],
+    'rename_vms': ['--suffix', '_bench', '-t', '{threads}'],
+    'pipeline': ['-s', 'ds0', '--remove-iso', '--answer-lock', 'yes', '--remove-snapshots', '--older', '30',
+                 '-d', 'ds3', '--suffix', '_bench', '-t', '{threads}'],
+}
+
+
+def GetArgs():
+   parser = argparse.ArgumentParser(
+       description="Benchmark the scripts against a simulated vCenter")
+   parser.add_argument('--vms', dest='vms', default='100,1000,10000',
+                       help="inventory sizes (comma separated)\nSample: --vms 100,1000")
+   parser.add_argument('--datacenters', dest='datacenters', default=2, type=int,
+                       help="datacenters of the simulated vCenter\nSample: --datacenters 4")
+   parser.add_argument('--latency', dest='latency', default=0.001, type=float,
+                       help="seconds every vCenter call takes\nSample: --latency 0.005")
+   parser.add_argument('--task-seconds', dest='task_seconds', default=0.02, type=float,
+                       help="seconds every vCenter task runs\nSample: --task-seconds 0.5")
+   parser.add_argument('--copy-rate', dest='copy_rate', default=None, type=float,
+                       help="bytes per second a relocation copies (added to --task-seconds)\nSample: --copy-rate 1e12")
+   parser.add_argument('-t', '--threads', dest='threads', default=8, type=int,
+                       help="--threads of the scripts\nSample: --threads 16")
+   parser.add_argument('--scripts', dest='scripts', default=','.join(sorted(SCRIPTS)),
+                       help="scripts to run (comma separated)\nSample: --scripts remove_snapshots,rename_vms")
+   parser.add_argument('--paths', dest='paths', default='dryrun,execute',
+                       help="dryrun and/or execute\nSample: --paths dryrun")
+   parser.add_argument('--json', dest='json',
+                       help="also write the results to this JSON file\nSample: --json bench.json")
+   parser.add_argument('--child', dest='child', help=argparse.SUPPRESS)
+   return parser.parse_args()
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / (1024.0 ** 2)
+
+
+class NoSleep:
+    # replaces the time module of a script, so its fixed sleeps do not count
+    time = staticmethod(time.time)
+
+    @staticmethod
+    def sleep(seconds):
+        pass
+
+
+def run_case(case):
+    """Run one script against a new FakeVCenter, in this process"""
+    import fake_vcenter
+    import inventory_cache
+    import sessions
+    vc = fake_vcenter.FakeVCenter(datacenters=case['datacenters'], vms=case['vms'], latency=case['latency'],
+                                  task_seconds=case['taskSeconds'], copy_rate=case['copyRate'])
+    module = importlib.import_module(case['script'])
+    connect = lambda *args, **kwargs: vc.connect()
+    for patched in (module, sessions, inventory_cache):
+        if hasattr(patched, 'SmartConnect'):
+            patched.SmartConnect = connect
+    module.Disconnect = lambda si: None
+    if hasattr(module, 'time'):
+        module.time = NoSleep
+    # journal and cache files
+    inventory_cache.CACHE_DIR = tempfile.mkdtemp(prefix='managevms-bench-')
+    options = [option.format(threads=case['threads']) for option in SCRIPTS[case['script']]]
+    sys.argv = [case['script'] + '.py', '-S', 'fake-vcenter', '-u', 'bench', '-p', 'bench'] + options
+    if case['path'] == 'dryrun':
+        sys.argv.append('-n')
+    vc.calls.clear()
+    rss_before = current_rss_mb()
+    output = io.StringIO()
+    started = time.time()
+    with contextlib.redirect_stdout(output):
+        try:
+            status = module.main()
+        except SystemExit as e:
+            status = e.code
+    wall = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return dict(case, wall=round(wall, 3), roundTrips=sum(vc.calls.values()), calls=dict(vc.calls),
+                tasks=len(vc.tasks), peakRssMB=round(peak, 1), rssGrowthMB=round(peak - rss_before, 1),
+                exit=status or 0, outputLines=output.getvalue().count('\n'))
+
+
+def main():
+    args = GetArgs()
+    if args.child:
+        print(json.dumps(run_case(json.loads(args.child))))
+        return 0
+
+    results = []
+    print("%-28s %-8s %6s %9s %11s %7s %9s %9s" % ('script', 'path', 'VMs', 'wall s', 'round-trips', 'tasks',
+                                                 'peak MB', 'growth MB'))
+    for vms in [int(v) for v in args.vms.split(',')]:
+        for script in args.scripts.split(','):
+            for path in args.paths.split(','):
+                case = {'script': script, 'path': path, 'vms': vms, 'datacenters': args.datacenters,
+                        'latency': args.latency, 'taskSeconds': args.task_seconds, 'copyRate': args.copy_rate,
+                        'threads': args.threads}
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(case)],
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                if proc.returncode != 0:
+                    print("%-28s %-8s %6d FAILED: %s" % (script, path, vms, proc.stderr.strip().splitlines()[-1:]))
+                    continue
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                results.append(result)
+                print("%-28s %-8s %6d %9.2f %11d %7d %9.1f %9.1f" % (
+                    script, path, vms, result['wall'], result['roundTrips'], result['tasks'],
+                    result['peakRssMB'], result['rssGrowthMB']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
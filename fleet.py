@@ -0,0 +1,83 @@
+"""Fan-out of a script over several vCenters.
+
+-S/--vcHost takes a comma separated list of vCenters or @file, a file with
+one vCenter per line (# starts a comment). The script then runs once per
+vCenter in a separate process with the same options, so --threads and the
+other limits apply per vCenter. The output lines of each process are
+prefixed with its vCenter and a summary with the exit status of every
+vCenter is printed at the end.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_fleet(value):
+    """True if -S names more than one vCenter"""
+    return bool(value) and (value.startswith('@') or ',' in value)
+
+
+def parse_hosts(value):
+    if value.startswith('@'):
+        hosts = []
+        with open(value[1:]) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    hosts.append(line)
+    else:
+        hosts = [host.strip() for host in value.split(',') if host.strip()]
+    # keep order, drop duplicates
+    return list(dict.fromkeys(hosts))
+
+
+def host_argv(argv, host):
+    """argv with the -S/--vcHost value replaced by host"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ('-S', '--vcHost'):
+            result += [arg, host]
+            skip = True
+        elif arg.startswith('--vcHost='):
+            result.append('--vcHost=' + host)
+        elif arg.startswith('-S'):
+            result.append('-S' + host)
+        else:
+            result.append(arg)
+    return result
+
+
+def fan_out(value, parallel=0):
+    """Run the current script once per vCenter in value, returns the exit status
+
+    At most parallel vCenters (0: all) are processed at the same time.
+    """
+    hosts = parse_hosts(value)
+    if not hosts:
+        print("No vCenter given")
+        return 1
+    lock = threading.Lock()
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+
+    def run(host):
+        proc = subprocess.Popen([sys.executable] + host_argv(sys.argv, host), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        for line in proc.stdout:
+            with lock:
+                print("[" + host + "] " + line.rstrip('\n'), flush=True)
+        return proc.wait()
+
+    with ThreadPoolExecutor(max_workers=parallel or len(hosts)) as pool:
+        status = dict(zip(hosts, pool.map(run, hosts)))
+    print("")
+    print("Summary:")
+    for host in hosts:
+        print("  " + host + ": " + ("OK" if status[host] == 0 else "FAILED (exit status " + str(status[host]) + ")"))
+    return 0 if all(code == 0 for code in status.values()) else 1
@@ -0,0 +1,446 @@
+"""Shared inventory loader for the VM scripts.
+
+Fetches the properties a script needs for all VMs (plus the folders,
+datacenters and datastores needed to resolve names) with a few paged
+PropertyCollector calls and hands back plain records. Filtering then runs
+against these records without any further SOAP round-trips.
+"""
+
+from pyVmomi import vim, vmodl, VmomiSupport
+
+# Properties every script needs to filter VMs
+# (a VM in a vApp has no parent folder, only parentVApp)
+VM_BASE_PROPERTIES = ['name', 'parent', 'parentVApp', 'runtime.powerState', 'config.template']
+# Disks and CD-ROMs (datastore checks, disk sizes, ISO removal)
+VM_DEVICE_PROPERTIES = ['config.hardware.device']
+# Snapshot tree
+VM_SNAPSHOT_PROPERTIES = ['snapshot']
+# Files of the VM (size of the snapshot delta disks)
+VM_LAYOUT_PROPERTIES = ['layoutEx']
+# ESXi host the VM runs on
+VM_HOST_PROPERTIES = ['runtime.host']
+# Space the VM uses per datastore
+VM_STORAGE_PROPERTIES = ['storage.perDatastoreUsage']
+# Datastore of the VM home (configuration files)
+VM_HOME_PROPERTIES = ['config.files.vmPathName']
+
+# Properties of the other objects needed to resolve folder and datastore names
+# (vApps and resource pools for the datacenter of the VMs in a vApp)
+ENTITY_PROPERTIES = {
+    vim.Folder: ['name', 'parent'],
+    vim.Datacenter: ['name', 'parent'],
+    vim.ComputeResource: ['name', 'parent'],
+    vim.ResourcePool: ['name', 'parent'],
+    vim.VirtualApp: ['name', 'parent', 'parentFolder', 'parentVApp'],
+    vim.Datastore: ['name', 'parent', 'summary.freeSpace', 'summary.capacity', 'summary.url'],
+}
+
+# Number of objects per RetrievePropertiesEx/ContinueRetrievePropertiesEx page
+PAGE_SIZE = 1000
+
+
+def build_filter_spec(view, prop_specs):
+    """FilterSpec that selects the given properties of all objects in a ContainerView"""
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_set = []
+    for obj_type, paths in prop_specs.items():
+        prop_set.append(vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=paths, all=False))
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_set)
+
+
+def retrieve_properties(si, prop_specs, container=None, page_size=PAGE_SIZE):
+    """Retrieve properties of all objects below container (default: rootFolder)
+
+    prop_specs maps a managed object type to the list of property paths.
+    Returns a dict moId -> {'type': wsdl type name, 'props': {path: plain value}}
+    """
+    content = si.content
+    if container is None:
+        container = content.rootFolder
+    view = content.viewManager.CreateContainerView(container, list(prop_specs), True)
+    try:
+        return retrieve(si, build_filter_spec(view, prop_specs), page_size)
+    finally:
+        view.Destroy()
+
+
+def retrieve(si, filter_spec, page_size=PAGE_SIZE):
+    """Run one FilterSpec with paged RetrievePropertiesEx calls, see retrieve_properties"""
+    objects = {}
+    for page in retrieve_pages(si, filter_spec, page_size):
+        objects.update(page)
+    return objects
+
+
+def retrieve_pages(si, filter_spec, page_size=PAGE_SIZE):
+    """Like retrieve(), but yields the objects of every page as soon as it arrives"""
+    pc = si.content.propertyCollector
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = pc.RetrievePropertiesEx([filter_spec], options)
+    while result:
+        objects = {}
+        for obj_content in result.objects:
+            props = {}
+            for prop in obj_content.propSet:
+                props[prop.name] = plain_value(prop.name, prop.val)
+            objects[obj_content.obj._moId] = {'type': obj_content.obj._wsdlName, 'props': props}
+        yield objects
+        if not result.token:
+            break
+        result = pc.ContinueRetrievePropertiesEx(result.token)
+
+
+def plain_value(path, value):
+    """Convert a property value into plain python data (MoRefs become moIds)"""
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return value._moId
+    if path == 'storage.perDatastoreUsage':
+        usage = {}
+        for entry in value or []:
+            usage[entry.datastore._moId] = entry.committed
+        return usage
+    if path == 'config.hardware.device':
+        return plain_devices(value)
+    if path == 'snapshot':
+        if value is None:
+            return []
+        return plain_snapshots(value.rootSnapshotList)
+    if path == 'layoutEx':
+        return plain_layout(value)
+    return value
+
+
+def disk_capacity(device):
+    if getattr(device, "capacityInBytes", None) is not None:
+        return device.capacityInBytes
+    elif getattr(device, "capacityInKB", None) is not None:
+        return device.capacityInKB * 1024
+    return 0
+
+
+def plain_devices(devices):
+    """Disks and CD-ROMs of a VM as plain dicts"""
+    result = []
+    for device in devices or []:
+        if isinstance(device, vim.vm.device.VirtualDisk):
+            kind = 'disk'
+        elif isinstance(device, vim.vm.device.VirtualCdrom):
+            kind = 'cdrom'
+        else:
+            continue
+        backing = device.backing
+        datastore = getattr(backing, 'datastore', None)
+        result.append({
+            'kind': kind,
+            'key': device.key,
+            'label': device.deviceInfo.label if device.deviceInfo else '',
+            'fileName': getattr(backing, 'fileName', None),
+            'datastore': datastore._moId if datastore is not None else None,
+            'iso': isinstance(backing, vim.vm.device.VirtualCdrom.IsoBackingInfo),
+            'capacity': disk_capacity(device) if kind == 'disk' else 0,
+            'thinProvisioned': getattr(backing, 'thinProvisioned', None),
+            'diskMode': getattr(backing, 'diskMode', None),
+            # e.g. VirtualDiskFlatVer2BackingInfo, VirtualDiskRawDiskMappingVer1BackingInfo
+            'backing': backing._wsdlName if backing is not None else None,
+        })
+    return result
+
+
+def plain_snapshots(snapshots):
+    """Snapshot tree as nested plain dicts
+
+    Built in one pass without recursion; every snapshot also has its depth
+    (0 for the roots) and the moId of its parent (None for the roots).
+    """
+    result = []
+    stack = [(snapshot, result, None, 0) for snapshot in reversed(snapshots or [])]
+    while stack:
+        snapshot, siblings, parent, depth = stack.pop()
+        record = {
+            'name': snapshot.name,
+            'description': snapshot.description,
+            'createTime': snapshot.createTime,
+            'state': snapshot.state,
+            'id': snapshot.id,
+            'snapshot': snapshot.snapshot._moId,
+            'parent': parent,
+            'depth': depth,
+            'children': [],
+        }
+        siblings.append(record)
+        for child in reversed(snapshot.childSnapshotList or []):
+            stack.append((child, record['children'], record['snapshot'], depth + 1))
+    return result
+
+
+def plain_layout(layout):
+    """Bytes of the snapshot files in layoutEx
+
+    Returns {'snapshots': snapshot moId -> bytes, 'datastores': datastore
+    name -> bytes}. A snapshot owns the delta disks it froze (the last link
+    of its disk chains, unless that is the base disk) and its state and
+    memory files. The delta disks the VM writes to since the current
+    snapshot only count for the datastores.
+    """
+    snapshots = {}
+    datastores = {}
+    if layout is None:
+        return {'snapshots': snapshots, 'datastores': datastores}
+    files = dict((f.key, f) for f in layout.file or [])
+
+    def add(keys):
+        total = 0
+        for key in keys:
+            f = files.get(key)
+            if f is None:
+                continue
+            total += f.size or 0
+            name = f.name[1:f.name.index(']')] if f.name.startswith('[') and ']' in f.name else ''
+            datastores[name] = datastores.get(name, 0) + (f.size or 0)
+        return total
+
+    for snapshot in layout.snapshot or []:
+        keys = [snapshot.dataKey, snapshot.memoryKey]
+        for disk in snapshot.disk or []:
+            if len(disk.chain or []) > 1:
+                keys += disk.chain[-1].fileKey
+        snapshots[snapshot.key._moId] = add(keys)
+    if layout.snapshot:
+        for disk in layout.disk or []:
+            if len(disk.chain or []) > 1:
+                add(disk.chain[-1].fileKey)
+    return {'snapshots': snapshots, 'datastores': datastores}
+
+
+def load_inventory(si, vm_properties, page_size=PAGE_SIZE):
+    """Load all VMs with the given properties and return the inventory
+
+    The inventory is a dict with
+      'vms':        list of VM records (see vm_record)
+      'entities':   moId -> {'type', 'name', 'parent'} for folders, datacenters,
+                    clusters, resource pools and vApps
+      'datastores': moId -> {'name', 'parent', 'freeSpace', 'capacity', 'url'}
+      'paths':      moId -> inventory path of the folders and datacenters
+    Datastore clusters (StoragePods) are entities, their datastores have
+    the pod as parent.
+    """
+    prop_specs = dict(ENTITY_PROPERTIES)
+    prop_specs[vim.VirtualMachine] = list(vm_properties)
+    objects = retrieve_properties(si, prop_specs, page_size=page_size)
+    return build_inventory(si, objects)
+
+
+def load_entities(si, page_size=PAGE_SIZE):
+    """Inventory of the folders, datacenters and datastores only, without VMs
+
+    load_datastore_vms() adds the VMs of some datastores to it.
+    """
+    return build_inventory(si, retrieve_properties(si, dict(ENTITY_PROPERTIES), page_size=page_size))
+
+
+def load_datastore_vms(si, inventory, datastores, vm_properties, page_size=PAGE_SIZE):
+    """Add the VMs with files on the datastores (list of moIds) to an inventory
+
+    The VMs are selected by a traversal along Datastore.vm, so the VMs on
+    other datastores are neither transferred nor evaluated.
+    """
+    if not datastores:
+        return inventory
+    objects = retrieve(si, datastore_vms_spec(si, datastores, vm_properties), page_size)
+    for moid, obj in objects.items():
+        inventory['vms'].append(vm_record(si, moid, obj['props'], inventory))
+    inventory.pop('byDatacenter', None)
+    return inventory
+
+
+def datastore_vms_spec(si, datastores, vm_properties):
+    """FilterSpec of the VMs with files on the datastores (list of moIds), along Datastore.vm"""
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseVms', path='vm', skip=False, type=vim.Datastore)
+    obj_specs = []
+    for moid in datastores:
+        obj_specs.append(vmodl.query.PropertyCollector.ObjectSpec(
+            obj=vim.Datastore(moid, si._stub), skip=True, selectSet=[traversal]))
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=list(vm_properties), all=False)
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+
+
+def iter_vms(si, inventory, vm_properties, datastores=None, page_size=PAGE_SIZE):
+    """VM records of all VMs (or of the VMs with files on datastores), page by page
+
+    The records are yielded as the pages of the scan arrive, so the caller
+    can work on the first VMs while the vCenter still collects the rest.
+    inventory is the one of load_entities(), the VMs are not added to it.
+    """
+    if datastores is not None:
+        if not datastores:
+            return
+        pages = retrieve_pages(si, datastore_vms_spec(si, datastores, vm_properties), page_size)
+        view = None
+    else:
+        view = si.content.viewManager.CreateContainerView(si.content.rootFolder, [vim.VirtualMachine], True)
+        pages = retrieve_pages(si, build_filter_spec(view, {vim.VirtualMachine: list(vm_properties)}), page_size)
+    try:
+        seen = set()
+        for page in pages:
+            for moid, obj in page.items():
+                # a VM on several of the datastores is reported once
+                if moid not in seen:
+                    seen.add(moid)
+                    yield vm_record(si, moid, obj['props'], inventory)
+    finally:
+        if view is not None:
+            view.Destroy()
+
+
+def build_inventory(si, objects):
+    """Turn the result of retrieve_properties into an inventory"""
+    entities = {}
+    datastores = {}
+    for moid, obj in objects.items():
+        props = obj['props']
+        if obj['type'] == 'Datastore':
+            datastores[moid] = {
+                'name': props.get('name', ''),
+                'parent': props.get('parent'),
+                'freeSpace': props.get('summary.freeSpace') or 0,
+                'capacity': props.get('summary.capacity') or 0,
+                'url': props.get('summary.url'),
+            }
+        elif obj['type'] != 'VirtualMachine':
+            entities[moid] = {'type': obj['type'], 'name': props.get('name', ''), 'parent': entity_parent(props)}
+    inventory = {'vms': [], 'entities': entities, 'datastores': datastores}
+    inventory['paths'] = build_paths(entities)
+    for moid, obj in objects.items():
+        if obj['type'] == 'VirtualMachine':
+            inventory['vms'].append(vm_record(si, moid, obj['props'], inventory))
+    return inventory
+
+
+def vm_record(si, moid, props, inventory):
+    """Plain record of a VM
+
+    'obj' is the VirtualMachine managed object for actions on the VM,
+    everything else is plain data that needs no further SOAP calls.
+    """
+    datastores = inventory['datastores']
+    disks = []
+    cdroms = []
+    for device in props.get('config.hardware.device') or []:
+        datastore = datastores.get(device['datastore'])
+        device = dict(device, datastoreName=datastore['name'] if datastore else '')
+        if device['kind'] == 'disk':
+            disks.append(device)
+        else:
+            cdroms.append(device)
+    parent = entity_parent(props)
+    datacenter = find_datacenter(inventory, parent)
+    return {
+        'moid': moid,
+        'obj': vim.VirtualMachine(moid, si._stub),
+        'name': props.get('name', ''),
+        'powerState': props.get('runtime.powerState'),
+        'template': bool(props.get('config.template')),
+        'parent': parent,
+        'host': props.get('runtime.host'),
+        'datacenter': datacenter,
+        'home': home_datastore(inventory, datacenter, props.get('config.files.vmPathName')),
+        'folder': folder_name(inventory, parent),
+        'path': inventory['paths'].get(parent, '') + '/' + props.get('name', ''),
+        'disks': disks,
+        'cdroms': cdroms,
+        'snapshots': props.get('snapshot') or [],
+        'snapshotSizes': (props.get('layoutEx') or {}).get('snapshots', {}),
+        'deltaDatastores': delta_datastores(inventory, datacenter, props.get('layoutEx')),
+        'committed': props.get('storage.perDatastoreUsage') or {},
+    }
+
+
+def entity_parent(props):
+    """moId of the folder (or vApp) an entity is listed in
+
+    A VM in a vApp has no parent, only parentVApp. A vApp has the resource
+    pool as parent, it is listed in parentFolder (or in its parentVApp).
+    """
+    return props.get('parentFolder') or props.get('parent') or props.get('parentVApp')
+
+
+def find_datacenter(inventory, moid):
+    """moId of the datacenter containing the entity moid"""
+    entities = inventory['entities']
+    while moid in entities:
+        if entities[moid]['type'] == 'Datacenter':
+            return moid
+        moid = entities[moid]['parent']
+    return None
+
+
+def build_paths(entities):
+    """Full inventory path of every folder and datacenter, e.g. '/DC1/vm/kunde1'"""
+    paths = {}
+    for moid in entities:
+        # walk up to the first entity with a known path; the root folder
+        # (no parent) is '', it is not part of the ContainerView results
+        chain = []
+        while moid in entities and moid not in paths:
+            chain.append(moid)
+            moid = entities[moid]['parent']
+        path = paths.get(moid, '')
+        for moid in reversed(chain):
+            if entities[moid]['parent'] is None:
+                path = ''
+            else:
+                path += '/' + entities[moid]['name']
+            paths[moid] = path
+    return paths
+
+
+def home_datastore(inventory, datacenter, path):
+    """moId of the datastore in path ('[ds1] vm1/vm1.vmx') in the datacenter"""
+    if not path or not path.startswith('[') or ']' not in path:
+        return None
+    return datastore_by_name(inventory, datacenter, path[1:path.index(']')])
+
+
+def datastore_by_name(inventory, datacenter, name):
+    """moId of the datastore called name in the datacenter"""
+    if 'datastoreNames' not in inventory:
+        names = {}
+        for moid, ds in inventory['datastores'].items():
+            names[(find_datacenter(inventory, ds['parent']), ds['name'])] = moid
+        inventory['datastoreNames'] = names
+    return inventory['datastoreNames'].get((datacenter, name))
+
+
+def delta_datastores(inventory, datacenter, layout):
+    """Datastore moId -> bytes of the snapshot files on it, from plain_layout()"""
+    result = {}
+    for name, size in (layout or {}).get('datastores', {}).items():
+        moid = datastore_by_name(inventory, datacenter, name)
+        if moid is not None:
+            result[moid] = result.get(moid, 0) + size
+    return result
+
+
+def folder_name(inventory, parent):
+    """Folder string the scripts match --folder against: parent/grandparent"""
+    entities = inventory['entities']
+    if parent not in entities:
+        return ''
+    name = entities[parent]['name']
+    grandparent = entities[parent]['parent']
+    if grandparent in entities:
+        name += "/" + entities[grandparent]['name']
+    return name
+
+
+def vms_in_datacenter(inventory, datacenter):
+    """VM records of one datacenter"""
+    if 'byDatacenter' not in inventory:
+        by_datacenter = {}
+        for vm in inventory['vms']:
+            by_datacenter.setdefault(vm['datacenter'], []).append(vm)
+        inventory['byDatacenter'] = by_datacenter
+    return inventory['byDatacenter'].get(datacenter._moId, [])
@@ -0,0 +1,173 @@
+"""Persistent inventory cache with incremental refresh.
+
+The first run with --cache loads the inventory through a PropertyCollector
+filter and WaitForUpdatesEx and stores the plain object properties together
+with the version token in a file keyed by the vCenter instance UUID. The
+vCenter session is kept open (not logged out) and its id is stored as well,
+so the next run reuses the session and its PropertyCollector and only pulls
+the deltas since the stored version.
+
+PropertyCollectors and filters live as long as the session: if the session has
+expired (vCenter default: 30 minutes idle) or the collector is gone, the cache
+is rebuilt with a full load.
+"""
+
+import datetime
+import json
+import os
+
+from pyVmomi import vim, vmodl
+from pyVim.connect import SmartConnect
+
+import inventory
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'managevms')
+CACHE_VERSION = 5
+
+
+def _entity_properties():
+    # the cache has to be rebuilt when inventory.ENTITY_PROPERTIES change
+    properties = []
+    for obj_type, paths in inventory.ENTITY_PROPERTIES.items():
+        for path in paths:
+            properties.append(obj_type.__name__ + '.' + path)
+    return sorted(properties)
+
+
+def _path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError("Cannot cache value of type %s" % type(value).__name__)
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def _read(name):
+    try:
+        with open(_path(name)) as f:
+            return json.load(f, object_hook=_decode)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(name, data):
+    """Write a cache file atomically, readable only by the user (it may hold a session id)"""
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    tmp = _path(name + '.tmp')
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, default=_encode)
+    os.replace(tmp, _path(name))
+
+
+def connect(host, user, password, verbose=False):
+    """Connect to the vCenter, reusing the session of the last --cache run if it is still valid"""
+    session = _read(host + '.session')
+    if session and session.get('user') == user:
+        try:
+            si = SmartConnect(host=host, sessionId=session['sessionId'], disableSslCertValidation=True)
+            if si.content.sessionManager.currentSession is not None:
+                if verbose: print("Reusing cached vCenter session")
+                return si
+        except vmodl.MethodFault:
+            pass
+    si = SmartConnect(host=host, user=user, pwd=password, disableSslCertValidation=True)
+    _write(host + '.session', {'user': user, 'sessionId': si._stub.GetSessionId()})
+    return si
+
+
+def _apply_update(objects, update):
+    """Apply a PropertyCollector UpdateSet to the cached objects"""
+    for filter_update in update.filterSet or []:
+        for obj_update in filter_update.objectSet or []:
+            moid = obj_update.obj._moId
+            if obj_update.kind == 'leave':
+                objects.pop(moid, None)
+                continue
+            obj = objects.setdefault(moid, {'type': obj_update.obj._wsdlName, 'props': {}})
+            for change in obj_update.changeSet or []:
+                if change.op in ('remove', 'indirectRemove'):
+                    obj['props'].pop(change.name, None)
+                else:
+                    obj['props'][change.name] = inventory.plain_value(change.name, change.val)
+
+
+def _wait_for_updates(pc, version, objects, page_size):
+    """Pull all pending updates since version, returns the new version"""
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0, maxObjectUpdates=page_size)
+    while True:
+        update = pc.WaitForUpdatesEx(version, options)
+        if update is None:
+            return version
+        _apply_update(objects, update)
+        version = update.version
+        if not update.truncated:
+            return version
+
+
+def _full_load(si, vm_properties, old, page_size):
+    """Create a new filter on the whole inventory and load it from scratch"""
+    content = si.content
+    if old:
+        # drop collector and view of an older cache in this session, if they still exist
+        try:
+            vmodl.query.PropertyCollector(old['collector'], si._stub).DestroyPropertyCollector()
+            vim.view.ContainerView(old['view'], si._stub).Destroy()
+        except vmodl.MethodFault:
+            pass
+    # A private collector, so pyVim.task.WaitForTask on the session collector
+    # does not consume the updates of our filter
+    pc = content.propertyCollector.CreatePropertyCollector()
+    prop_specs = dict(inventory.ENTITY_PROPERTIES)
+    prop_specs[vim.VirtualMachine] = vm_properties
+    view = content.viewManager.CreateContainerView(content.rootFolder, list(prop_specs), True)
+    pc.CreateFilter(inventory.build_filter_spec(view, prop_specs), partialUpdates=False)
+    objects = {}
+    version = _wait_for_updates(pc, '', objects, page_size)
+    return {
+        'cacheVersion': CACHE_VERSION,
+        'sessionId': si._stub.GetSessionId(),
+        'collector': pc._moId,
+        'view': view._moId,
+        'vmProperties': vm_properties,
+        'entityProperties': _entity_properties(),
+        'version': version,
+        'objects': objects,
+    }
+
+
+def load_inventory(si, vm_properties, verbose=False, page_size=inventory.PAGE_SIZE):
+    """Like inventory.load_inventory, but served from the on-disk cache
+
+    Only the changes since the cached version are fetched from the vCenter.
+    """
+    name = si.content.about.instanceUuid + '.json'
+    cache = _read(name)
+    if cache and (cache.get('cacheVersion') != CACHE_VERSION
+                  or cache.get('entityProperties') != _entity_properties()
+                  or cache.get('sessionId') != si._stub.GetSessionId()):
+        # older format, or collector and view belong to another (expired) session
+        if verbose: print("Inventory cache not reusable, reloading")
+        cache = None
+    if cache and set(vm_properties) <= set(cache['vmProperties']):
+        try:
+            pc = vmodl.query.PropertyCollector(cache['collector'], si._stub)
+            cache['version'] = _wait_for_updates(pc, cache['version'], cache['objects'], page_size)
+            if verbose: print("Inventory cache refreshed (version " + str(cache['version']) + ")")
+            _write(name, cache)
+            return inventory.build_inventory(si, cache['objects'])
+        except vmodl.MethodFault as e:
+            if verbose: print("Inventory cache not usable (" + type(e).__name__ + "), reloading")
+    properties = sorted(set(vm_properties) | set(cache['vmProperties'] if cache else []))
+    cache = _full_load(si, properties, cache, page_size)
+    if verbose: print("Inventory cache loaded (" + str(len(cache['objects'])) + " objects)")
+    _write(name, cache)
+    return inventory.build_inventory(si, cache['objects'])
@@ -0,0 +1,141 @@
+"""Crash-safe journal of a migration run.
+
+Before the first relocation starts, the planned VMs (as plain inventory
+records, keyed by moId) are written to a journal file together with their
+destination datastore. Every state change (queued -> running with the
+vCenter task id -> done/failed) is appended to the file as one JSON line
+and synced to disk, so after an interrupted run (SSH drop, Ctrl-C, session
+timeout) --resume can reattach to the still running tasks and continue
+with the rest of the queue without rescanning the inventory.
+
+The first line of the file holds the plan, every further line a change
+of one VM or, in a streaming run, a VM added to the plan; load() replays
+them. A line cut off by a crash is ignored.
+"""
+
+import json
+import os
+import threading
+import time
+
+import inventory_cache
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def journal_path(host):
+    """Default journal file of a vCenter"""
+    return os.path.join(inventory_cache.CACHE_DIR, host + '.journal')
+
+
+def plain_record(vm):
+    """VM record without the managed object, as stored in the journal"""
+    return dict((key, value) for key, value in vm.items() if key != 'obj')
+
+
+def new_entry(vm, datacenter, destination, destination_name, disks, move_home):
+    return {
+        'vm': plain_record(vm),
+        'datacenter': datacenter,
+        'destination': destination,
+        'destinationName': destination_name,
+        'disks': disks,
+        'moveHome': move_home,
+        'state': QUEUED,
+        'task': None,
+        'error': None,
+    }
+
+
+class MigrationJournal:
+    """Planned VMs of a migration run and their state"""
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        # VM moId -> its entry, so a change is applied without searching the entries
+        self.by_moid = dict((entry['vm']['moid'], entry) for entry in data['entries'])
+        # update() is called from the worker threads of tasks.run_jobs()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, host, planned, provision=None):
+        """New journal for planned, a list of (vm record, datacenter moId, datastore moId, datastore name,
+        keys of the disks to move or None for the whole VM, move the VM home); provision is the disk format"""
+        entries = [new_entry(*planned_vm) for planned_vm in planned]
+        journal = cls(path, {'host': host, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'provisionType': provision,
+                             'entries': entries})
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """Journal of an earlier run, None if there is none"""
+        try:
+            with open(path) as f:
+                journal = cls(path, json.loads(f.readline()))
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # last line of a crashed run, rewrite the journal
+                        # so the next change does not end up on that line
+                        journal.save()
+                        break
+                    if 'entry' in change:
+                        journal._add(change['entry'])
+                    else:
+                        journal._apply(change.pop('moid'), change)
+        except (OSError, ValueError):
+            return None
+        return journal
+
+    def entries(self):
+        return self.data['entries']
+
+    def pending(self):
+        """Entries that are not finished yet (queued or still running)"""
+        return [entry for entry in self.entries() if entry['state'] in (QUEUED, RUNNING)]
+
+    def _apply(self, moid, changes):
+        entry = self.by_moid.get(moid)
+        if entry is not None:
+            entry.update(changes)
+
+    def _add(self, entry):
+        self.entries().append(entry)
+        self.by_moid[entry['vm']['moid']] = entry
+
+    def add(self, vm, datacenter, destination, destination_name, disks=None, move_home=True):
+        """Plan one more VM (a streaming run plans the VMs while the first ones are relocated)"""
+        entry = new_entry(vm, datacenter, destination, destination_name, disks, move_home)
+        with self.lock:
+            self._add(entry)
+            self._append({'entry': entry})
+
+    def update(self, moid, **changes):
+        """Change the entry of VM moid and append the change to the journal"""
+        with self.lock:
+            self._apply(moid, changes)
+            self._append(dict(changes, moid=moid))
+
+    def _append(self, line):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(line) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save(self):
+        # write the plan to a temporary file and rename it, so a crash never leaves a half written journal
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.data) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
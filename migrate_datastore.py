@@ -1,27 +1,35 @@
 #! /usr/bin/env python3
 
 import argparse
-import time
-import re
+import sys
 
 # import the vSphere Python SDK needed modules
 import pyVmomi
 from pyVim.connect import SmartConnect, Disconnect
-from pyVim import task
+
+import fleet
+import inventory
+import inventory_cache
+import placement
+import relocation
+import soap_profile
+import tasks
+import telemetry
+import vm_filter
 
 def GetArgs():
    parser = argparse.ArgumentParser(
        description="This is tool to migrate virtual machine to adatastore")
    parser.add_argument('-S', '--vcHost', dest='host', action='store',
-                       help='VC host to connect. (Required)')
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
    parser.add_argument('-u', '--user', default='administrator@vsphere.local',
                        help='User name of vc host. (Default: \'administrator@vsphere.local\')')
    parser.add_argument('-p', '--password', default='Admin!23',
                        help='Password of vc host.')
    parser.add_argument('-s', '--sourceDatastore', dest='sourecedatastore',
-                       help="Specify the source datastore.")
+                       help="Specify the source datastore(s): comma separated datastore and/or datastore cluster names, URLs or moIds. Sample: --sourceDatastore ds1")
    parser.add_argument('-d', '--ds', dest='datastore',
-                       help="Specify the destination datastore.")
+                       help="Specify the destination datastore(s): comma separated datastore and/or datastore cluster names, URLs or moIds. Sample: --ds ds1,ds2")
    parser.add_argument('-k', '--vm', dest='vm',
                        help="Specify the VM names need to be relocated. (Regular Expression, Case insensitiv). Sample: --vm vmxxx")
    parser.add_argument('-f', '--folder', dest='folder',
@@ -30,49 +38,81 @@ def GetArgs():
                        help="verbose\nSample: --debug 1")
    parser.add_argument('-x', '--exclude', dest='exclude', 
                        help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
    parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
                        help="dry-run\nSample: --dryrun")
    parser.add_argument('-P', '--powerstate', dest='powerstate', default='on',
                        help="powerstate\nSample: --powerstate on|off default: on")
-#   parser.add_argument('-P', '--provisionType', dest='provisionType', default='thick',
-#                       help='Virtual disk provision type, supports: thin, thick; if omitted, thick will be taken',)
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
+   parser.add_argument('--stats', dest='stats',
+                       help="append per VM migration statistics (bytes, duration, throughput) to this JSONL file\nSample: --stats migrations.jsonl")
+   parser.add_argument('--prometheus', dest='prometheus',
+                       help="write throughput and ETA metrics to this Prometheus textfile\nSample: --prometheus /var/lib/node_exporter/migration.prom")
+   parser.add_argument('--per-disk', dest='per_disk', default=False, action="store_true",
+                       help="only move the disks on the source datastore (-s) and the VM home if it is there, the other disks stay\nSample: --per-disk")
+   parser.add_argument('--keep-home', dest='keep_home', default=False, action="store_true",
+                       help="with --per-disk: leave the VM home (configuration files) where it is\nSample: --keep-home")
+   parser.add_argument('--headroom', dest='headroom', default=10, type=float,
+                       help="percent of each destination datastore's capacity to keep free (default: 10)\nSample: --headroom 15")
+   parser.add_argument('--provisionType', dest='provisionType', choices=('thin', 'thick'),
+                       help="convert the moved disks to thin or (lazy zeroed) thick provisioning; if omitted, the disks keep their format\nSample: --provisionType thin")
    args = parser.parse_args()
    #if args.action not in ('relocate_vm'\
    #   'listVMs') or not args.host:
    #   parser.print_help()
    return args
 
-def GetResourcePools(entity):
-   pools = []
-   for pool in entity.resourcePool:
-      pools += GetResourcePools(pool)
-   pools.append(entity)
-   return pools
-
-def convert_to_template(vm,dc):
-    if vm.config.template:
-        print("VM is already a template")
-    else:
-        print("Converting to template")
-        vm.MarkAsTemplate()
-
-def convert_to_vm(vm,dc):
-    if vm.config.template:
-        print("Converting to VM")
-        pools = GetResourcePools(dc.hostFolder.childEntity[0].resourcePool)
-        if len(pools) == 0:
-            print("No resource pool found")
-            return
-        vm.MarkAsVirtualMachine(pool=pools[0])
-        time.sleep(5)
+def size_str(total_bytes):
+    total_mb = total_bytes / (1024 * 1024) if total_bytes else 0
+    total_gb = total_bytes / (1024 * 1024 * 1024) if total_bytes else 0
+    if total_gb >= 1:
+        return "%.2f GB" % total_gb
     else:
-        print("VM is already a VM")
+        return "%.2f MB" % total_mb
+
+def sizes_str(vm, disks=None, provision=None):
+    # committed bytes are copied, the destination needs them for thin and the provisioned bytes for thick disks
+    return "committed %s, provisioned %s, %s on destination" % (
+        size_str(relocation.moved_bytes(vm, disks)), size_str(relocation.provisioned_bytes(vm, disks)),
+        size_str(relocation.destination_bytes(vm, disks, provision)))
+
+def migrate_job(vm, destination_ds, destination_name, stats, disks=None, move_home=True, provision=None):
+    # job for tasks.run_jobs(); vm is an inventory record, vm['obj'] the VirtualMachine
+    # disks: keys of the disks to move (None: the whole VM), provision: 'thin', 'thick' or None (keep the format)
+    vm_obj = vm['obj']
+    def start():
+        print("Migrating VM: " + vm['name'] + " (%s) to %s" % (sizes_str(vm, disks, provision), destination_name))
+        # a template is relocated as it is, no conversion to a VM
+        if vm['template']:
+            print("VM is a template")
+        stats.start(vm, telemetry.source_label(vm, disks), destination_name, relocation.moved_bytes(vm, disks))
+        return vm_obj.Relocate(spec=relocation.relocate_spec(vm, destination_ds, disks, move_home, provision))
+    def done(job, error):
+        stats.finish(vm, error)
+    return {'name': vm['name'], 'vm': vm, 'steps': [start], 'done': done}
 
 def main():
     args = GetArgs()
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
     if not args.datastore:
         print("-d/--datastore is required!")
         return
+    if args.per_disk and not args.sourecedatastore:
+        print("--per-disk needs -s/--sourceDatastore!")
+        return 1
 
     vcenter_server = args.host
     username = args.user
@@ -91,109 +131,129 @@ def main():
     elif powerstate == 'off':
         src_state = 'poweredOff'
 
-    si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
-    vm_list = []
-    datacenters = si.content.rootFolder.childEntity
-    for datacenter in datacenters:
-        if verbose: print("Datacenter: " + datacenter.name)
-
-        # Search for Destination Datastore
-        found_ds = False
-        destination_ds = []
-        source_dc = None
-        for ds in datacenter.datastoreFolder.childEntity:
-            obj_type = type(ds).__name__
-            if obj_type == 'vim.Datastore':
-                if ds.name == dest_datastore:
-                    if verbose: print("Found destination datastore: " + ds.name)
-                    found_ds = True
-                    destination_ds = ds
-                    source_dc = datacenter
-        if found_ds == False:
-            print("Destination datastore not found")
-            exit()
-
-        # List VMs
-        vm_view = si.content.viewManager.CreateContainerView(datacenter, [pyVmomi.vim.VirtualMachine], True)
-        vms_list = vm_view.view
-        vm_view.Destroy()
+    vm_properties = inventory.VM_BASE_PROPERTIES + inventory.VM_DEVICE_PROPERTIES + inventory.VM_STORAGE_PROPERTIES
+    if args.per_disk:
+        vm_properties = vm_properties + inventory.VM_HOME_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(vcenter_server, username, password, verbose)
+    else:
+        si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    sources = None
+    if args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    elif args.sourecedatastore:
+        # only the VMs with files on the source datastores (Datastore.vm)
+        inv = inventory.load_entities(si)
+        sources = placement.resolve_datastores(inv, args.sourecedatastore, "Source")
+        inventory.load_datastore_vms(si, inv, sources, vm_properties)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    destinations = placement.resolve_destinations(inv, dest_datastore)
+    if not destinations:
+        print("Destination datastore not found")
+        return 1
+    if args.sourecedatastore:
+        if sources is None:
+            sources = placement.resolve_datastores(inv, args.sourecedatastore, "Source")
+        if not sources:
+            return 1
+        sources = set(sources)
+    # only the datacenters holding a destination datastore are scanned
+    dest_datacenters = placement.destinations_by_datacenter(inv, destinations)
+    for moid, entity in inv['entities'].items():
+        if entity['type'] == 'Datacenter' and moid not in dest_datacenters:
+            if verbose: print("Datacenter: " + entity['name'] + " (no destination datastore, skipped)")
+    destinations = set(destinations)
+    failed = []
+    # per datacenter the list of (vm, destination moId) placed there
+    planned = []
+    # --per-disk: VM moId -> (keys of the disks to move, move the VM home)
+    moves = {}
+    def vm_disks(vm):
+        return moves.get(vm['moid'], (None, True))[0]
+    def moved_bytes(vm):
+        return relocation.moved_bytes(vm, vm_disks(vm))
+    def destination_bytes(vm):
+        return relocation.destination_bytes(vm, vm_disks(vm), args.provisionType)
+    for dc_moid, dc_destinations in dest_datacenters.items():
+        soap_profile.set_phase('filter')
+        datacenter = pyVmomi.vim.Datacenter(dc_moid, si._stub)
+        if verbose: print("Datacenter: " + inv['entities'][dc_moid]['name'])
+
+        # Destination Datastores in this Datacenter
+        for moid in dc_destinations:
+            if verbose: print("Found destination datastore: " + inv['datastores'][moid]['name'])
 
         # Loop through VMs
-        for vm in vms_list:
-            if verbose: print("VM: " + vm.name)
+        vm_to_migrate = []
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if verbose: print("VM: " + vm['name'])
             is_on_dest_ds = False
             if args.sourecedatastore:
                 is_on_src_ds = False
             else:
                 is_on_src_ds = True
-            for device in vm.config.hardware.device:
-                if isinstance(device, pyVmomi.vim.vm.device.VirtualDisk):
-                    if device.backing.datastore.name == args.datastore:
-                        is_on_dest_ds = True
-                        if verbose: print("  Found on DEST Datastore " + args.datastore + ": "+ vm.name)
-                    if args.sourecedatastore and device.backing.datastore.name == args.sourecedatastore:
-                        is_on_src_ds = True
-                        if verbose: print("  Found on SOURCE Datastore " + args.sourecedatastore + ": "+ vm.name)
-            if not is_on_dest_ds and is_on_src_ds:
-                if vm.runtime.powerState == src_state:
-                    if verbose: print("VM is $vm.runtime.powerState")
-                    if verbose: print("Folder name: " + vm.parent.name)
-                    if not args.folder or (args.folder and re.search(args.folder,vm.parent.name+"/"+vm.parent.parent.name ,re.IGNORECASE)):
-                        if not args.vm or (args.vm and re.search(args.vm, vm.name,re.IGNORECASE)):
-                            if args.exclude and (args.exclude and re.search(args.exclude, vm.name,re.IGNORECASE )):
-                                print("NOT Migrating VM: (excluded)" + vm.name)
-                            else:
-                                total_bytes = 0
-                                for device in vm.config.hardware.device:
-                                    if isinstance(device, pyVmomi.vim.vm.device.VirtualDisk):
-                                        if getattr(device, "capacityInBytes", None) is not None:
-                                            total_bytes += device.capacityInBytes
-                                        elif getattr(device, "capacityInKB", None) is not None:
-                                            total_bytes += device.capacityInKB * 1024
-                                total_mb = total_bytes / (1024 * 1024) if total_bytes else 0
-                                total_gb = total_bytes / (1024 * 1024 * 1024) if total_bytes else 0
-                                if total_gb >= 1:
-                                    size_str = "%.2f GB" % total_gb
-                                else:
-                                    size_str = "%.2f MB" % total_mb
-                                print("Migrating VM: " + vm.name + " (%s)" % size_str)
-                                if not args.dryrun:
-                                    # Check if the VM is a template
-                                    convert_back = False
-                                    if vm.config.template:
-                                        print("VM is a template! Convert to VM first")
-                                        convert_to_vm(vm,source_dc)
-                                        convert_back = True
-
-                                    start_ts = time.time()
-                                    t1 = vm.Relocate(spec=pyVmomi.vim.vm.RelocateSpec(datastore=destination_ds))
-                                    task.WaitForTask(t1)
-                                    duration_sec = max(time.time() - start_ts, 0.001)
-                                    hours = duration_sec / 3600.0
-                                    mb_per_hour = (total_mb / hours) if hours > 0 else 0
-                                    if mb_per_hour >= 1024:
-                                        rate_str = "%.2f GB/h" % (mb_per_hour / 1024.0)
-                                    else:
-                                        rate_str = "%.2f MB/h" % mb_per_hour
-                                    print("VM migrated (Durchsatz: %s)" % rate_str)
-
-                                    if mb_per_hour > 0:
-                                        tb_mb = 1024 * 1024
-                                        hours_for_tb = tb_mb / mb_per_hour
-                                        total_seconds = int(hours_for_tb * 3600)
-                                        h = total_seconds // 3600
-                                        m = (total_seconds % 3600) // 60
-                                        s = total_seconds % 60
-                                        print("Geschätzte Dauer für 1 TB bei diesem Durchsatz: %02d:%02d:%02d (hh:mm:ss)" % (h, m, s))
-
-                                    if convert_back:
-                                        print("Converting back to template")
-                                        convert_to_template(vm,source_dc)
-                                else:
-                                    print("Dryrun: VM not migrated")
+            for disk in vm['disks']:
+                if disk['datastore'] in destinations:
+                    is_on_dest_ds = True
+                    if verbose: print("  Found on DEST Datastore " + disk['datastoreName'] + ": "+ vm['name'])
+                if sources and disk['datastore'] in sources:
+                    is_on_src_ds = True
+                    if verbose: print("  Found on SOURCE Datastore " + disk['datastoreName'] + ": "+ vm['name'])
+            # with --per-disk the disks on the destination just stay there
+            if (args.per_disk or not is_on_dest_ds) and is_on_src_ds:
+                if vm['powerState'] == src_state:
+                    if verbose: print("VM is " + vm['powerState'])
+                    if verbose: print("Folder name: " + vm['folder'])
+                    if vm_filters.matches(vm):
+                        if vm_filters.excluded(vm):
+                            print("NOT Migrating VM: (excluded)" + vm['name'])
+                        else:
+                            vm_to_migrate.append(vm)
+                            if args.per_disk:
+                                moves[vm['moid']] = relocation.plan_disks(vm, sources, args.keep_home)
+
+        # Distribute the VMs over the destination datastores before starting any task
+        soap_profile.set_phase('plan')
+        placed, unplaced = placement.plan_placement(inv, vm_to_migrate, dc_destinations, args.headroom,
+                                                    destination_bytes)
+        placement.print_plan(inv, placed, unplaced, args.headroom, destination_bytes)
+        if placed:
+            provisioned = sum(relocation.provisioned_bytes(vm, vm_disks(vm)) for vm, moid in placed)
+            needed = sum(destination_bytes(vm) for vm, moid in placed)
+            print("  Total: %d VMs, committed %s (copied), provisioned %s, %s on destination (%s saved)" % (
+                len(placed), size_str(sum(moved_bytes(vm) for vm, moid in placed)), size_str(provisioned),
+                size_str(needed), size_str(max(provisioned - needed, 0))))
+        planned.append(placed)
+    # one telemetry for the VMs of all datacenters
+    stats = telemetry.MigrationTelemetry(sum(moved_bytes(vm) for placed in planned for vm, moid in placed),
+                                         args.stats, args.prometheus)
+    for placed in planned:
+        jobs = []
+        for vm, moid in placed:
+            destination_name = inv['datastores'][moid]['name']
+            if not args.dryrun:
+                disks, move_home = moves.get(vm['moid'], (None, True))
+                jobs.append(migrate_job(vm, pyVmomi.vim.Datastore(moid, si._stub), destination_name, stats,
+                                        disks, move_home, args.provisionType))
+            else:
+                print("Migrating VM: " + vm['name'] + " (%s) to %s" % (
+                    sizes_str(vm, vm_disks(vm), args.provisionType), destination_name))
+                print("Dryrun: VM not migrated")
+        # one migration after the other
+        soap_profile.set_phase('execute')
+        failed += tasks.run_jobs(si, jobs, 1, verbose, on_progress=lambda job, percent: stats.progress(job['vm'], percent))
         #break
-    Disconnect(si)
+    if any(planned) and not args.dryrun:
+        stats.print_summary()
+    soap_profile.report()
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-   main()
\ No newline at end of file
+   sys.exit(main())
\ No newline at end of file
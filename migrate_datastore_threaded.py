@@ -1,28 +1,39 @@
 #! /usr/bin/env python3
 
 import argparse
-import threading
+import sys
 import time
-import re
 
 # import the vSphere Python SDK needed modules
 import pyVmomi
+from pyVmomi import vmodl
 from pyVim.connect import SmartConnect, Disconnect
-from pyVim import task
+
+import fleet
+import inventory
+import inventory_cache
+import journal
+import placement
+import relocation
+import sessions
+import soap_profile
+import tasks
+import telemetry
+import vm_filter
 
 def GetArgs():
    parser = argparse.ArgumentParser(
        description="This is tool to migrate virtual machine to adatastore")
    parser.add_argument('-S', '--vcHost', dest='host', action='store',
-                       help='VC host to connect. (Required)')
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
    parser.add_argument('-u', '--user', default='administrator@vsphere.local',
                        help='User name of vc host. (Default: \'administrator@vsphere.local\')')
    parser.add_argument('-p', '--password', default='Admin!23',
                        help='Password of vc host.')
    parser.add_argument('-s', '--sourceDatastore', dest='sourecedatastore',
-                       help="Specify the source datastore.")
+                       help="Specify the source datastore(s): comma separated datastore and/or datastore cluster names, URLs or moIds. Sample: --sourceDatastore ds1")
    parser.add_argument('-d', '--ds', dest='datastore',
-                       help="Specify the destination datastore.")
+                       help="Specify the destination datastore(s): comma separated datastore and/or datastore cluster names, URLs or moIds. Sample: --ds ds1,ds2")
    parser.add_argument('-k', '--vm', dest='vm',
                        help="Specify the VM names need to be relocated. (Regular Expression, Case insensitiv). Sample: --vm vmxxx")
    parser.add_argument('-f', '--folder', dest='folder',
@@ -33,68 +44,259 @@ def GetArgs():
                        help="verbose\nSample: --debug 1")
    parser.add_argument('-x', '--exclude', dest='exclude', 
                        help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
    parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
                        help="dry-run\nSample: --dryrun")
    parser.add_argument('-P', '--powerstate', dest='powerstate', default='on',
                        help="powerstate\nSample: --powerstate on|off default: on")
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
+   parser.add_argument('--sessions', dest='sessions', default=sessions.POOL_SIZE, type=int,
+                       help="number of HTTP connections the worker threads share on the vCenter session (default: %d)\nSample: --sessions 8" % sessions.POOL_SIZE)
+   parser.add_argument('--max-per-source', dest='max_per_source', default=0, type=int,
+                       help="max. concurrent migrations per source datastore (0 = no limit)\nSample: --max-per-source 2")
+   parser.add_argument('--max-per-dest', dest='max_per_dest', default=0, type=int,
+                       help="max. concurrent migrations per destination datastore (0 = no limit)\nSample: --max-per-dest 4")
+   parser.add_argument('--max-per-host', dest='max_per_host', default=0, type=int,
+                       help="max. concurrent migrations per ESXi host (0 = no limit, vSphere runs 2 Storage vMotions per host)\nSample: --max-per-host 2")
+   parser.add_argument('--headroom', dest='headroom', default=10, type=float,
+                       help="percent of each destination datastore's capacity to keep free (default: 10)\nSample: --headroom 15")
+   parser.add_argument('--stats', dest='stats',
+                       help="append per VM migration statistics (bytes, duration, throughput) to this JSONL file\nSample: --stats migrations.jsonl")
+   parser.add_argument('--prometheus', dest='prometheus',
+                       help="write throughput and ETA metrics to this Prometheus textfile\nSample: --prometheus /var/lib/node_exporter/migration.prom")
+   parser.add_argument('--order', dest='order', default='none', choices=('none', 'largest', 'smallest'),
+                       help="order of the migrations by disk size: largest first, smallest first (shortest job first) or as found\nSample: --order largest")
+   parser.add_argument('--per-disk', dest='per_disk', default=False, action="store_true",
+                       help="only move the disks on the source datastore (-s) and the VM home if it is there, the other disks stay\nSample: --per-disk")
+   parser.add_argument('--keep-home', dest='keep_home', default=False, action="store_true",
+                       help="with --per-disk: leave the VM home (configuration files) where it is\nSample: --keep-home")
+   parser.add_argument('--journal', dest='journal',
+                       help="journal file of the planned VMs and their state (default: ~/.cache/managevms/<vcHost>.journal)\nSample: --journal migration.journal")
+   parser.add_argument('--resume', dest='resume', default=False, action="store_true",
+                       help="continue an interrupted run from its journal: reattach to running tasks, migrate the rest, no inventory scan\nSample: --resume")
 
-#   parser.add_argument('-P', '--provisionType', dest='provisionType', default='thick',
-#                       help='Virtual disk provision type, supports: thin, thick; if omitted, thick will be taken',)
+   parser.add_argument('--provisionType', dest='provisionType', choices=('thin', 'thick'),
+                       help="convert the moved disks to thin or (lazy zeroed) thick provisioning; if omitted, the disks keep their format\nSample: --provisionType thin")
+   parser.add_argument('--stream', dest='stream', default=False, action="store_true",
+                       help="start migrating while the inventory is scanned: every VM is placed and queued as soon as the scan finds it\nSample: --stream")
+   parser.add_argument('--queue', dest='queue', default=0, type=int,
+                       help="with --stream: number of VMs waiting for a free thread before the scan pauses (0 = 2 * --threads)\nSample: --queue 16")
    args = parser.parse_args()
    #if args.action not in ('relocate_vm'\
    #   'listVMs') or not args.host:
    #   parser.print_help()
    return args
 
-def GetResourcePools(entity):
-   pools = []
-   for pool in entity.resourcePool:
-      pools += GetResourcePools(pool)
-   pools.append(entity)
-   return pools
+def relocate_vm(vm, destination_ds, verbose, disks=None, move_home=True, provision=None):
+    # vm is an inventory record, vm['obj'] the VirtualMachine
+    # disks: keys of the disks to move (None: the whole VM), provision: 'thin', 'thick' or None (keep the format)
+    vm_obj = vm['obj']
+    if disks is None:
+        print("  Migrate VM: " + vm['name'] + " (start task)")
+    else:
+        print("  Migrate VM: " + vm['name'] + " (start task, " + str(len(disks)) + " disks" + (" and VM home" if move_home else "") + ")")
+    # a template is relocated as it is, no conversion to a VM
+    if verbose and vm['template']: print("    VM is a template")
+    return vm_obj.Relocate(spec=relocation.relocate_spec(vm, destination_ds, disks, move_home, provision))
 
+def reattach_vm(vm, destination_ds, destination_name, running_task, verbose, disks=None, move_home=True, provision=None):
+    # VM of an interrupted run: running_task is its task (None if it was still queued);
+    # vCenter drops finished tasks after a while
+    if running_task is not None:
+        try:
+            running_task.info.state
+            print("  Migrate VM: " + vm['name'] + " (reattach to " + running_task._moId + ")")
+            return running_task
+        except vmodl.fault.ManagedObjectNotFound:
+            pass
+    if relocation.is_relocated(vm['obj'], destination_name, disks, move_home):
+        print("  Migrate VM: " + vm['name'] + " (already on the destination)")
+        return None
+    return relocate_vm(vm, destination_ds, verbose, disks, move_home, provision)
 
-def convert_to_template(vm,dc):
-    if vm.config.template:
-        print("    VM is already a template")
-    else:
-        print("    Converting to template")
-        vm.MarkAsTemplate()
-
-def convert_to_vm(vm,dc):
-    if vm.config.template:
-        print("    Converting to VM")
-        pools = GetResourcePools(dc.hostFolder.childEntity[0].resourcePool)
-        if len(pools) == 0:
-            print("No resource pool found")
-            return
-        vm.MarkAsVirtualMachine(pool=pools[0])
-        time.sleep(5)
+def relocate_job(vm, destination_ds, destination_name, stats, verbose, run_journal=None, running_task=None,
+                 disks=None, move_home=True, provision=None, resumed=False):
+    # job for tasks.run_jobs(), occupying the VM's datastores and host
+    # resumed: VM of an interrupted run, it may have been relocated already
+    resources = [('dst', destination_ds._moId)]
+    for disk in vm['disks']:
+        if disks is None or disk['key'] in disks:
+            resources.append(('src', disk['datastore']))
+    if vm['host']:
+        resources.append(('host', vm['host']))
+    def start():
+        stats.start(vm, telemetry.source_label(vm, disks), destination_name, relocation.moved_bytes(vm, disks))
+        if running_task is not None or resumed:
+            t = reattach_vm(vm, destination_ds, destination_name, running_task, verbose, disks, move_home, provision)
+        else:
+            t = relocate_vm(vm, destination_ds, verbose, disks, move_home, provision)
+        if run_journal and t is not None:
+            run_journal.update(vm['moid'], state=journal.RUNNING, task=t._moId)
+        return t
+    def done(job, error):
+        stats.finish(vm, error)
+        if run_journal:
+            if error is None:
+                run_journal.update(vm['moid'], state=journal.DONE)
+            else:
+                run_journal.update(vm['moid'], state=journal.FAILED, error=tasks.error_message(error))
+    return {'name': vm['name'], 'vm': vm, 'resources': resources, 'steps': [start], 'done': done}
+
+def run_migrations(si, args, jobs, stats, stream=False):
+    # Migrate VMs, a slot is refilled as soon as one of the tasks finishes
+    # (stream: jobs is an iterator that scans while the first VMs are migrated)
+    limits = {'src': args.max_per_source, 'dst': args.max_per_dest, 'host': args.max_per_host}
+    on_progress = lambda job, percent: stats.progress(job['vm'], percent)
+    if stream:
+        failed = tasks.run_job_stream(si, jobs, args.threads, args.verbose, limits, on_progress, args.queue or None)
     else:
-        print("VM is already a VM")
-
-def relocate_vm(vm, destination_ds, source_dc, verbose):
-    # Check if the VM is a template
-    convert_back = False
-    if vm.config.template:
-        print("    VM is a template! Convert to VM first")
-        convert_to_vm(vm=vm,dc=source_dc)
-        convert_back = True
-    t1 = vm.Relocate(spec=pyVmomi.vim.vm.RelocateSpec(datastore=destination_ds))
-    task.WaitForTask(t1)
+        failed = tasks.run_jobs(si, jobs, args.threads, args.verbose, limits, on_progress=on_progress)
     print("")
-    print("    VM migrated:" + vm.name)
+    print("All migrations FINISHED, failed: " + str(len(failed)))
+    stats.print_summary()
+    return failed
+
+def resume(si, args, journal_file):
+    # continue the run recorded in the journal without scanning the inventory
+    run_journal = journal.MigrationJournal.load(journal_file)
+    if run_journal is None:
+        print("No journal found: " + journal_file)
+        return None
+    pending = run_journal.pending()
+    print("Resuming run of " + run_journal.data['created'] + ": " + str(len(pending)) + " of "
+          + str(len(run_journal.entries())) + " VMs left")
+    if args.dryrun:
+        for entry in pending:
+            print("Dryrun: VM " + entry['vm']['name'] + " to " + entry['destinationName'] + " (" + entry['state'] + ")")
+        return []
+    stats = telemetry.MigrationTelemetry(sum(relocation.moved_bytes(entry['vm'], entry.get('disks')) for entry in pending),
+                                         args.stats, args.prometheus)
+    jobs = []
+    for entry in pending:
+        vm = dict(entry['vm'], obj=pyVmomi.vim.VirtualMachine(entry['vm']['moid'], si._stub))
+        destination_ds = pyVmomi.vim.Datastore(entry['destination'], si._stub)
+        running_task = None
+        if entry['state'] == journal.RUNNING and entry['task']:
+            running_task = pyVmomi.vim.Task(entry['task'], si._stub)
+        jobs.append(relocate_job(vm, destination_ds, entry['destinationName'], stats, args.verbose,
+                                 run_journal, running_task, entry.get('disks'), entry.get('moveHome', True),
+                                 run_journal.data.get('provisionType'), resumed=True))
+    return run_migrations(si, args, jobs, stats)
+
+def select_vm(vm, args, vm_filters, sources, destinations, src_state):
+    # the VM has a disk on a source datastore (or no -s), is not on a destination,
+    # has the powerstate and passes the filters
+    verbose = args.verbose
+    if verbose: print("VM: " + vm['name'])
+    is_on_dest_ds = False
+    if args.sourecedatastore:
+        is_on_src_ds = False
+    else:
+        is_on_src_ds = True
+    for disk in vm['disks']:
+        if disk['datastore'] in destinations:
+            is_on_dest_ds = True
+            if verbose: print("  Found on DEST Datastore " + disk['datastoreName'] + ": "+ vm['name'])
+        if sources and disk['datastore'] in sources:
+            is_on_src_ds = True
+            if verbose: print("  Found on SOURCE Datastore " + disk['datastoreName'] + ": "+ vm['name'])
+    # with --per-disk the disks on the destination just stay there
+    if (args.per_disk or not is_on_dest_ds) and is_on_src_ds:
+        if vm['powerState'] == src_state:
+            if verbose: print("VM is " + vm['powerState'])
+            if verbose: print("Folder name: " + vm['folder'])
+            if vm_filters.matches(vm):
+                if vm_filters.excluded(vm):
+                    print(" NOT Migrating VM: "+ vm['name'] + " (excluded)")
+                else:
+                    print("WILL Migrating VM: " + vm['name'])
+                    return True
+    return False
+
+def stream_jobs(si, args, inv, vm_properties, sources, destinations, dest_datacenters, vm_filters, src_state,
+                stats, run_journal):
+    # relocation jobs in the order the scan finds the VMs; each VM is placed on
+    # the destination with the most space left when it is found
+    free = placement.free_space(inv, destinations, args.headroom)
+    for vm in inventory.iter_vms(si, inv, vm_properties, sources):
+        if vm['datacenter'] not in dest_datacenters:
+            continue
+        if not select_vm(vm, args, vm_filters, sources, destinations, src_state):
+            continue
+        disks, move_home = None, True
+        if args.per_disk:
+            disks, move_home = relocation.plan_disks(vm, sources, args.keep_home)
+        size = relocation.destination_bytes(vm, disks, args.provisionType)
+        moid = placement.place(free, dest_datacenters[vm['datacenter']], size)
+        if moid is None:
+            print("  NOT Migrating VM: " + vm['name'] + " (%.2f GB, does not fit on any destination)" % (size / (1024.0 ** 3)))
+            continue
+        destination_name = inv['datastores'][moid]['name']
+        if args.verbose: print("  Destination: " + destination_name)
+        if run_journal:
+            run_journal.add(vm, vm['datacenter'], moid, destination_name, disks, move_home)
+        stats.add(relocation.moved_bytes(vm, disks))
+        yield relocate_job(vm, pyVmomi.vim.Datastore(moid, si._stub), destination_name, stats, args.verbose,
+                           run_journal, disks=disks, move_home=move_home, provision=args.provisionType)
 
-    if convert_back:
-        print("    Converting back to template")
-        convert_to_template(vm=vm,dc=source_dc)
-    return
+def check_journal(journal_file):
+    old_journal = journal.MigrationJournal.load(journal_file)
+    if old_journal and old_journal.pending():
+        print("Replacing journal with " + str(len(old_journal.pending())) + " unfinished VMs (use --resume to continue it): " + journal_file)
+
+def stream_migrations(si, args, inv, vm_properties, sources, destinations, dest_datacenters, vm_filters, src_state,
+                      journal_file):
+    # --stream: the first VMs are migrated while the scan still runs, no plan of the whole run first
+    soap_profile.set_phase('execute')
+    stats = telemetry.MigrationTelemetry(0, args.stats, args.prometheus)
+    run_journal = None
+    if not args.dryrun:
+        check_journal(journal_file)
+        run_journal = journal.MigrationJournal.create(journal_file, args.host, [], args.provisionType)
+    jobs = stream_jobs(si, args, inv, vm_properties, sources, destinations, dest_datacenters, vm_filters, src_state,
+                       stats, run_journal)
+    if args.dryrun:
+        for job in jobs:
+            pass
+        print("Dryrun: Not migrating VMs")
+        return []
+    return run_migrations(si, args, jobs, stats, stream=True)
+
+def order_vms(planned, order, size):
+    # largest first keeps big VMs from running alone at the end of a run,
+    # smallest first finishes the most VMs per hour; planned holds the VMs of
+    # all datacenters (one queue), size(vm) is the number of bytes to move
+    if order == 'largest':
+        return sorted(planned, key=lambda item: size(item[0]), reverse=True)
+    if order == 'smallest':
+        return sorted(planned, key=lambda item: size(item[0]))
+    return planned
 
 def main():
     args = GetArgs()
-    if not args.datastore:
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
+    if not args.datastore and not args.resume:
         print("-d/--datastore is required!")
         return
+    if args.per_disk and not args.sourecedatastore and not args.resume:
+        print("--per-disk needs -s/--sourceDatastore!")
+        return 1
+    if args.stream and args.order != 'none':
+        print("--order needs the whole inventory, it cannot be used with --stream")
+        return 1
 
     vcenter_server = args.host
     username = args.user
@@ -113,105 +315,136 @@ def main():
     elif powerstate == 'off':
         src_state = 'poweredOff'
 
-    si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
-    vm_list = []
-    datacenters = si.content.rootFolder.childEntity
-    source_dc = None
-    for datacenter in datacenters:
-        if verbose: print("Datacenter: " + datacenter.name)
-
-        # Search for Destination Datastore
-        found_ds = False
-        destination_ds = []
-        for ds in datacenter.datastoreFolder.childEntity:
-            obj_type = type(ds).__name__
-            if obj_type == 'vim.Datastore':
-                if ds.name == dest_datastore:
-                    if verbose: print("Found destination datastore: " + ds.name)
-                    found_ds = True
-                    destination_ds = ds
-                    source_dc = datacenter
-        if found_ds == False:
-            print("Destination datastore not found")
-            exit()
-
-        # List VMs
-        vm_view = si.content.viewManager.CreateContainerView(datacenter, [pyVmomi.vim.VirtualMachine], True)
-        vms_list = vm_view.view
-        vm_view.Destroy()
-
-        threads = []
+    journal_file = args.journal or journal.journal_path(vcenter_server)
+    if args.resume:
+        if args.cache:
+            si = inventory_cache.connect(vcenter_server, username, password, verbose)
+        else:
+            si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
+        si = sessions.pool(si, vcenter_server, username, password, args.sessions)
+        soap_profile.attach(si)
+        soap_profile.set_phase('execute')
+        failed = resume(si, args, journal_file)
+        soap_profile.report()
+        if not args.cache:
+            Disconnect(si)
+        # None: no journal to resume
+        return 1 if failed is None or failed else 0
+
+    vm_properties = inventory.VM_BASE_PROPERTIES + inventory.VM_DEVICE_PROPERTIES + inventory.VM_HOST_PROPERTIES \
+        + inventory.VM_STORAGE_PROPERTIES
+    if args.per_disk:
+        vm_properties = vm_properties + inventory.VM_HOME_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(vcenter_server, username, password, verbose)
+    else:
+        si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
+    si = sessions.pool(si, vcenter_server, username, password, args.sessions)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    sources = None
+    if args.stream:
+        # the VMs are scanned page by page while the first ones are migrated, without the cache
+        inv = inventory.load_entities(si)
+    elif args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    elif args.sourecedatastore:
+        # only the VMs with files on the source datastores (Datastore.vm)
+        inv = inventory.load_entities(si)
+        sources = placement.resolve_datastores(inv, args.sourecedatastore, "Source")
+        inventory.load_datastore_vms(si, inv, sources, vm_properties)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    destinations = placement.resolve_destinations(inv, dest_datastore)
+    if not destinations:
+        print("Destination datastore not found")
+        return 1
+    if args.sourecedatastore:
+        if sources is None:
+            sources = placement.resolve_datastores(inv, args.sourecedatastore, "Source")
+        if not sources:
+            return 1
+        sources = set(sources)
+    # only the datacenters holding a destination datastore are scanned
+    dest_datacenters = placement.destinations_by_datacenter(inv, destinations)
+    for moid, entity in inv['entities'].items():
+        if entity['type'] == 'Datacenter' and moid not in dest_datacenters:
+            if verbose: print("Datacenter: " + entity['name'] + " (no destination datastore, skipped)")
+    destinations = set(destinations)
+    if args.stream:
+        failed = stream_migrations(si, args, inv, vm_properties, sources, destinations, dest_datacenters, vm_filters,
+                                   src_state, journal_file)
+        soap_profile.report()
+        if not args.cache:
+            Disconnect(si)
+        return 1 if failed else 0
+    # (vm, datacenter, destination datastore moId) of all datacenters
+    planned = []
+    # --per-disk: VM moId -> (keys of the disks to move, move the VM home)
+    moves = {}
+    def vm_disks(vm):
+        return moves.get(vm['moid'], (None, True))[0]
+    def moved_bytes(vm):
+        return relocation.moved_bytes(vm, vm_disks(vm))
+    def destination_bytes(vm):
+        return relocation.destination_bytes(vm, vm_disks(vm), args.provisionType)
+    for dc_moid, dc_destinations in dest_datacenters.items():
+        soap_profile.set_phase('filter')
+        datacenter = pyVmomi.vim.Datacenter(dc_moid, si._stub)
+        if verbose: print("Datacenter: " + inv['entities'][dc_moid]['name'])
+
+        # Destination Datastores in this Datacenter
+        for moid in dc_destinations:
+            if verbose: print("Found destination datastore: " + inv['datastores'][moid]['name'])
+
         # Loop through VMs
         vm_to_migrate = []
-        for vm in vms_list:
-            if verbose: print("VM: " + vm.name)
-            is_on_dest_ds = False
-            if args.sourecedatastore:
-                is_on_src_ds = False
-            else:
-                is_on_src_ds = True
-            for device in vm.config.hardware.device:
-                if isinstance(device, pyVmomi.vim.vm.device.VirtualDisk):
-                    if device.backing.datastore.name == args.datastore:
-                        is_on_dest_ds = True
-                        if verbose: print("  Found on DEST Datastore " + args.datastore + ": "+ vm.name)
-                    if args.sourecedatastore and device.backing.datastore.name == args.sourecedatastore:
-                        is_on_src_ds = True
-                        if verbose: print("  Found on SOURCE Datastore " + args.sourecedatastore + ": "+ vm.name)
-            if not is_on_dest_ds and is_on_src_ds:
-                if vm.runtime.powerState == src_state:
-                    if verbose: print("VM is $vm.runtime.powerState")
-                    if verbose: print("Folder name: " + vm.parent.name)
-                    if not args.folder or (args.folder and re.search(args.folder,vm.parent.name+"/"+vm.parent.parent.name ,re.IGNORECASE)):
-                        if not args.vm or (args.vm and re.search(args.vm, vm.name,re.IGNORECASE)):
-                            if args.exclude and (args.exclude and re.search(args.exclude, vm.name,re.IGNORECASE )):
-                                print(" NOT Migrating VM: "+ vm.name + " (excluded)")
-                            else:
-                                print("WILL Migrating VM: " + vm.name)
-                                vm_to_migrate.append(vm)
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if select_vm(vm, args, vm_filters, sources, destinations, src_state):
+                vm_to_migrate.append(vm)
+                if args.per_disk:
+                    moves[vm['moid']] = relocation.plan_disks(vm, sources, args.keep_home)
 
+        # Distribute the VMs over the destination datastores before starting any task
+        soap_profile.set_phase('plan')
+        placed, unplaced = placement.plan_placement(inv, vm_to_migrate, dc_destinations, args.headroom,
+                                                    destination_bytes)
         print("")
-        print("Number of VMs to migrate: " + str(len(vm_to_migrate)))
+        print("Number of VMs to migrate: " + str(len(placed)))
+        placement.print_plan(inv, placed, unplaced, args.headroom, destination_bytes)
         print("")
+        for vm, moid in placed:
+            planned.append((vm, datacenter, moid))
+    # the VMs of all datacenters share one queue, order it as a whole
+    planned = order_vms(planned, args.order, moved_bytes)
 
-        if not args.dryrun:
-            print("Sleep 5 seconds before migrating VMs")
-            time.sleep(5)
-            # Migrate VMs
-            threads = []
-            for vm in vm_to_migrate:
-                    # print the number of current threads
-                    if verbose: print("Current Number of my threads: " + str(len(threads)))
-                    if len(threads) >= args.threads: 
-                        if verbose: print("Waiting for a thread to finish (" + str(len(threads)) + "/" + str(args.threads) + ")")
-                    # print all running threads
-                    print("    Running threads: ", end='', flush=True)
-                    for t in threads:
-                        print(" "+ str(t.name),end='', flush=True)
-                    print("")
-                    while len(threads) >= args.threads:
-                        # wait for a thread to finish
-                        print(".", end='', flush=True)
-                        time.sleep(30)
-                        for t in threads:
-                            if not t.is_alive():
-                                threads.remove(t)
-                                break
-                    print("  Migrate VM: " + vm.name + " (start task)")
-                    t = threading.Thread(target=relocate_vm, args=(vm, destination_ds, source_dc, verbose), name=vm.name)
-                    threads.append(t)
-                    t.start()
-            
-            # wait for threads to finish
-            print("")
-            print("Waiting for all threads to FINISH")
-            for t in threads:
-                t.join()
-        else:
-            print("Dryrun: Not migrating VMs")
+    if not args.dryrun:
+        check_journal(journal_file)
+        print("Sleep 5 seconds before migrating VMs")
+        time.sleep(5)
+        run_journal = journal.MigrationJournal.create(journal_file, vcenter_server, [
+            (vm, datacenter._moId, moid, inv['datastores'][moid]['name']) + moves.get(vm['moid'], (None, True))
+            for vm, datacenter, moid in planned], args.provisionType)
+        stats = telemetry.MigrationTelemetry(sum(moved_bytes(vm) for vm, datacenter, moid in planned),
+                                             args.stats, args.prometheus)
+        jobs = []
+        for vm, datacenter, moid in planned:
+            destination_ds = pyVmomi.vim.Datastore(moid, si._stub)
+            disks, move_home = moves.get(vm['moid'], (None, True))
+            jobs.append(relocate_job(vm, destination_ds, inv['datastores'][moid]['name'], stats, verbose,
+                                     run_journal, disks=disks, move_home=move_home, provision=args.provisionType))
+        soap_profile.set_phase('execute')
+        failed = run_migrations(si, args, jobs, stats)
+    else:
+        print("Dryrun: Not migrating VMs")
+        failed = []
+    soap_profile.report()
 
-    Disconnect(si)
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-   main()
\ No newline at end of file
+   sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,305 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+
+# import the vSphere Python SDK needed modules
+import pyVmomi
+from pyVim.connect import SmartConnect, Disconnect
+
+import fleet
+import inventory
+import inventory_cache
+import placement
+import relocation
+import rename_plan
+import snapshot_plan
+import soap_profile
+import tasks
+import telemetry
+import vm_filter
+
+# the stages reuse the jobs of the single scripts
+import migrate_datastore_threaded
+import remove_iso
+import remove_snapshots
+import rename_vms
+
+def GetArgs():
+   parser = argparse.ArgumentParser(
+       description="Tool to run several actions on the same VMs with one inventory scan: remove ISOs, remove snapshots, relocate and rename, in this order")
+   parser.add_argument('-S', '--vcHost', dest='host', action='store',
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
+   parser.add_argument('-u', '--user', default='administrator@vsphere.local',
+                       help='User name of vc host. (Default: \'administrator@vsphere.local\')')
+   parser.add_argument('-p', '--password', default='Admin!23',
+                       help='Password of vc host.')
+   parser.add_argument('-s', '--sourceDatastore', dest='sourecedatastore',
+                       help="only VMs with a disk or an ISO on these datastores (comma separated datastore and/or datastore cluster names, URLs or moIds); --remove-iso removes only the ISOs on them\nSample: --sourceDatastore LUN17")
+   parser.add_argument('-k', '--vm', dest='vm',
+                       help="Specify the VM names. (Regular Expression, Case insensitive). Sample: --vm vmxxx")
+   parser.add_argument('-f', '--folder', dest='folder',
+                       help="Specify the Folder name. (Regular Expression, Case insensitive). Sample: --folder kunde1")
+   parser.add_argument('-x', '--exclude', dest='exclude',
+                       help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
+   parser.add_argument('-P', '--powerstate', dest='powerstate', default='all', choices=('on', 'off', 'all'),
+                       help="powerstate\nSample: --powerstate on|off|all default: all")
+   # stage 1: ISOs
+   parser.add_argument('--remove-iso', dest='remove_iso', default=False, action="store_true",
+                       help="remove the ISOs of the VMs\nSample: --remove-iso")
+   parser.add_argument('--answer-lock', dest='answer_lock', choices=('yes', 'no'),
+                       help="answer the question of a VM whose guest locked the CD-ROM: yes disconnects it anyway, no keeps the ISO\nSample: --answer-lock yes")
+   parser.add_argument('--question-timeout', dest='question_timeout', default=tasks.QUESTION_TIMEOUT, type=float,
+                       help="seconds a CD-ROM lock question raised by the reconfigure may wait for an answer before its default answer (no) is given\nSample: --question-timeout 300")
+   # stage 2: snapshots
+   parser.add_argument('--remove-snapshots', dest='remove_snapshots', default=False, action="store_true",
+                       help="remove the snapshots of the VMs (all, or those selected by --older or --snapshot)\nSample: --remove-snapshots")
+   parser.add_argument('--older', dest='older', type=int,
+                       help="remove only the snapshots older than days\nSample: --older 30")
+   parser.add_argument('--snapshot', dest='snapshot',
+                       help="remove only the snapshot with this name and its children\nSample: --snapshot before-update")
+   # stage 3: relocation
+   parser.add_argument('-d', '--ds', dest='datastore',
+                       help="relocate the VMs to this datastore, datastore cluster or comma separated list\nSample: --ds ds3")
+   parser.add_argument('--provisionType', dest='provisionType', choices=('thin', 'thick'),
+                       help="disk format on the destination (default: keep the format of each disk)\nSample: --provisionType thin")
+   parser.add_argument('--headroom', dest='headroom', default=10, type=float,
+                       help="percent of each destination datastore kept free\nSample: --headroom 10")
+   parser.add_argument('--max-per-source', dest='max_per_source', default=0, type=int,
+                       help="number of VMs worked on at the same time per source datastore (0 = no limit)\nSample: --max-per-source 2")
+   parser.add_argument('--max-per-dest', dest='max_per_dest', default=0, type=int,
+                       help="number of VMs worked on at the same time per destination datastore (0 = no limit)\nSample: --max-per-dest 2")
+   parser.add_argument('--max-per-host', dest='max_per_host', default=0, type=int,
+                       help="number of VMs worked on at the same time per ESXi host (0 = no limit)\nSample: --max-per-host 2")
+   # stage 4: rename
+   parser.add_argument('--suffix', dest='suffix',
+                       help="Add suffix to VM name\nSample: --suffix _off")
+   parser.add_argument('--prefix', dest='prefix',
+                       help="Add prefix to VM name\nSample: --prefix OFF_")
+   parser.add_argument('--remove-suffix', dest='remove_suffix',
+                       help="Remove suffix from VM name\nSample: --remove-suffix _off")
+   parser.add_argument('--remove-prefix', dest='remove_prefix',
+                       help="Remove prefix from VM name\nSample: --remove-prefix OFF_")
+   parser.add_argument('--pattern', dest='pattern',
+                       help="Replace the matches of a regular expression (case insensitive) in the VM name with --replace\nSample: --pattern '^web(\\d+)$' --replace 'www\\1'")
+   parser.add_argument('--replace', dest='replace',
+                       help="Replacement of --pattern, \\1 is the first group\nSample: --replace 'www\\1'")
+   parser.add_argument('--template', dest='template',
+                       help="New VM name from {name}, {folder} (the parent folder) and {datacenter}\nSample: --template '{folder}-{name}'")
+   parser.add_argument('--conflict', dest='conflict', default=rename_plan.REJECT, choices=[rename_plan.REJECT, rename_plan.SUFFIX],
+                       help="new name already used in the folder: reject the rename or append -1, -2, ... default: reject\nSample: --conflict suffix")
+   parser.add_argument('-t', '--threads', dest='threads', default=1, type=int,
+                       help="number of VMs worked on at the same time (one vCenter task per VM)\nSample: --threads 3")
+   parser.add_argument('-v', '--verbose', dest='verbose', default=0, action="count",
+                       help="verbose\nSample: -vv")
+   parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
+                       help="dry-run\nSample: --dryrun")
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
+   args = parser.parse_args()
+   return args
+
+def on_source(vm, sources):
+    # a disk or an ISO of the VM is on one of the datastores (moIds)
+    for disk in vm['disks']:
+        if disk['datastore'] in sources:
+            return True
+    for cdrom in vm['cdroms']:
+        if cdrom['iso'] and cdrom['datastore'] in sources:
+            return True
+    return False
+
+def select_snapshots(vm, args):
+    # moIds of the snapshots --remove-snapshots removes
+    if args.older:
+        return snapshot_plan.select_older(vm['snapshots'], args.older)
+    if args.snapshot:
+        return snapshot_plan.select_name(vm['snapshots'], args.snapshot)
+    return snapshot_plan.select_all(vm['snapshots'])
+
+def main():
+    args = GetArgs()
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
+
+    renaming = rename_vms.rename_operations(args)
+    if renaming > 1:
+        print("Error: At most one rename operation can be specified (--suffix, --prefix, --remove-suffix, --remove-prefix, --pattern or --template)")
+        return 1
+    pattern, error = rename_vms.compile_rename(args)
+    if error:
+        print("Error: " + error)
+        return 1
+    if not (args.remove_iso or args.remove_snapshots or args.datastore or renaming):
+        print("Nothing to do: give --remove-iso, --remove-snapshots, -d/--ds or a rename operation")
+        return 1
+
+    verbose = args.verbose
+    src_state = {'on': 'poweredOn', 'off': 'poweredOff'}.get(args.powerstate)
+
+    # one scan with the properties of all stages
+    vm_properties = inventory.VM_BASE_PROPERTIES + inventory.VM_DEVICE_PROPERTIES + inventory.VM_HOST_PROPERTIES
+    if args.remove_snapshots:
+        vm_properties = vm_properties + inventory.VM_SNAPSHOT_PROPERTIES
+    if args.datastore:
+        vm_properties = vm_properties + inventory.VM_STORAGE_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(args.host, args.user, args.password, verbose)
+    else:
+        si = SmartConnect(host=args.host, user=args.user, pwd=args.password, disableSslCertValidation=True)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    if args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    # -s is resolved like the migrators do it: names, clusters, URLs or moIds
+    sources = None
+    if args.sourecedatastore:
+        sources = set(placement.resolve_datastores(inv, args.sourecedatastore, "Source"))
+        if not sources:
+            return 1
+    dest_datacenters = {}
+    if args.datastore:
+        destinations = placement.resolve_destinations(inv, args.datastore)
+        if not destinations:
+            print("Destination datastore not found")
+            return 1
+        dest_datacenters = placement.destinations_by_datacenter(inv, destinations)
+        destinations = set(destinations)
+
+    # Filter the VMs once, the stages work on the same list
+    soap_profile.set_phase('filter')
+    selected = []
+    for datacenter in si.content.rootFolder.childEntity:
+        if verbose >= 2: print("Datacenter: " + datacenter.name)
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if verbose >= 2: print("VM: " + vm['name'])
+            if src_state and vm['powerState'] != src_state:
+                continue
+            if sources and not on_source(vm, sources):
+                continue
+            if not vm_filters.matches(vm):
+                continue
+            if vm_filters.excluded(vm):
+                if verbose: print("Not looking at VM: (excluded)" + vm['name'])
+                continue
+            if verbose: print("Looking at VM: " + vm['name'])
+            selected.append((vm, datacenter))
+
+    soap_profile.set_phase('plan')
+    # stage 3: VM moId -> destination datastore moId, placed per datacenter
+    destination_bytes = lambda vm: relocation.destination_bytes(vm, None, args.provisionType)
+    placed = {}
+    if args.datastore:
+        for dc_moid, dc_destinations in dest_datacenters.items():
+            candidates = [vm for vm, datacenter in selected if datacenter._moId == dc_moid and
+                          not any(disk['datastore'] in destinations for disk in vm['disks'])]
+            dc_placed, unplaced = placement.plan_placement(inv, candidates, dc_destinations, args.headroom,
+                                                           destination_bytes)
+            placement.print_plan(inv, dc_placed, unplaced, args.headroom, destination_bytes)
+            placed.update((vm['moid'], moid) for vm, moid in dc_placed)
+    # stage 4: VM moId -> new name, checked against the names in each folder
+    new_names = {}
+    rejected = []
+    if renaming:
+        renames = []
+        for vm, datacenter in selected:
+            new_name = rename_vms.processVM(vm, args, pattern, rename_plan.name_fields(inv, vm), verbose)
+            if new_name:
+                renames.append((vm, new_name))
+        planned, rejected = rename_plan.plan(inv['vms'], renames, args.conflict)
+        for vm, new_name in rejected:
+            print("Not renaming VM: {} -> {} (name already used in the folder)".format(vm['name'], new_name))
+        new_names.update((vm['moid'], new_name) for vm, new_name in planned)
+
+    # One job per VM: its stages run one after the other, never at the same time
+    stats = telemetry.MigrationTelemetry(sum(relocation.moved_bytes(vm, None) for vm, datacenter in selected
+                                             if vm['moid'] in placed), None, None)
+    def skipped(stage):
+        # a relocation that never starts is no longer part of the total
+        if stage.get('relocate'):
+            stats.add(-relocation.moved_bytes(stage['vm'], None))
+    jobs = []
+    count = 0
+    for vm, datacenter in selected:
+        stages = []
+        names = []
+        if args.remove_iso:
+            job = remove_iso.iso_job(si, vm, datacenter, None, verbose, sources)
+            if job:
+                stages.append(job)
+                names.append("remove ISOs")
+        if args.remove_snapshots and vm['snapshots']:
+            snapshots = select_snapshots(vm, args)
+            steps = remove_snapshots.snapshotRemove(vm, snapshots, False, verbose)
+            if steps:
+                stages.append(remove_snapshots.snapshot_job(vm, steps, snapshot_plan.removed_bytes(vm, snapshots)))
+                names.append("remove snapshots")
+        if vm['moid'] in placed:
+            moid = placed[vm['moid']]
+            destination_name = inv['datastores'][moid]['name']
+            job = migrate_datastore_threaded.relocate_job(
+                vm, pyVmomi.vim.Datastore(moid, si._stub), destination_name, stats, verbose,
+                provision=args.provisionType)
+            job['relocate'] = True
+            stages.append(job)
+            names.append("relocate to " + destination_name)
+        if vm['moid'] in new_names:
+            stages.append(rename_vms.renameVM(vm['obj'], vm['name'], new_names[vm['moid']], False, verbose))
+            names.append("rename to " + new_names[vm['moid']])
+        if not stages:
+            continue
+        count += 1
+        if args.dryrun:
+            print("Dryrun: " + vm['name'] + ": " + ", ".join(names))
+        else:
+            if verbose: print("VM " + vm['name'] + ": " + ", ".join(names))
+            job = tasks.chain_jobs(stages, skipped)
+            job['vm'] = vm
+            jobs.append(job)
+    print("Number of VMs: " + str(count))
+
+    # Run the pipelines, at most args.threads VMs at the same time
+    soap_profile.set_phase('execute')
+    failed = []
+    if jobs:
+        watcher = None
+        if args.remove_iso:
+            # a reconfigure waits while the VM asks whether to override the CD-ROM lock
+            answers = {tasks.CDROM_LOCKED: args.answer_lock} if args.answer_lock else {}
+            watcher = tasks.QuestionWatcher(si, [job['vm']['obj'] for job in jobs], answers, verbose,
+                                            args.question_timeout)
+        limits = {'src': args.max_per_source, 'dst': args.max_per_dest, 'host': args.max_per_host}
+        try:
+            failed = tasks.run_jobs(si, jobs, args.threads, verbose, limits,
+                                    on_progress=lambda job, percent: stats.progress(job['vm'], percent))
+        finally:
+            if watcher:
+                watcher.close()
+        print("")
+        print("Pipeline finished, failed: " + str(len(failed)))
+        if placed:
+            stats.print_summary()
+    soap_profile.report()
+
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed or rejected else 0
+
+
+if __name__ == "__main__":
+   sys.exit(main())
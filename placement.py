@@ -0,0 +1,134 @@
+"""Placement of VMs onto several destination datastores.
+
+Before any relocation starts, the VMs are bin-packed onto the destination
+datastores using their committed size (storage.perDatastoreUsage) against
+each datastore's free space minus a headroom reserve. VMs are placed
+largest first, each onto the datastore with the most space left, which
+spreads the write load across the targets. A streaming run places each
+VM with place() as the scan finds it, in the order of the scan.
+"""
+
+import inventory
+
+
+def datastore_index(inv):
+    """Index of all datastores and datastore clusters (StoragePods)
+
+    Maps the name, URL and moId of every datastore to its moId, and the name
+    and moId of every datastore cluster to the moIds of its datastores. A
+    name can stand for several datastores (the same name in several
+    datacenters). Built once per inventory.
+    """
+    if 'datastoreIndex' in inv:
+        return inv['datastoreIndex']
+    index = {}
+    for moid, ds in inv['datastores'].items():
+        for key in (ds['name'], ds.get('url'), moid):
+            if key:
+                index.setdefault(key, []).append(moid)
+        pod = inv['entities'].get(ds['parent'])
+        if pod and pod['type'] == 'StoragePod':
+            index.setdefault(pod['name'], []).append(moid)
+            index.setdefault(ds['parent'], []).append(moid)
+    inv['datastoreIndex'] = index
+    return index
+
+
+def resolve_datastores(inv, names, kind="Destination"):
+    """moIds of the datastores for a comma separated list of datastore and/or
+    datastore cluster names, URLs or moIds; a cluster stands for all of its
+    datastores"""
+    index = datastore_index(inv)
+    result = []
+    for name in names.split(','):
+        name = name.strip()
+        if name not in index:
+            print(kind + " datastore not found: " + name)
+        result += index.get(name, [])
+    # keep order, drop duplicates
+    return list(dict.fromkeys(result))
+
+
+def resolve_destinations(inv, names):
+    """moIds of the destination datastores for a -d argument"""
+    return resolve_datastores(inv, names, "Destination")
+
+
+def destinations_by_datacenter(inv, destinations):
+    """datacenter moId -> destination datastore moIds in that datacenter"""
+    result = {}
+    for moid in destinations:
+        result.setdefault(datastore_datacenter(inv, moid), []).append(moid)
+    return result
+
+
+def datastore_datacenter(inv, moid):
+    return inventory.find_datacenter(inv, inv['datastores'][moid]['parent'])
+
+
+def vm_committed(vm):
+    """Bytes a relocation of the whole VM has to copy"""
+    if vm['committed']:
+        return sum(vm['committed'].values())
+    return sum(disk['capacity'] for disk in vm['disks'])
+
+
+def usable_space(inv, moid, headroom):
+    """Free space of a datastore minus headroom percent of its capacity"""
+    ds = inv['datastores'][moid]
+    return ds['freeSpace'] - ds['capacity'] * headroom / 100.0
+
+
+def free_space(inv, destinations, headroom=10):
+    """Datastore moId -> usable space of the destinations, for place()"""
+    return dict((moid, usable_space(inv, moid, headroom)) for moid in destinations)
+
+
+def place(free, destinations, needed):
+    """Destination with the most free space that fits needed bytes, None if none fits
+
+    The bytes are taken from free, so the next VM sees what is left.
+    """
+    best = None
+    for moid in destinations:
+        if free[moid] >= needed and (best is None or free[moid] > free[best]):
+            best = moid
+    if best is not None:
+        free[best] -= needed
+    return best
+
+
+def plan_placement(inv, vms, destinations, headroom=10, size=vm_committed):
+    """Assign each VM to one of the destination datastores
+
+    Returns (placement, unplaced): placement is a list of (vm, datastore
+    moId) in the order of vms, unplaced the VMs that fit on no destination.
+    """
+    free = free_space(inv, destinations, headroom)
+    assigned = {}
+    for vm in sorted(vms, key=size, reverse=True):
+        best = place(free, destinations, size(vm))
+        if best is not None:
+            assigned[vm['moid']] = best
+    placement = []
+    unplaced = []
+    for vm in vms:
+        if vm['moid'] in assigned:
+            placement.append((vm, assigned[vm['moid']]))
+        else:
+            unplaced.append(vm)
+    return placement, unplaced
+
+
+def print_plan(inv, placement, unplaced, headroom, size=vm_committed):
+    planned = {}
+    for vm, moid in placement:
+        planned[moid] = planned.get(moid, 0) + size(vm)
+    for moid in planned:
+        print("  %s: %d VMs, %.2f GB planned, %.2f GB usable" % (
+            inv['datastores'][moid]['name'],
+            sum(1 for vm, ds in placement if ds == moid),
+            planned[moid] / (1024.0 ** 3),
+            usable_space(inv, moid, headroom) / (1024.0 ** 3)))
+    for vm in unplaced:
+        print("  NOT Migrating VM: " + vm['name'] + " (%.2f GB, does not fit on any destination)" % (size(vm) / (1024.0 ** 3)))
@@ -0,0 +1,148 @@
+"""RelocateSpec of the migrators: the whole VM or only some of its disks.
+
+By default a relocation moves the VM home (configuration files) and every
+disk to the destination. With --per-disk only the disks on the source
+datastores get a disk locator for the destination; the VM home moves
+along when it is on a source datastore as well (unless --keep-home), and
+the other disks keep their datastore. So a VM that was selected because
+one of its disks is on the source LUN only has that disk copied.
+
+With a provision type (--provisionType thin|thick) every moved flat disk
+gets a locator whose backing asks vCenter to convert the disk while
+copying it; RDM, SeSparse and other disks are moved in their format. The
+destination then needs the committed bytes of a thin disk but the
+full capacity of a thick one, see destination_bytes().
+"""
+
+from pyVmomi import vim
+
+import placement
+
+# backing of the disks whose provisioning a relocation can convert
+FLAT_BACKING = 'VirtualDiskFlatVer2BackingInfo'
+
+
+def plan_disks(vm, sources, keep_home=False):
+    """(disk keys, move home) of a per-disk relocation off the datastores in sources"""
+    disks = [disk['key'] for disk in vm['disks'] if disk['datastore'] in sources]
+    move_home = not keep_home and vm.get('home') in sources
+    return disks, move_home
+
+
+def moved_bytes(vm, disks=None):
+    """Bytes a relocation copies (disks None: the whole VM)"""
+    if disks is None:
+        return placement.vm_committed(vm)
+    total = 0
+    for disk in vm['disks']:
+        if disk['key'] in disks:
+            total += disk_committed(vm, disk)
+    return total
+
+
+def disk_committed(vm, disk):
+    """Committed bytes of one disk
+
+    storage.perDatastoreUsage only has the committed space per datastore, it
+    is split over the disks on that datastore by their capacity.
+    """
+    on_datastore = [d for d in vm['disks'] if d['datastore'] == disk['datastore']]
+    used = vm['committed'].get(disk['datastore'])
+    if used is None:
+        return disk['capacity']
+    capacity = sum(d['capacity'] for d in on_datastore) or 1
+    return min(disk['capacity'], used * disk['capacity'] // capacity)
+
+
+def convertible(disk):
+    """True if a relocation can change the provisioning of disk
+
+    Only flat disks take a FlatVer2 backing; RDM, SeSparse and the other
+    backings keep their format.
+    """
+    # records of older journals have no backing, they were flat disks then
+    return disk.get('backing', FLAT_BACKING) == FLAT_BACKING
+
+
+def is_thin(disk, provision=None):
+    """True if disk is thin provisioned after a relocation with provision (None: format kept)"""
+    if provision is None or not convertible(disk):
+        return bool(disk['thinProvisioned'])
+    return provision == 'thin'
+
+
+def provisioned_bytes(vm, disks=None):
+    """Capacity of the disks a relocation moves (disks None: all disks)"""
+    return sum(disk['capacity'] for disk in vm['disks'] if disks is None or disk['key'] in disks)
+
+
+def destination_bytes(vm, disks=None, provision=None):
+    """Space a relocation needs on the destination datastore
+
+    Thin disks take their committed bytes, thick disks their capacity.
+    Without a provision type this is what the relocation copies.
+    """
+    if provision is None:
+        return moved_bytes(vm, disks)
+    total = 0
+    for disk in vm['disks']:
+        if disks is None or disk['key'] in disks:
+            total += disk_committed(vm, disk) if is_thin(disk, provision) else disk['capacity']
+    return total
+
+
+def disk_backing(disk, provision):
+    """Backing of a disk locator converting the disk to provision (thin or thick)"""
+    return vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+        diskMode=disk.get('diskMode') or 'persistent',
+        thinProvisioned=provision == 'thin',
+        eagerlyScrub=False)
+
+
+def relocate_spec(vm, destination_ds, disks=None, move_home=True, provision=None):
+    """RelocateSpec moving the whole VM (disks None) or the disks with the keys in disks
+
+    provision ('thin' or 'thick') converts the moved disks, None keeps their format.
+    """
+    if disks is None and provision is None:
+        return vim.vm.RelocateSpec(datastore=destination_ds)
+    locators = []
+    for disk in vm['disks']:
+        if disks is None or disk['key'] in disks:
+            locator = vim.vm.RelocateSpec.DiskLocator(diskId=disk['key'], datastore=destination_ds)
+            if provision is not None and convertible(disk):
+                locator.diskBackingInfo = disk_backing(disk, provision)
+            elif provision is not None:
+                print("    " + vm['name'] + ": " + disk['label'] + " (" + str(disk.get('backing')) + ") is moved, its provisioning is kept")
+        elif move_home:
+            # without a locator the disk would follow the VM home
+            locator = vim.vm.RelocateSpec.DiskLocator(
+                diskId=disk['key'], datastore=vim.Datastore(disk['datastore'], destination_ds._stub))
+        else:
+            continue
+        locators.append(locator)
+    return vim.vm.RelocateSpec(datastore=destination_ds if move_home else None, disk=locators)
+
+
+def datastore_of(path):
+    """Datastore name of a datastore path like '[ds1] vm/vm.vmx'"""
+    if not path or not path.startswith('['):
+        return None
+    return path[1:path.find(']')]
+
+
+def is_relocated(vm_obj, destination_name, disks=None, move_home=True):
+    """True if the disks with the keys in disks (None: all disks) and, with move_home,
+    the VM home are on the datastore destination_name
+
+    Only the disk files and the VM home count: a mounted ISO may stay on
+    any datastore.
+    """
+    config = vm_obj.config
+    if move_home and datastore_of(config.files.vmPathName) != destination_name:
+        return False
+    for device in config.hardware.device:
+        if isinstance(device, vim.vm.device.VirtualDisk) and (disks is None or device.key in disks):
+            if datastore_of(device.backing.fileName) != destination_name:
+                return False
+    return True
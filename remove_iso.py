@@ -1,19 +1,25 @@
 #! /usr/bin/env python3
 
 import argparse
-import time
-import re
+import sys
 
 # import the vSphere Python SDK needed modules
 import pyVmomi
 from pyVim.connect import SmartConnect, Disconnect
-from pyVim import task
+
+import fleet
+import inventory
+import inventory_cache
+import soap_profile
+import tasks
+import templates
+import vm_filter
 
 def GetArgs():
    parser = argparse.ArgumentParser(
        description="This is tool to remove any iso from a VM on a datastore")
    parser.add_argument('-S', '--vcHost', dest='host', action='store',
-                       help='VC host to connect. (Required)')
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
    parser.add_argument('-u', '--user', default='administrator@vsphere.local',
                        help='User name of vc host. (Default: \'administrator@vsphere.local\')')
    parser.add_argument('-p', '--password', default='Admin!23',
@@ -24,14 +30,30 @@ def GetArgs():
                        help="Specify the VM names. (Regular Expression, Case insensitiv). Sample: --vm vmxxx")
    parser.add_argument('-f', '--folder', dest='folder',
                        help="Specify the Folder name need to be relocated. (Regular Expression, Case insensitiv). Sample: --folder kunde1")
+   parser.add_argument('-t', '--threads', dest='threads', default=1, type=int,
+                       help="number of Tasks to start in the vCenter at the same time\nSample: --threads 3")
    parser.add_argument('-v', '--verbose', dest='verbose', default=False, action="store_true",
                        help="verbose\nSample: --debug 1")
    parser.add_argument('-x', '--exclude', dest='exclude', 
                        help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
    parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
                        help="dry-run\nSample: --dryrun")
    parser.add_argument('-P', '--powerstate', dest='powerstate', default='on',
                        help="powerstate\nSample: --powerstate on|off default: on")
+   parser.add_argument('--answer-lock', dest='answer_lock', choices=('yes', 'no'),
+                       help="answer the question of a VM whose guest locked the CD-ROM door: yes disconnects anyway, no cancels the change (default: leave it to the vSphere client)\nSample: --answer-lock yes")
+   parser.add_argument('--question-timeout', dest='question_timeout', default=tasks.QUESTION_TIMEOUT, type=float,
+                       help="seconds a CD-ROM lock question raised by the reconfigure may wait for an answer before its default answer (no) is given\nSample: --question-timeout 300")
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
 #   parser.add_argument('-P', '--provisionType', dest='provisionType', default='thick',
 #                       help='Virtual disk provision type, supports: thin, thick; if omitted, thick will be taken',)
    args = parser.parse_args()
@@ -40,34 +62,61 @@ def GetArgs():
    #   parser.print_help()
    return args
 
-def GetResourcePools(entity):
-   pools = []
-   for pool in entity.resourcePool:
-      pools += GetResourcePools(pool)
-   pools.append(entity)
-   return pools
-
-def convert_to_template(vm,dc):
-    if vm.config.template:
-        print("VM is already a template")
-    else:
-        print("Converting to template")
-        vm.MarkAsTemplate()
-
-def convert_to_vm(vm,dc):
-    if vm.config.template:
-        print("Converting to VM")
-        pools = GetResourcePools(dc.hostFolder.childEntity[0].resourcePool)
-        if len(pools) == 0:
-            print("No resource pool found")
-            return
-        vm.MarkAsVirtualMachine(pool=pools[0])
-        time.sleep(5)
-    else:
-        print("VM is already a VM")
+def remove_isos(vm, vm_name, keys, verbose):
+    # Change the backing of the CD-ROMs in keys to a client device with one reconfigure task
+    spec = pyVmomi.vim.vm.ConfigSpec(deviceChange=[])
+    for device in vm.config.hardware.device:
+        if device.key in keys and isinstance(device.backing, pyVmomi.vim.vm.device.VirtualCdrom.IsoBackingInfo):
+            if verbose: print("  Found ISO " + device.backing.fileName + ": " + vm_name)
+            device.backing = pyVmomi.vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo(deviceName='', exclusive=False)
+            spec.deviceChange.append(pyVmomi.vim.vm.device.VirtualDeviceSpec(
+                operation=pyVmomi.vim.vm.device.VirtualDeviceSpec.Operation.edit, device=device))
+    if not spec.deviceChange:
+        return None
+    print("  Removing " + str(len(spec.deviceChange)) + " ISO from VM: " + vm_name)
+    # If the guest locked the CD-ROM door the task waits for an answer to
+    # runtime.question, see tasks.QuestionWatcher and --answer-lock
+    return vm.ReconfigVM_Task(spec)
+
+def iso_job(si, vm, datacenter, sourcedatastore, verbose, sources=None):
+    # job for tasks.run_jobs(): one reconfigure task for all ISOs of the VM
+    # (None if the VM has no ISO to remove); sources: moIds of the source
+    # datastores, checked instead of the name sourcedatastore
+    vm_obj = vm['obj']
+    keys = []
+    for cdrom in vm['cdroms']:
+        if sources is not None:
+            on_source = cdrom['datastore'] in sources
+        else:
+            on_source = not sourcedatastore or cdrom['datastoreName'] == sourcedatastore
+        if cdrom['iso'] and on_source:
+            if verbose: print("  Found CDROM" + cdrom['label'])
+            keys.append(cdrom['key'])
+    if not keys:
+        return None
+    steps = [lambda: remove_isos(vm_obj, vm['name'], keys, verbose)]
+    # a template cannot be reconfigured, it is a VM while its ISOs are removed
+    converted = []
+    if vm['template']:
+        def to_vm():
+            print("    VM is a template! Convert to VM first")
+            if templates.to_vm(si, vm, datacenter):
+                converted.append(True)
+        steps.insert(0, to_vm)
+    def done(job, error):
+        if verbose and error is None: print("VM iso-removed: " + vm['name'])
+        if converted:
+            templates.to_template(vm)
+    return {'name': vm['name'], 'vm': vm, 'steps': steps, 'done': done}
 
 def main():
     args = GetArgs()
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
 
     vcenter_server = args.host
     username = args.user
@@ -85,82 +134,77 @@ def main():
     elif powerstate == 'off':
         src_state = 'poweredOff'
 
-    si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
-    vm_list = []
+    vm_properties = inventory.VM_BASE_PROPERTIES + inventory.VM_DEVICE_PROPERTIES + inventory.VM_HOST_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(vcenter_server, username, password, verbose)
+    else:
+        si = SmartConnect(host=vcenter_server, user=username, pwd=password, disableSslCertValidation=True)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    if args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    soap_profile.set_phase('filter')
+    jobs = []
     datacenters = si.content.rootFolder.childEntity
     for datacenter in datacenters:
         if verbose: print("Datacenter: " + datacenter.name)
 
-        # List VMs
-        vm_view = si.content.viewManager.CreateContainerView(datacenter, [pyVmomi.vim.VirtualMachine], True)
-        vms_list = vm_view.view
-        vm_view.Destroy()
-
         # Loop through VMs
-        for vm in vms_list:
-            if verbose: print("VM: " + vm.name)
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if verbose: print("VM: " + vm['name'])
             if args.sourecedatastore:
                 is_on_src_ds = False
             else:
                 is_on_src_ds = True
-            for device in vm.config.hardware.device:
-                if isinstance(device, pyVmomi.vim.vm.device.VirtualCdrom):
-                    if args.sourecedatastore:
-                      if isinstance(device.backing, pyVmomi.vim.vm.device.VirtualCdrom.IsoBackingInfo):
-                        if device.backing.datastore.name == args.sourecedatastore:
-                          is_on_src_ds = True
-                          if verbose: print("  Found on SOURCE Datastore " + args.sourecedatastore + ": "+ vm.name)
+            for cdrom in vm['cdroms']:
+                if args.sourecedatastore:
+                  if cdrom['iso']:
+                    if cdrom['datastoreName'] == args.sourecedatastore:
+                      is_on_src_ds = True
+                      if verbose: print("  Found on SOURCE Datastore " + args.sourecedatastore + ": "+ vm['name'])
             if is_on_src_ds:
-                if vm.runtime.powerState == src_state:
-                    if verbose: print("VM is $vm.runtime.powerState")
-                    if verbose: print("Folder name: " + vm.parent.name)
-                    if not args.folder or (args.folder and re.search(args.folder,vm.parent.name+"/"+vm.parent.parent.name ,re.IGNORECASE)):
-                        if not args.vm or (args.vm and re.search(args.vm, vm.name,re.IGNORECASE)):
-                            if args.exclude and (args.exclude and re.search(args.exclude, vm.name,re.IGNORECASE )):
-                                if verbose: print("Not looking at VM: (excluded)" + vm.name)
+                if vm['powerState'] == src_state:
+                    if verbose: print("VM is " + vm['powerState'])
+                    if verbose: print("Folder name: " + vm['folder'])
+                    if vm_filters.matches(vm):
+                        if vm_filters.excluded(vm):
+                            if verbose: print("Not looking at VM: (excluded)" + vm['name'])
+                        else:
+                            if verbose: print("Looking at VM: " + vm['name'])
+                            if not args.dryrun:
+                                job = iso_job(si, vm, datacenter, args.sourecedatastore, verbose)
+                                if job:
+                                    jobs.append(job)
                             else:
-                                if verbose: print("Looking at VM: " + vm.name)
-                                if not args.dryrun:
-                                    # Check if the VM is a template
-                                    convert_back = False
-                                    if vm.config.template:
-                                        print("    VM is a template! Convert to VM first")
-                                        convert_to_vm(vm,datacenter)
-                                        convert_back = True
-                                    for device in vm.config.hardware.device:
-                                        if isinstance(device, pyVmomi.vim.vm.device.VirtualCdrom):
-                                            if isinstance(device.backing, pyVmomi.vim.vm.device.VirtualCdrom.IsoBackingInfo):
-                                                if verbose: print("  Found CDROM" + device.deviceInfo.label)
-                                                if not args.sourecedatastore or device.backing.datastore.name == args.sourecedatastore:
-                                                    if verbose: print("  Found ISO on " + device.backing.datastore.name + ": "+ vm.name)
-                                                    if verbose: print("  Removing ISO")
-                                                    print("  Removing ISO from VM: " + vm.name)
-                                                    # Change the VirtualCdrom backing to ClientDevice
-                                                    device.backing = pyVmomi.vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo()
-                                                    # Update the VM
-                                                    spec = pyVmomi.vim.vm.ConfigSpec()
-                                                    spec.deviceChange = [pyVmomi.vim.vm.device.VirtualDeviceSpec()]
-                                                    spec.deviceChange[0].operation = pyVmomi.vim.vm.device.VirtualDeviceSpec.Operation.edit
-                                                    spec.deviceChange[0].device = device
-                                                    # Do It and do not wait for completion
-                                                    # THe Answer " The guest operating system has locked the CD-ROM door and is probably using the CD-ROM, which can prevent the guest from recognizing media changes. If possible, eject the CD-ROM from inside the guest before disconnecting. Disconnect anyway and override the lock?"
-                                                    # is not possible to answer with the vSphere API
-                            
-                                                    task=vm.ReconfigVM_Task(spec)
-                                                    time.sleep(10)
-                                                    if verbose: print("  ISO removed")
-                                    if verbose: print("VM iso-removed")
-
-                                    if convert_back:
-                                        print("    Converting back to template")
-                                        convert_to_template(vm,datacenter)
-                                else:
-                                    print("Dryrun: VM not iso-removed")
-                                # exit loop for Testing
-                                #break
+                                print("Dryrun: VM not iso-removed")
+                            # exit loop for Testing
+                            #break
             #break
-    Disconnect(si)
+
+    # Remove the ISOs, at most args.threads tasks at the same time
+    soap_profile.set_phase('execute')
+    watcher = None
+    if jobs:
+        # a reconfigure waits while the VM asks whether to override the CD-ROM lock
+        answers = {tasks.CDROM_LOCKED: args.answer_lock} if args.answer_lock else {}
+        watcher = tasks.QuestionWatcher(si, [job['vm']['obj'] for job in jobs], answers, verbose,
+                                        args.question_timeout)
+    try:
+        failed = tasks.run_jobs(si, jobs, args.threads, verbose)
+    finally:
+        if watcher:
+            watcher.close()
+    if jobs:
+        print("ISO removal finished, failed: " + str(len(failed)))
+    soap_profile.report()
+
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-   main()
\ No newline at end of file
+   sys.exit(main())
\ No newline at end of file
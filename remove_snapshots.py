@@ -1,20 +1,29 @@
 #! /usr/bin/env python3
 
 import argparse
-import threading
-import time
-import re
+import csv
+import datetime
+import json
+import sys
 
 # import the vSphere Python SDK needed modules
 import pyVmomi
 from pyVim.connect import SmartConnect, Disconnect
-from pyVim import task
+
+import fleet
+import inventory
+import inventory_cache
+import sessions
+import snapshot_plan
+import soap_profile
+import tasks
+import vm_filter
 
 def GetArgs():
    parser = argparse.ArgumentParser(
        description="This is tool to remove snapshots from virtual machine")
    parser.add_argument('-S', '--vcHost', dest='host', action='store',
-                       help='VC host to connect. (Required)')
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
    parser.add_argument('-u', '--user', default='administrator@vsphere.local',
                        help='User name of vc host. (Default: \'administrator@vsphere.local\')')
    parser.add_argument('-p', '--password', default='Admin!23',
@@ -35,246 +44,216 @@ def GetArgs():
                        help="verbose\nSample: -vv")
    parser.add_argument('-x', '--exclude', dest='exclude',
                        help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
    parser.add_argument('--older', dest='older', type=int,
                        help="Only remove snapshots older than specified days\nSample: --older 30")
+   parser.add_argument('--max-per-datastore', dest='max_per_datastore', default=0, type=int,
+                       help="max. concurrent snapshot removals per datastore holding delta disks of the VM (0 = no limit)\nSample: --max-per-datastore 2")
+   parser.add_argument('--order', dest='order', default='none', choices=('none', 'largest', 'smallest'),
+                       help="order of the removals by delta size: largest first, smallest first (most snapshots cleared per hour) or as found\nSample: --order smallest")
    parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
                        help="dry-run\nSample: --dryrun")
+   parser.add_argument('--sessions', dest='sessions', default=sessions.POOL_SIZE, type=int,
+                       help="number of HTTP connections the worker threads share on the vCenter session (default: %d)\nSample: --sessions 8" % sessions.POOL_SIZE)
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--report', dest='report', nargs='?', const='-',
+                       help="remove nothing, write every snapshot of the selected VMs with age and size to stdout or a file ({host} is replaced by the vCenter)\nSample: --report snapshots-{host}.csv")
+   parser.add_argument('--report-format', dest='report_format', default='csv', choices=('csv', 'json'),
+                       help="format of --report: csv or json (one object per line)\nSample: --report-format json")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
    args = parser.parse_args()
    #if args.action not in ('relocate_vm','listVMs') or not args.host:
    #   parser.print_help()
    return args
 
-def list_snapshots_recursively(snapshots):
-    snapshot_data = []
-    for snapshot in snapshots:
-        snap_text = "Name: %s; Description: %s; CreateTime: %s; State: %s" % (
-                                        snapshot.name, snapshot.description,
-                                        snapshot.createTime, snapshot.state)
-        snapshot_data.append(snap_text)
-        snapshot_data = snapshot_data + list_snapshots_recursively(
-                                        snapshot.childSnapshotList)
-    return snapshot_data
-
-
-def get_snapshots_by_name_recursively(snapshots, snapname):
-    snap_obj = []
-    for snapshot in snapshots:
-        if snapshot.name == snapname:
-            snap_obj.append(snapshot)
-        else:
-            snap_obj = snap_obj + get_snapshots_by_name_recursively(
-                                    snapshot.childSnapshotList, snapname)
-    return snap_obj
-
-
-def get_current_snap_obj(snapshots, snapob):
-    snap_obj = []
-    for snapshot in snapshots:
-        if snapshot.snapshot == snapob:
-            snap_obj.append(snapshot)
-        snap_obj = snap_obj + get_current_snap_obj(
-                                snapshot.childSnapshotList, snapob)
-    return snap_obj
-
-
-def get_all_snapshots_recursively(snapshots):
-    """Get all snapshots recursively (returns snapshot objects, not strings)"""
-    snap_obj = []
-    for snapshot in snapshots:
-        snap_obj.append(snapshot)
-        # Recursively check child snapshots
-        snap_obj = snap_obj + get_all_snapshots_recursively(snapshot.childSnapshotList)
-    return snap_obj
-
-
-def get_snapshots_older_than_days(snapshots, days):
-    """Get all snapshots that are older than the specified number of days"""
-    import datetime
-    snap_obj = []
-    cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days)
-
-    for snapshot in snapshots:
-        # Convert createTime to datetime if it's not already
-        create_time = snapshot.createTime
-        if isinstance(create_time, str):
-            # Handle string format if needed
-            create_time = datetime.datetime.fromisoformat(create_time.replace('Z', '+00:00'))
-        elif hasattr(create_time, 'replace'):  # vim.DateTime object
-            # Convert vim.DateTime to python datetime
-            create_time = create_time.replace(tzinfo=None)
-
-        if create_time < cutoff_date:
-            snap_obj.append(snapshot)
-
-        # Recursively check child snapshots
-        snap_obj = snap_obj + get_snapshots_older_than_days(
-                                snapshot.childSnapshotList, days)
-    return snap_obj
-
-
-def snapshotRemove(vm, snapshotname, dryrun, verbose):
-    if verbose: print("Removing snapshot: " + snapshotname + " from VM: " + vm.name)
-    snap_obj = get_snapshots_by_name_recursively(vm.snapshot.rootSnapshotList, snapshotname)
-    # if len(snap_obj) is 0; then no snapshots with specified name
-    if len(snap_obj) == 1:
-        snap = snap_obj[0].snapshot
-        print("  " + vm.name + " " + snap)
-        if not dryrun:
-            task.WaitForTask(snap.RemoveSnapshot_Task(removeChildren=True))
-            print("Snapshot removed:" + vm.name + " " + snapshotname)
-
-def snapshotRemoveAll(vm, dryrun, verbose):
-    if verbose: print("Removing all snapshots from VM: " + vm.name + ":")
-    snaps = list_snapshots_recursively(vm.snapshot.rootSnapshotList)
-    for snap in snaps:
-        print("  " + vm.name + " " + snap)
+REPORT_FIELDS = ['vcenter', 'vm', 'path', 'snapshot', 'name', 'parent', 'depth', 'createTime', 'ageDays',
+                 'sizeBytes', 'state', 'description']
 
-    #t1 = vm.removesnapshot(spec=pyVmomi.vim.vm.RelocateSpec(datastore=destination_ds))
-    #t1 = vm.RemoveAllSnapshots_Task()
-    if not dryrun:
-        task.WaitForTask(vm.RemoveAllSnapshots())
-        print("Snapshot removed:" + vm.name)
-    return
-
-
-def snapshotRemoveOlderThan(vm, days, dryrun, verbose):
-    """Remove snapshots older than specified days"""
-    if verbose: print("Removing snapshots older than {} days from VM: {}".format(days, vm.name))
-
-    # Get all snapshots on the VM
-    all_snapshots = get_all_snapshots_recursively(vm.snapshot.rootSnapshotList)
-    # Get snapshots older than specified days
-    old_snapshots = get_snapshots_older_than_days(vm.snapshot.rootSnapshotList, days)
-
-    if not old_snapshots:
-        if verbose: print("  No snapshots older than {} days found on VM: {}".format(days, vm.name))
-        return
-
-    # Optimization: if ALL snapshots are older than the threshold, use RemoveAllSnapshots
-    if len(all_snapshots) == len(old_snapshots):
-        if verbose: print("  All {} snapshots are older than {} days, using RemoveAllSnapshots".format(len(all_snapshots), days))
-
-        # Show all snapshots that will be removed
-        for snap_obj in all_snapshots:
-            snap_text = "Name: %s; Description: %s; CreateTime: %s; State: %s" % (
-                                            snap_obj.name, snap_obj.description,
-                                            snap_obj.createTime, snap_obj.state)
-            print("  " + vm.name + " " + snap_text)
-
-        if not dryrun:
-            task.WaitForTask(vm.RemoveAllSnapshots())
-            print("All snapshots removed from: {}".format(vm.name))
+def report_writer(path, report_format, host):
+    # (file, write(row)) of --report; rows are written as the VMs are processed
+    if path == '-':
+        report_file = sys.stdout
     else:
-        # Only some snapshots are old, remove them individually
-        if verbose: print("  Found {} old snapshots out of {} total, removing individually".format(len(old_snapshots), len(all_snapshots)))
-
-        for snap_obj in old_snapshots:
-            snap_text = "Name: %s; Description: %s; CreateTime: %s; State: %s" % (
-                                            snap_obj.name, snap_obj.description,
-                                            snap_obj.createTime, snap_obj.state)
-            print("  " + vm.name + " " + snap_text)
-
-        if not dryrun:
-            for snap_obj in old_snapshots:
-                if verbose: print("  Removing snapshot: {} from VM: {}".format(snap_obj.name, vm.name))
-                task.WaitForTask(snap_obj.snapshot.RemoveSnapshot_Task(removeChildren=True))
-            print("Snapshots older than {} days removed from: {}".format(days, vm.name))
-    return
+        report_file = open(path.replace('{host}', host), 'w', newline='')
+    if report_format == 'csv':
+        writer = csv.DictWriter(report_file, REPORT_FIELDS)
+        writer.writeheader()
+        return report_file, writer.writerow
+    return report_file, lambda row: report_file.write(json.dumps(row) + "\n")
+
+def snapshot_rows(vm, host, now):
+    # report rows of the snapshots of vm (inventory record)
+    names = {}
+    for snapshot in snapshot_plan.walk(vm['snapshots']):
+        names[snapshot['snapshot']] = snapshot['name']
+        created = snapshot_plan.create_time(snapshot)
+        yield {
+            'vcenter': host,
+            'vm': vm['name'],
+            'path': vm['path'],
+            'snapshot': snapshot['snapshot'],
+            'name': snapshot['name'],
+            'parent': names.get(snapshot['parent'], ''),
+            'depth': snapshot['depth'],
+            'createTime': created.isoformat(),
+            'ageDays': round((now - created).total_seconds() / 86400.0, 1),
+            'sizeBytes': vm['snapshotSizes'].get(snapshot['snapshot']),
+            'state': snapshot['state'],
+            'description': snapshot['description'],
+        }
+
+def snapshot_text(snapshot):
+    return "Name: %s; Description: %s; CreateTime: %s; State: %s" % (
+        snapshot['name'], snapshot['description'], snapshot['createTime'], snapshot['state'])
+
+
+def snapshotRemove(vm, selected, dryrun, verbose):
+    """Print the snapshots of vm (inventory record) with the moIds in selected
+
+    Returns the steps for tasks.run_jobs(), functions that start one vCenter
+    task each: the fewest removals covering the selection (snapshot_plan).
+    """
+    vm_obj = vm['obj']
+    for snapshot in snapshot_plan.walk(vm['snapshots']):
+        if snapshot['snapshot'] in selected:
+            print("  " + vm['name'] + " " + snapshot_text(snapshot))
+    steps = []
+    for operation, snapshot, children in snapshot_plan.plan(vm['snapshots'], selected):
+        if operation == snapshot_plan.REMOVE_ALL:
+            if verbose: print("  RemoveAllSnapshots on: " + vm['name'])
+            steps.append(lambda: vm_obj.RemoveAllSnapshots())
+        else:
+            if verbose: print("  RemoveSnapshot " + snapshot['name'] + (" with children" if children else "") + " on: " + vm['name'])
+            snap = pyVmomi.vim.vm.Snapshot(snapshot['snapshot'], vm_obj._stub)
+            steps.append(lambda snap=snap, children=children: snap.RemoveSnapshot_Task(removeChildren=children))
+    if dryrun:
+        return []
+    return steps
+
+def snapshot_job(vm, steps, size):
+    # job for tasks.run_jobs(), occupying the datastores of the VM's delta disks
+    resources = [('ds', moid) for moid in vm['deltaDatastores']]
+    def done(job, error):
+        if error is None:
+            print("Snapshots removed: " + vm['name'])
+    return {'name': vm['name'], 'steps': steps, 'done': done, 'resources': resources, 'size': size}
+
+def order_jobs(jobs, order):
+    # a consolidation takes about as long as its delta disks are big:
+    # smallest first clears the most snapshots per hour
+    if order == 'largest':
+        return sorted(jobs, key=lambda job: job['size'], reverse=True)
+    if order == 'smallest':
+        return sorted(jobs, key=lambda job: job['size'])
+    return jobs
 
 def main():
     args = GetArgs()
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
     #if not args.datastore:
     #    print("-d/--datastore is required!")
     #    return
 
     verbose = args.verbose
 
-    si = SmartConnect(host=args.host, user=args.user, pwd=args.password, disableSslCertValidation=True)
-    vm_list = []
+    vm_properties = inventory.VM_BASE_PROPERTIES + inventory.VM_SNAPSHOT_PROPERTIES
+    if args.datastore:
+        vm_properties += inventory.VM_DEVICE_PROPERTIES
+    if args.report is not None or args.max_per_datastore or args.order != 'none':
+        vm_properties += inventory.VM_LAYOUT_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(args.host, args.user, args.password, verbose)
+    else:
+        si = SmartConnect(host=args.host, user=args.user, pwd=args.password, disableSslCertValidation=True)
+    if args.report is None:
+        # the report starts no tasks
+        si = sessions.pool(si, args.host, args.user, args.password, args.sessions)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    if args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    soap_profile.set_phase('filter')
+    jobs = []
+    if args.report is not None:
+        report_file, write_row = report_writer(args.report, args.report_format, args.host)
+        now = datetime.datetime.now(datetime.timezone.utc)
     datacenters = si.content.rootFolder.childEntity
     for datacenter in datacenters:
         if verbose >= 2: print("Datacenter: " + datacenter.name)
 
-        # List VMs
-        vm_view = si.content.viewManager.CreateContainerView(datacenter, [pyVmomi.vim.VirtualMachine], True)
-        vms_list = vm_view.view
-        vm_view.Destroy()
-
-        threads = []
         # Loop through VMs
-        for vm in vms_list:
-            if verbose >= 2: print("VM: " + vm.name)
-            if not args.folder or (args.folder and re.search(args.folder,vm.parent.name+"/"+vm.parent.parent.name ,re.IGNORECASE)):
-                if verbose >= 2: print("  VM Folder: " + vm.parent.name)
-                if not args.vm or (args.vm and re.search(args.vm, vm.name,re.IGNORECASE)):
-                    if verbose >= 2: print("  VM name: " + vm.name)
-                    if not (args.exclude and (args.exclude and re.search(args.exclude, vm.name,re.IGNORECASE ))):
-                        if verbose >= 2: print("  VM not excluded: " + vm.name)
-                        if not args.poweredon or (args.poweredon and vm.runtime.powerState == "poweredOn"):
-                            if verbose >=1: print("  Considering VM:" + vm.name)
-                            # Look if the VM has a Disk on the Datastore (if specified)
-                            is_on_ds = False
-                            if args.datastore:
-                                if verbose >=2: print("  Checking if VM is on Datastore " + args.datastore)
-                                for device in vm.config.hardware.device:
-                                    if isinstance(device, pyVmomi.vim.vm.device.VirtualDisk):
-                                        if device.backing.datastore.name == args.datastore:
-                                            if verbose: print("  Found on Datastore " + args.datastore + ": "+ vm.name)
-                                            is_on_ds = True
-                                            break
-                            # Move only if not specified or if specified and found on DS
-                            if not args.datastore or is_on_ds:
-                                if vm.snapshot:
-                                    #print("  Snapshots:")
-                                    for snapshot in vm.snapshot.rootSnapshotList:
-                                        #print("    " + snapshot.name)
-                                        ##if snapshot.name == "snapshot":
-                                        if verbose: print("Found some snapshots on VM:")
-                                        if args.threads > 1:
-                                            # start a thread if we have less than args.threads
-                                            if len(threads) >= args.threads: 
-                                                print("Waiting for a thread to finish")
-                                            while len(threads) >= args.threads:
-                                                # wait for a thread to finish
-                                                print(".", end='', flush=True)
-                                                time.sleep(30)
-                                                for t in threads:
-                                                    if not t.is_alive():
-                                                        threads.remove(t)
-                                                        break
-                                            if args.older:
-                                                # Remove snapshots older than X days
-                                                t = threading.Thread(target=snapshotRemoveOlderThan, args=(vm, args.older, args.dryrun, verbose))
-                                            elif args.snapshot:
-                                                # Remove specific snapshot
-                                                t = threading.Thread(target=snapshotRemove, args=(vm, args.snapshot, args.dryrun, verbose))
-                                            else:
-                                                # Remove all snapshots
-                                                t = threading.Thread(target=snapshotRemoveAll, args=(vm, args.dryrun, verbose))
-                                            threads.append(t)
-                                            t.start()
-                                        else:
-                                            if args.older:
-                                                # Remove snapshots older than X days
-                                                if verbose: print("  Removing snapshots older than {} days on: {}".format(args.older, vm.name))
-                                                snapshotRemoveOlderThan(vm, args.older, args.dryrun, verbose)
-                                            elif args.snapshot:
-                                                # Remove specific snapshot
-                                                if verbose: print("  Removing snapshot: " + args.snapshot + " on " + vm.name )
-                                                snapshotRemove(vm, args.snapshot, args.dryrun, verbose)
-                                            else:
-                                                # Remove all snapshots
-                                                if verbose: print("  Removing All snapshots on: " + vm.name )
-                                                snapshotRemoveAll(vm, args.dryrun, verbose)
-
-    if args.threads > 1:
-        # wait for threads to finish
-        for t in threads:
-            time.sleep(30)
-            t.join()
-
-    Disconnect(si)
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if verbose >= 2: print("VM: " + vm['name'])
+            if vm_filters.matches(vm):
+                if verbose >= 2: print("  VM Path: " + vm['path'])
+                if not vm_filters.excluded(vm):
+                    if verbose >= 2: print("  VM not excluded: " + vm['name'])
+                    if not args.poweredon or (args.poweredon and vm['powerState'] == "poweredOn"):
+                        if verbose >=1: print("  Considering VM:" + vm['name'])
+                        # Look if the VM has a Disk on the Datastore (if specified)
+                        is_on_ds = False
+                        if args.datastore:
+                            if verbose >=2: print("  Checking if VM is on Datastore " + args.datastore)
+                            for disk in vm['disks']:
+                                if disk['datastoreName'] == args.datastore:
+                                    if verbose: print("  Found on Datastore " + args.datastore + ": "+ vm['name'])
+                                    is_on_ds = True
+                                    break
+                        # Move only if not specified or if specified and found on DS
+                        if not args.datastore or is_on_ds:
+                            if vm['snapshots'] and args.report is not None:
+                                for row in snapshot_rows(vm, args.host, now):
+                                    write_row(row)
+                            elif vm['snapshots']:
+                                if verbose: print("Found some snapshots on VM:")
+                                if args.older:
+                                    # Remove snapshots older than X days
+                                    if verbose: print("  Removing snapshots older than {} days on: {}".format(args.older, vm['name']))
+                                    selected = snapshot_plan.select_older(vm['snapshots'], args.older)
+                                elif args.snapshot:
+                                    # Remove specific snapshot (and its children)
+                                    if verbose: print("  Removing snapshot: " + args.snapshot + " on " + vm['name'])
+                                    selected = snapshot_plan.select_name(vm['snapshots'], args.snapshot)
+                                else:
+                                    # Remove all snapshots
+                                    if verbose: print("  Removing All snapshots on: " + vm['name'])
+                                    selected = snapshot_plan.select_all(vm['snapshots'])
+                                # one job per VM, its removals run one after the other
+                                steps = snapshotRemove(vm, selected, args.dryrun, verbose)
+                                if steps:
+                                    jobs.append(snapshot_job(vm, steps, snapshot_plan.removed_bytes(vm, selected)))
+
+    if args.report is not None and report_file is not sys.stdout:
+        report_file.close()
+        print("Snapshot report written to " + report_file.name)
+
+    # Run the removals, at most args.threads tasks at the same time
+    soap_profile.set_phase('execute')
+    jobs = order_jobs(jobs, args.order)
+    failed = tasks.run_jobs(si, jobs, args.threads, verbose, {'ds': args.max_per_datastore})
+    if jobs:
+        print("Snapshot removal finished, failed: " + str(len(failed)))
+    soap_profile.report()
+
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
-   main()
\ No newline at end of file
+   sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,62 @@
+"""Rename plan of rename_vms.py.
+
+vCenter keeps the names of the VMs and templates in one folder unique, a
+Rename_Task to a name that is already used in the folder fails with
+DuplicateName. The plan checks every new name against an index of the
+names per folder (built once from the inventory records) before any task
+runs: a conflict is either rejected or resolved by appending -1, -2, ...
+The new names of the plan are added to the index, so two VMs renamed to
+the same name collide as well. The renames run in parallel, so a name
+that another rename of the same run frees counts as taken.
+"""
+
+REJECT = 'reject'
+SUFFIX = 'suffix'
+
+
+def name_fields(inventory, vm):
+    """Fields of a --template: name, folder (the parent folder) and datacenter"""
+    entities = inventory['entities']
+    return {
+        'name': vm['name'],
+        'folder': entities.get(vm['parent'], {}).get('name', ''),
+        'datacenter': entities.get(vm['datacenter'], {}).get('name', ''),
+    }
+
+
+def folder_index(vms):
+    """Folder moId -> set of the names of the VMs and templates in it"""
+    index = {}
+    for vm in vms:
+        index.setdefault(vm['parent'], set()).add(vm['name'])
+    return index
+
+
+def free_name(taken, name):
+    """name with the first suffix -1, -2, ... that is not in taken"""
+    i = 1
+    while "%s-%d" % (name, i) in taken:
+        i += 1
+    return "%s-%d" % (name, i)
+
+
+def plan(vms, renames, conflict=REJECT):
+    """Check the renames against the names of all VMs in vms
+
+    renames is a list of (vm record, new name). Returns (planned, rejected),
+    two lists of (vm record, new name); with conflict SUFFIX nothing is
+    rejected, the new name gets a suffix instead.
+    """
+    index = folder_index(vms)
+    planned = []
+    rejected = []
+    for vm, new_name in renames:
+        taken = index.setdefault(vm['parent'], set())
+        if new_name in taken:
+            if conflict != SUFFIX:
+                rejected.append((vm, new_name))
+                continue
+            new_name = free_name(taken, new_name)
+        taken.add(new_name)
+        planned.append((vm, new_name))
+    return planned, rejected
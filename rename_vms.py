@@ -1,20 +1,25 @@
 #! /usr/bin/env python3
 
 import argparse
-import threading
-import time
 import re
+import sys
 
 # import the vSphere Python SDK needed modules
-import pyVmomi
 from pyVim.connect import SmartConnect, Disconnect
-from pyVim import task
+
+import fleet
+import inventory
+import inventory_cache
+import rename_plan
+import soap_profile
+import tasks
+import vm_filter
 
 def GetArgs():
    parser = argparse.ArgumentParser(
        description="Tool to rename virtual machines")
    parser.add_argument('-S', '--vcHost', dest='host', action='store',
-                       help='VC host to connect. (Required)')
+                       help='VC host to connect: one host, a comma separated list or @file with one host per line. (Required)')
    parser.add_argument('-u', '--user', default='administrator@vsphere.local',
                        help='User name of vc host. (Default: \'administrator@vsphere.local\')')
    parser.add_argument('-p', '--password', default='Admin!23',
@@ -33,27 +38,51 @@ def GetArgs():
                        help="Remove suffix from VM name\nSample: --remove-suffix _off")
    parser.add_argument('--remove-prefix', dest='remove_prefix',
                        help="Remove prefix from VM name\nSample: --remove-prefix OFF_")
+   parser.add_argument('--pattern', dest='pattern',
+                       help="Replace the matches of a regular expression (case insensitive) in the VM name with --replace\nSample: --pattern '^web(\\d+)$' --replace 'www\\1'")
+   parser.add_argument('--replace', dest='replace',
+                       help="Replacement of --pattern, \\1 is the first group\nSample: --replace 'www\\1'")
+   parser.add_argument('--template', dest='template',
+                       help="New VM name from {name}, {folder} (the parent folder) and {datacenter}\nSample: --template '{folder}-{name}'")
+   parser.add_argument('--conflict', dest='conflict', default=rename_plan.REJECT, choices=[rename_plan.REJECT, rename_plan.SUFFIX],
+                       help="new name already used in the folder: reject the rename or append -1, -2, ... default: reject\nSample: --conflict suffix")
    parser.add_argument('-t', '--threads', dest='threads', default=1, type=int,
                        help="number of Tasks to start in the vCenter at the same time\nSample: --threads 3")
    parser.add_argument('-v', '--verbose', dest='verbose', default=0, action="count",
                        help="verbose\nSample: -vv")
    parser.add_argument('-x', '--exclude', dest='exclude',
                        help="exclude\nSample: --exclude VM-NAME123")
+   parser.add_argument('--path', dest='path',
+                       help="Specify the inventory path of the VMs, matched against the full path /datacenter/folders/vm. (Regular Expression, Case insensitive). Sample: --path '^/DC1/vm/kunde1/'")
+   parser.add_argument('--exclude-path', dest='exclude_path',
+                       help="exclude VMs by inventory path (Regular Expression, Case insensitive)\nSample: --exclude-path '/test/|/templates/'")
    parser.add_argument('-n', '--dryrun', dest='dryrun', default=False, action="store_true",
                        help="dry-run\nSample: --dryrun")
+   parser.add_argument('--parallel', dest='parallel', default=0, type=int,
+                       help="number of vCenters processed at the same time when -S names several (0 = all)\nSample: --parallel 4")
+   parser.add_argument('--cache', dest='cache', default=False, action="store_true",
+                       help="use the on-disk inventory cache and keep the vCenter session open for the next run\nSample: --cache")
+   parser.add_argument('--profile', dest='profile', nargs='?', const='',
+                       help="print SOAP calls, bytes and latency per phase and method at the end, or write them to a JSON file ({host} is replaced by the vCenter)\nSample: --profile profile-{host}.json")
    args = parser.parse_args()
    return args
 
 def renameVM(vm, original_name, new_name, dryrun, verbose):
-    if verbose: print("Renaming VM: {} -> {}".format(original_name, new_name))
+    """Returns the job for tasks.run_jobs() (None for a dryrun)"""
     if not dryrun:
-        task.WaitForTask(vm.Rename_Task(newName=new_name))
-        print("VM renamed: {} -> {}".format(original_name, new_name))
+        def start():
+            if verbose: print("Renaming VM: {} -> {}".format(original_name, new_name))
+            return vm.Rename_Task(newName=new_name)
+        def done(job, error):
+            if error is None:
+                print("VM renamed: {} -> {}".format(original_name, new_name))
+        return {'name': original_name, 'steps': [start], 'done': done}
     else:
         print("DRYRUN: Would rename VM: {} -> {}".format(original_name, new_name))
 
-def processVM(vm, args, verbose):
-    original_name = vm.name
+def processVM(vm, args, pattern, fields, verbose):
+    # vm is an inventory record, pattern the compiled --pattern, fields the fields of --template
+    original_name = vm['name']
     new_name = None
     
     # Check if we should add suffix/prefix
@@ -70,77 +99,112 @@ def processVM(vm, args, verbose):
     elif args.remove_prefix:
         if original_name.startswith(args.remove_prefix):
             new_name = original_name[len(args.remove_prefix):]
+    elif pattern:
+        new_name = pattern.sub(args.replace, original_name)
+    elif args.template:
+        new_name = args.template.format(**fields)
     
     if new_name and new_name != original_name:
         if verbose >= 1: print("  Processing VM: {} -> {}".format(original_name, new_name))
-        return (vm, new_name)
+        return new_name
     return None
 
+def rename_operations(args):
+    """Number of rename operations given (--suffix, --prefix, ...)"""
+    return sum(1 for op in (args.suffix, args.prefix, args.remove_suffix, args.remove_prefix, args.pattern, args.template) if op)
+
+def compile_rename(args):
+    """Check --pattern/--replace and --template, returns (compiled --pattern or None, error message or None)"""
+    if (args.pattern is None) != (args.replace is None):
+        return None, "--pattern and --replace must be given together"
+    pattern = None
+    if args.pattern:
+        try:
+            pattern = re.compile(args.pattern, re.IGNORECASE)
+            # checks the group references of --replace
+            pattern.sub(args.replace, '')
+        except re.error as e:
+            return None, "Invalid --pattern or --replace: " + args.pattern + " " + args.replace + " (" + str(e) + ")"
+    if args.template:
+        try:
+            args.template.format(name='', folder='', datacenter='')
+        except (KeyError, IndexError, ValueError) as e:
+            return None, "Invalid --template: " + args.template + " (" + str(e) + ")"
+    return pattern, None
+
 def main():
     args = GetArgs()
+    if fleet.is_fleet(args.host):
+        # one process per vCenter
+        return fleet.fan_out(args.host, args.parallel)
+    if args.profile is not None:
+        soap_profile.enable(args.profile or None, args.host)
+    vm_filters = vm_filter.from_args(args)
     
     # Validate that exactly one rename operation is specified
-    rename_ops = [args.suffix, args.prefix, args.remove_suffix, args.remove_prefix]
-    if sum(1 for op in rename_ops if op) != 1:
-        print("Error: Exactly one rename operation must be specified (--suffix, --prefix, --remove-suffix, or --remove-prefix)")
+    if rename_operations(args) != 1:
+        print("Error: Exactly one rename operation must be specified (--suffix, --prefix, --remove-suffix, --remove-prefix, --pattern or --template)")
+        return
+    pattern, error = compile_rename(args)
+    if error:
+        print("Error: " + error)
         return
     
     verbose = args.verbose
 
-    si = SmartConnect(host=args.host, user=args.user, pwd=args.password, disableSslCertValidation=True)
-    vm_list = []
+    vm_properties = inventory.VM_BASE_PROPERTIES
+    if args.cache:
+        si = inventory_cache.connect(args.host, args.user, args.password, verbose)
+    else:
+        si = SmartConnect(host=args.host, user=args.user, pwd=args.password, disableSslCertValidation=True)
+    soap_profile.attach(si)
+    soap_profile.set_phase('scan')
+    if args.cache:
+        inv = inventory_cache.load_inventory(si, vm_properties, verbose)
+    else:
+        inv = inventory.load_inventory(si, vm_properties)
+    soap_profile.set_phase('filter')
     datacenters = si.content.rootFolder.childEntity
-    threads = []
+    renames = []
     
     for datacenter in datacenters:
         if verbose >= 2: print("Datacenter: " + datacenter.name)
 
-        # List VMs
-        vm_view = si.content.viewManager.CreateContainerView(datacenter, [pyVmomi.vim.VirtualMachine], True)
-        vms_list = vm_view.view
-        vm_view.Destroy()
-
         # Loop through VMs
-        for vm in vms_list:
-            if verbose >= 2: print("VM: " + vm.name)
-            if not args.folder or (args.folder and re.search(args.folder, vm.parent.name+"/"+vm.parent.parent.name, re.IGNORECASE)):
-                if verbose >= 2: print("  VM Folder: " + vm.parent.name)
-                if not args.vm or (args.vm and re.search(args.vm, vm.name, re.IGNORECASE)):
-                    if verbose >= 2: print("  VM name: " + vm.name)
-                    if not (args.exclude and (args.exclude and re.search(args.exclude, vm.name, re.IGNORECASE))):
-                        if verbose >= 2: print("  VM not excluded: " + vm.name)
-                        # Check power state: if --poweredoff is set, only process powered off VMs
-                        if not args.poweredoff or (args.poweredoff and vm.runtime.powerState == "poweredOff"):
-                            if verbose >= 1: print("  Considering VM: " + vm.name + " (PowerState: " + vm.runtime.powerState + ")")
-                            result = processVM(vm, args, verbose)
-                            if result:
-                                vm_obj, new_name = result
-                                original_name = vm_obj.name
-                                if args.threads > 1:
-                                    # start a thread if we have less than args.threads
-                                    if len(threads) >= args.threads: 
-                                        print("Waiting for a thread to finish")
-                                    while len(threads) >= args.threads:
-                                        # wait for a thread to finish
-                                        print(".", end='', flush=True)
-                                        time.sleep(1)
-                                        for t in threads:
-                                            if not t.is_alive():
-                                                threads.remove(t)
-                                                break
-                                    t = threading.Thread(target=renameVM, args=(vm_obj, original_name, new_name, args.dryrun, verbose))
-                                    threads.append(t)
-                                    t.start()
-                                else:
-                                    renameVM(vm_obj, original_name, new_name, args.dryrun, verbose)
-
-    if args.threads > 1:
-        # wait for threads to finish
-        for t in threads:
-            t.join()
-
-    Disconnect(si)
+        for vm in inventory.vms_in_datacenter(inv, datacenter):
+            if verbose >= 2: print("VM: " + vm['name'])
+            if vm_filters.matches(vm):
+                if verbose >= 2: print("  VM Path: " + vm['path'])
+                if not vm_filters.excluded(vm):
+                    if verbose >= 2: print("  VM not excluded: " + vm['name'])
+                    # Check power state: if --poweredoff is set, only process powered off VMs
+                    if not args.poweredoff or (args.poweredoff and vm['powerState'] == "poweredOff"):
+                        if verbose >= 1: print("  Considering VM: " + vm['name'] + " (PowerState: " + vm['powerState'] + ")")
+                        new_name = processVM(vm, args, pattern, rename_plan.name_fields(inv, vm), verbose)
+                        if new_name:
+                            renames.append((vm, new_name))
+
+    # Check the new names against the names in each folder before any task runs
+    soap_profile.set_phase('plan')
+    planned, rejected = rename_plan.plan(inv['vms'], renames, args.conflict)
+    for vm, new_name in rejected:
+        print("Not renaming VM: {} -> {} (name already used in the folder)".format(vm['name'], new_name))
+    jobs = []
+    for vm, new_name in planned:
+        job = renameVM(vm['obj'], vm['name'], new_name, args.dryrun, verbose)
+        if job:
+            jobs.append(job)
+
+    # Run the renames, at most args.threads tasks at the same time
+    soap_profile.set_phase('execute')
+    failed = tasks.run_jobs(si, jobs, args.threads, verbose)
+    soap_profile.report()
+
+    if not args.cache:
+        # with --cache the session is kept for the next run
+        Disconnect(si)
+    return 1 if failed or rejected else 0
 
 
 if __name__ == "__main__":
-   main()
+   sys.exit(main())
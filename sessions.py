@@ -0,0 +1,104 @@
+"""Pooled vCenter session with keepalive and re-login.
+
+SessionPool is a pyVmomi stub adapter on top of several SOAP stubs that
+share the cookie of one authenticated session. Every worker thread of
+tasks.run_jobs() gets its own stub, so calls of different workers do not
+queue behind each other, and managed objects returned by a call are bound
+to the pool again. A keepalive thread calls CurrentTime() so the session
+does not expire while the workers wait for long tasks, and a call that
+fails with NotAuthenticated logs in again and is retried once.
+"""
+
+import itertools
+import threading
+
+from pyVmomi import vim
+from pyVmomi.SoapAdapter import StubAdapterBase
+from pyVim.connect import SmartConnect
+
+# SOAP stubs (HTTP connections) of a pool
+POOL_SIZE = 4
+# Seconds between two keepalive calls (vCenter drops idle sessions after 30 minutes)
+KEEPALIVE_SECONDS = 300
+
+
+class SessionPool(StubAdapterBase):
+    """Stub adapter spreading the calls of the worker threads over several stubs"""
+
+    def __init__(self, si, host, user, password, size=POOL_SIZE):
+        stub = si._stub
+        StubAdapterBase.__init__(self, version=stub.version)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.stubs = [stub]
+        for i in range(size - 1):
+            # same session, separate HTTP connection
+            self.stubs.append(SmartConnect(host=host, sessionId=stub.GetSessionId(),
+                                           disableSslCertValidation=True)._stub)
+        self.local = threading.local()
+        self.next_stub = itertools.cycle(self.stubs)
+        self.lock = threading.Lock()
+        # number of logins so far; a call that fails with NotAuthenticated
+        # logs in only if nobody did since the call started
+        self.generation = 0
+        self.stopped = threading.Event()
+
+    def stub(self):
+        """Stub of the calling thread"""
+        stub = getattr(self.local, 'stub', None)
+        if stub is None:
+            with self.lock:
+                stub = self.local.stub = next(self.next_stub)
+        return stub
+
+    def InvokeMethod(self, mo, info, args):
+        stub = self.stub()
+        generation = self.generation
+        status, obj = stub.InvokeMethod(mo, info, args, self)
+        if status != 200 and isinstance(obj, vim.fault.NotAuthenticated):
+            self.relogin(generation)
+            status, obj = stub.InvokeMethod(mo, info, args, self)
+        if status != 200:
+            raise obj
+        return obj
+
+    def relogin(self, generation):
+        """Log in again after the session of login generation expired"""
+        with self.lock:
+            if self.generation != generation:
+                # another worker already logged in again
+                return
+            print("vCenter session expired, logging in again")
+            # bound to the first stub, which takes the new cookie from the response
+            vim.SessionManager('SessionManager', self.stubs[0]).Login(self.user, self.password)
+            for stub in self.stubs[1:]:
+                stub.cookie = self.stubs[0].cookie
+            self.generation += 1
+
+    def GetSessionId(self):
+        return self.stubs[0].GetSessionId()
+
+    def DropConnections(self):
+        self.stopped.set()
+        for stub in self.stubs:
+            stub.DropConnections()
+
+    def keepalive(self, interval=KEEPALIVE_SECONDS):
+        """Start a thread that keeps the session alive until DropConnections()"""
+        si = vim.ServiceInstance('ServiceInstance', self)
+        def run():
+            while not self.stopped.wait(interval):
+                try:
+                    si.CurrentTime()
+                except Exception as e:
+                    print("vCenter keepalive failed: " + str(e))
+        thread = threading.Thread(target=run, name='vcenter-keepalive', daemon=True)
+        thread.start()
+
+
+def pool(si, host, user, password, size=POOL_SIZE):
+    """ServiceInstance of a new SessionPool on the session of si, with keepalive"""
+    session_pool = SessionPool(si, host, user, password, size)
+    session_pool.keepalive()
+    return vim.ServiceInstance('ServiceInstance', session_pool)
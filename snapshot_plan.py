@@ -0,0 +1,88 @@
+"""Snapshot removal plan of a VM.
+
+The selection (all snapshots, one snapshot by name with its children, the
+snapshots older than some days) is a set of snapshot moIds. plan() turns
+it into the fewest removal tasks that do not overlap: one
+RemoveAllSnapshots when every snapshot is selected, RemoveSnapshot_Task
+with removeChildren for a snapshot whose whole subtree is selected, and
+RemoveSnapshot_Task without children for a selected snapshot that has
+children to keep. No snapshot is removed twice, and the tasks of a VM run
+one after the other, so every removal consolidates its disks only once.
+
+The functions work on the plain snapshot records of inventory.py.
+"""
+
+import datetime
+
+REMOVE_ALL = 'removeAll'
+REMOVE = 'remove'
+
+
+def walk(snapshots):
+    """All snapshot records of a tree, parents before their children"""
+    stack = list(reversed(snapshots))
+    while stack:
+        snapshot = stack.pop()
+        yield snapshot
+        stack.extend(reversed(snapshot['children']))
+
+
+def select_all(snapshots):
+    return set(snapshot['snapshot'] for snapshot in walk(snapshots))
+
+
+def select_name(snapshots, name):
+    """The snapshot named name and its children, nothing if the name is not unique"""
+    matches = [snapshot for snapshot in walk(snapshots) if snapshot['name'] == name]
+    if len(matches) != 1:
+        return set()
+    return select_all(matches)
+
+
+def create_time(snapshot):
+    # the inventory keeps the timezone of the vCenter (UTC); naive times are taken as UTC
+    created = snapshot['createTime']
+    if isinstance(created, str):
+        created = datetime.datetime.fromisoformat(created.replace('Z', '+00:00'))
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=datetime.timezone.utc)
+    return created
+
+
+def select_older(snapshots, days, now=None):
+    """Snapshots created more than days ago"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(days=days)
+    return set(snapshot['snapshot'] for snapshot in walk(snapshots) if create_time(snapshot) < cutoff)
+
+
+def removed_bytes(vm, selected):
+    """Delta bytes consolidated by removing the selected snapshots of vm (inventory record with layoutEx)"""
+    return sum(vm['snapshotSizes'].get(moid, 0) for moid in selected)
+
+
+def plan(snapshots, selected):
+    """Removal operations for the snapshots with the moIds in selected
+
+    Returns a list of (REMOVE_ALL, None, None) or (REMOVE, snapshot record,
+    removeChildren), to be run in this order.
+    """
+    # moId -> the snapshot and all of its children are selected
+    whole = {}
+    for snapshot in reversed(list(walk(snapshots))):
+        whole[snapshot['snapshot']] = snapshot['snapshot'] in selected and \
+            all(whole[child['snapshot']] for child in snapshot['children'])
+    if snapshots and all(whole[snapshot['snapshot']] for snapshot in snapshots):
+        return [(REMOVE_ALL, None, None)]
+    operations = []
+    stack = list(reversed(snapshots))
+    while stack:
+        snapshot = stack.pop()
+        if whole[snapshot['snapshot']]:
+            # the children go with it
+            operations.append((REMOVE, snapshot, bool(snapshot['children'])))
+            continue
+        if snapshot['snapshot'] in selected:
+            operations.append((REMOVE, snapshot, False))
+        stack.extend(reversed(snapshot['children']))
+    return operations
@@ -0,0 +1,225 @@
+"""SOAP round-trip profiling for --profile.
+
+attach() hooks into the SOAP stubs of a connection (the stub SmartConnect
+created and the stubs of a sessions.SessionPool). Every call is counted
+with its latency and the bytes sent and received, per managed object type
+and method, and attributed to the phase the script is in: connect, scan
+(inventory load), filter (selecting the VMs), plan, execute (starting the
+tasks) and wait (TaskMonitor waiting for the tasks). Property reads of
+managed objects show up as 'Fetch <property>', e.g. a loop over
+vm.parent.parent.name. The wall time of each phase is recorded as well,
+so time spent outside of SOAP calls (sleeps, local work) shows up as the
+difference. report() prints the summary table or writes it as JSON.
+
+All functions do nothing unless enable() was called.
+"""
+
+import contextlib
+import http.client
+import json
+import threading
+import time
+
+PHASES = ('connect', 'scan', 'filter', 'plan', 'execute', 'wait')
+
+_profiler = None
+
+
+class _CountingFile:
+    """Socket file of an HTTP response, counts the bytes read from it"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def _count(self, n):
+        local = _profiler.local if _profiler else None
+        if local is not None and hasattr(local, 'received'):
+            local.received += n
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self._count(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self.fp.read1(*args)
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.fp.readline(*args)
+        self._count(len(data))
+        return data
+
+    def readinto(self, buffer):
+        n = self.fp.readinto(buffer)
+        self._count(n or 0)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class _CountingResponse(http.client.HTTPResponse):
+
+    def __init__(self, sock, *args, **kwargs):
+        http.client.HTTPResponse.__init__(self, sock, *args, **kwargs)
+        self.fp = _CountingFile(self.fp)
+
+
+class Profiler:
+    """Calls, bytes and latency per (phase, managed object type, method)"""
+
+    def __init__(self, path=None, host=None):
+        self.path = path
+        self.host = host
+        self.lock = threading.Lock()
+        # per thread: phase override and the bytes of the running call
+        self.local = threading.local()
+        self.phase = 'connect'
+        self.phase_started = time.time()
+        self.phase_seconds = {}
+        # (phase, type, method) -> counters
+        self.calls = {}
+
+    def current_phase(self):
+        return getattr(self.local, 'phase', None) or self.phase
+
+    def set_phase(self, name):
+        with self.lock:
+            now = time.time()
+            self.phase_seconds[self.phase] = self.phase_seconds.get(self.phase, 0) + now - self.phase_started
+            self.phase = name
+            self.phase_started = now
+
+    def record(self, phase, mo_type, method, seconds, error, sent, received):
+        with self.lock:
+            entry = self.calls.setdefault((phase, mo_type, method), {
+                'calls': 0, 'errors': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'sent': 0, 'received': 0})
+            entry['calls'] += 1
+            entry['errors'] += 1 if error else 0
+            entry['seconds'] += seconds
+            entry['maxSeconds'] = max(entry['maxSeconds'], seconds)
+            entry['sent'] += sent
+            entry['received'] += received
+
+    def instrument(self, stub):
+        """Wrap InvokeMethod of one SOAP stub (property reads go through it as well)"""
+        if getattr(stub, '_profiled', False):
+            return
+        stub._profiled = True
+        invoke = stub.InvokeMethod
+        local = self.local
+
+        def InvokeMethod(mo, info, args, outerStub=None):
+            method = info.wsdlName
+            if method == 'Fetch':
+                method += ' ' + str(args[0])
+            local.sent = local.received = 0
+            error = True
+            started = time.time()
+            try:
+                result = invoke(mo, info, args, outerStub)
+                # with an outerStub the stub returns (status, obj) instead of raising the fault
+                error = outerStub is not None and result[0] != 200
+                return result
+            finally:
+                self.record(self.current_phase(), mo._wsdlName, method, time.time() - started, error,
+                            local.sent, local.received)
+                del local.sent, local.received
+
+        stub.InvokeMethod = InvokeMethod
+        if hasattr(stub, 'requestModifierList'):
+            # SoapStubAdapter: count the serialized request and the HTTP response
+            def count_request(request):
+                local.sent += len(request)
+                return request
+            stub.requestModifierList.append(count_request)
+            get_connection = stub.GetConnection
+
+            def GetConnection():
+                conn = get_connection()
+                conn.response_class = _CountingResponse
+                return conn
+            stub.GetConnection = GetConnection
+
+    def summary(self):
+        self.set_phase(self.phase)
+        phases = {}
+        for (phase, mo_type, method), entry in self.calls.items():
+            total = phases.setdefault(phase, {'wall': 0.0, 'calls': 0, 'seconds': 0.0, 'sent': 0, 'received': 0})
+            for key in ('calls', 'seconds', 'sent', 'received'):
+                total[key] += entry[key]
+        for phase, seconds in self.phase_seconds.items():
+            phases.setdefault(phase, {'wall': 0.0, 'calls': 0, 'seconds': 0.0, 'sent': 0, 'received': 0})
+            phases[phase]['wall'] = seconds
+        calls = []
+        for (phase, mo_type, method), entry in self.calls.items():
+            calls.append(dict(entry, phase=phase, type=mo_type, method=method))
+        order = lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES)
+        calls.sort(key=lambda call: (order(call['phase']), -call['seconds']))
+        return {'host': self.host, 'phases': dict(sorted(phases.items(), key=lambda item: order(item[0]))),
+                'calls': calls}
+
+    def report(self):
+        data = self.summary()
+        if self.path:
+            path = self.path.replace('{host}', self.host or '')
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=1)
+            print("SOAP profile written to " + path)
+            return
+        print("")
+        print("SOAP profile:")
+        print("  %-8s %9s %7s %9s %10s %10s" % ('phase', 'wall s', 'calls', 'SOAP s', 'sent KB', 'recv KB'))
+        for phase, total in data['phases'].items():
+            print("  %-8s %9.2f %7d %9.2f %10.1f %10.1f" % (phase, total['wall'], total['calls'], total['seconds'],
+                                                       total['sent'] / 1024.0, total['received'] / 1024.0))
+        print("")
+        print("  %-8s %-22s %-30s %7s %6s %9s %8s %8s %10s %10s" % (
+            'phase', 'type', 'method', 'calls', 'errors', 'total s', 'avg ms', 'max ms', 'sent KB', 'recv KB'))
+        for call in data['calls']:
+            print("  %-8s %-22s %-30s %7d %6d %9.2f %8.1f %8.1f %10.1f %10.1f" % (
+                call['phase'], call['type'], call['method'], call['calls'], call['errors'], call['seconds'],
+                call['seconds'] / call['calls'] * 1000, call['maxSeconds'] * 1000,
+                call['sent'] / 1024.0, call['received'] / 1024.0))
+
+
+def enable(path=None, host=None):
+    """Start profiling; report() writes JSON to path ({host} is replaced) or prints a table"""
+    global _profiler
+    _profiler = Profiler(path, host)
+
+
+def attach(si):
+    """Profile the SOAP calls of si (call again after sessions.pool())"""
+    if _profiler is None:
+        return
+    stub = si._stub
+    for s in getattr(stub, 'stubs', [stub]):
+        _profiler.instrument(s)
+
+
+def set_phase(name):
+    """The script entered phase name"""
+    if _profiler is not None:
+        _profiler.set_phase(name)
+
+
+@contextlib.contextmanager
+def thread_phase(name):
+    """Attribute the calls of the current thread to phase name"""
+    if _profiler is None:
+        yield
+        return
+    previous = getattr(_profiler.local, 'phase', None)
+    _profiler.local.phase = name
+    try:
+        yield
+    finally:
+        _profiler.local.phase = previous
+
+
+def report():
+    if _profiler is not None:
+        _profiler.report()
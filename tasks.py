@@ -0,0 +1,500 @@
+"""Execution engine for vCenter tasks shared by the scripts.
+
+TaskMonitor watches all in-flight tasks through a single PropertyCollector
+filter on a ListView, so one blocking WaitForUpdatesEx call reports every
+task that finished. run_jobs() drives the jobs of a script from an asyncio
+event loop: the blocking pyVmomi calls (starting a task, converting a
+template, ...) run on a bounded thread pool, the jobs await the completion
+of their tasks, and a slot is refilled the moment its task completes. The
+number of SOAP calls in flight and the number of running vCenter tasks are
+capped separately, so thousands of VMs need neither thousands of threads
+nor sleep loops.
+
+Besides the global limit, run_jobs() can cap the number of jobs sharing a
+resource (a source or destination datastore, an ESXi host, ...), so the
+queue skips jobs whose datastore or host is already busy.
+
+run_job_stream() starts the jobs while their source (e.g. the inventory
+scan) still produces more of them.
+
+chain_jobs() turns several jobs of one VM into one, so they run in order
+and never at the same time.
+
+QuestionWatcher answers the questions a VM asks while one of its tasks
+waits (runtime.question), e.g. whether to disconnect a CD-ROM the guest
+has locked.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+import soap_profile
+
+# Seconds one WaitForUpdatesEx call may block before it is reissued
+WAIT_SECONDS = 60
+# Blocking SOAP calls (task starts, template conversions, ...) at the same time
+SOAP_LIMIT = 8
+
+
+class TaskMonitor:
+    """Watch info.state of a changing set of tasks with one filter
+
+    on_progress(data, percent) is called when info.progress of a task changes.
+    """
+
+    def __init__(self, si, on_progress=None):
+        self.si = si
+        self.tasks = {}
+        self.on_progress = on_progress
+        # add() runs on the worker threads of run_jobs() while wait() may renew the view
+        self.lock = threading.Lock()
+        self._create()
+
+    def _create(self):
+        # collector and view live as long as the session
+        content = self.si.content
+        self.pc = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateListView(obj=[task for task, data in list(self.tasks.values())])
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseList', path='view', skip=False, type=vim.view.ListView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=self.view, skip=True, selectSet=[traversal])
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.Task, pathSet=['info.state', 'info.error', 'info.progress'], all=False)
+        self.pc.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec]),
+                             partialUpdates=True)
+        self.version = ''
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task, data=None):
+        """Watch task; data is handed back when the task finishes"""
+        with self.lock:
+            self.tasks[task._moId] = (task, data)
+            self.view.ModifyListView(add=[task])
+
+    def wait(self, timeout=None):
+        """Block until at least one task finished (or timeout seconds passed)
+
+        Returns a list of (task, state, error, data) for the finished tasks.
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=WAIT_SECONDS if timeout is None else timeout)
+        finished = []
+        while not finished and self.tasks:
+            try:
+                update = self.pc.WaitForUpdatesEx(self.version, options)
+            except vmodl.fault.ManagedObjectNotFound:
+                # the session was renewed (sessions.SessionPool), watch the tasks with a new collector
+                with self.lock:
+                    self._create()
+                continue
+            if update is None:
+                if timeout is not None:
+                    break
+                continue
+            self.version = update.version
+            for filter_update in update.filterSet or []:
+                for obj_update in filter_update.objectSet or []:
+                    if obj_update.kind == 'leave':
+                        continue
+                    changes = {}
+                    for change in obj_update.changeSet or []:
+                        changes[change.name] = change.val
+                    state = changes.get('info.state')
+                    moid = obj_update.obj._moId
+                    if self.on_progress and changes.get('info.progress') is not None and moid in self.tasks:
+                        self.on_progress(self.tasks[moid][1], changes['info.progress'])
+                    if state in (vim.TaskInfo.State.success, vim.TaskInfo.State.error) and moid in self.tasks:
+                        task, data = self.tasks.pop(moid)
+                        error = changes.get('info.error')
+                        if state == vim.TaskInfo.State.error and error is None:
+                            error = task.info.error
+                        finished.append((task, state, error, data))
+        if finished:
+            self.view.ModifyListView(remove=[task for task, state, error, data in finished])
+        return finished
+
+    def close(self):
+        try:
+            self.pc.DestroyPropertyCollector()
+            self.view.DestroyView()
+        except vmodl.MethodFault:
+            pass
+
+
+# Message of the question a reconfiguration asks when the guest locked the CD-ROM door
+CDROM_LOCKED = 'msg.cdromdisconnect.locked'
+# Seconds a question may wait for an operator before QuestionWatcher gives its default answer
+QUESTION_TIMEOUT = 600
+
+
+class QuestionWatcher:
+    """Answer runtime.question of a set of VMs from a background thread
+
+    answers maps a message id (e.g. CDROM_LOCKED) to the label of the
+    choice to answer with ('yes' or 'no'). Other questions are printed
+    once and left for an operator. A CD-ROM lock question raised during
+    the run (by our reconfigure) that is still open after timeout seconds
+    gets its default answer (no, the task fails), so it does not block
+    the run; questions that were open before, or ask something else
+    (e.g. Retry/Cancel when a datastore is full), are never answered
+    without a policy. Like TaskMonitor it watches the VMs with one filter
+    on a ListView, so a waiting question costs no polling.
+    """
+
+    def __init__(self, si, vms, answers=None, verbose=False, timeout=QUESTION_TIMEOUT):
+        self.answers = answers or {}
+        self.verbose = verbose
+        self.timeout = timeout
+        # VM moId -> (VirtualMachine, question, time it was seen) of the questions left to an operator
+        self.waiting = {}
+        content = si.content
+        self.pc = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateListView(obj=list(vms))
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseList', path='view', skip=False, type=vim.view.ListView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=self.view, skip=True, selectSet=[traversal])
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=['name', 'runtime.question'], all=False)
+        self.pc.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec]),
+                             partialUpdates=False)
+        self.names = {}
+        # wake up in time to give the default answers
+        self.options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=max(1, int(min(WAIT_SECONDS, self.timeout))))
+        # the questions open before the run are seen with the first update
+        self.initial = True
+        self.version = ''
+        self._update(self.pc.WaitForUpdatesEx(self.version, self.options))
+        self.initial = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                update = self.pc.WaitForUpdatesEx(self.version, self.options)
+            except vmodl.MethodFault:
+                # cancelled by close() or the collector is gone with the session
+                return
+            self._update(update)
+            self._expire()
+
+    def _update(self, update):
+        if update is None:
+            return
+        self.version = update.version
+        for filter_update in update.filterSet or []:
+            for obj_update in filter_update.objectSet or []:
+                changes = dict((change.name, change.val) for change in obj_update.changeSet or [])
+                if 'name' in changes:
+                    self.names[obj_update.obj._moId] = changes['name']
+                if 'runtime.question' in changes:
+                    # answered (by us or in the vSphere client) or a new question
+                    self.waiting.pop(obj_update.obj._moId, None)
+                    if changes['runtime.question'] is not None:
+                        self._answer(obj_update.obj, changes['runtime.question'])
+
+    def _answer(self, vm, question):
+        name = self.names.get(vm._moId, vm._moId)
+        message_ids = [message.id for message in question.message or []]
+        answer = None
+        for message_id in message_ids:
+            answer = answer or self.answers.get(message_id)
+        choice = None
+        for info in question.choice.choiceInfo if answer and question.choice else []:
+            # choices are labelled button.yes / button.no
+            if answer in (info.key, info.label.lower().replace('button.', ''), (info.summary or '').lower()):
+                choice = info.key
+        if choice is None:
+            print("  VM " + name + " waits for an answer: " + (question.text or ', '.join(message_ids)))
+            if not self.initial and CDROM_LOCKED in message_ids:
+                self.waiting[vm._moId] = (vm, question, time.time())
+            return
+        if self.verbose: print("  Answering '" + answer + "' on VM " + name + ": " + ', '.join(message_ids))
+        self._send(vm, name, question, choice)
+
+    def _expire(self):
+        # default answer for the CD-ROM lock questions nobody answered within timeout seconds
+        now = time.time()
+        for moid, (vm, question, since) in list(self.waiting.items()):
+            if now - since < self.timeout:
+                continue
+            del self.waiting[moid]
+            name = self.names.get(moid, moid)
+            choices = question.choice.choiceInfo if question.choice else []
+            if not choices:
+                continue
+            default = choices[question.choice.defaultIndex or 0]
+            print("  VM " + name + ": no answer after " + str(int(self.timeout)) + " seconds, answering '"
+                  + (default.summary or default.label) + "'")
+            self._send(vm, name, question, default.key)
+
+    def _send(self, vm, name, question, choice):
+        try:
+            vm.AnswerVM(questionId=question.id, answerChoice=choice)
+        except vmodl.MethodFault as e:
+            # answered in the meantime
+            print("  Could not answer the question of VM " + name + ": " + (e.msg or type(e).__name__))
+
+    def close(self):
+        self.stopped.set()
+        try:
+            self.pc.CancelWaitForUpdates()
+        except vmodl.MethodFault:
+            pass
+        self.thread.join()
+        try:
+            self.pc.DestroyPropertyCollector()
+            self.view.DestroyView()
+        except vmodl.MethodFault:
+            pass
+
+
+def run_jobs(si, jobs, limit, verbose=False, limits=None, on_progress=None, soap_limit=SOAP_LIMIT):
+    """Run jobs with at most limit vCenter tasks at the same time
+
+    A job is a dict with
+      'name':  name used in messages (usually the VM name)
+      'steps': list of functions that each start one vCenter task and return
+               it (or None if there is nothing to wait for). The steps of a job
+               run one after the other, so a job never has two active tasks.
+      'done':  optional function(job, error) called after the last step or
+               after the first failed step (error is None on success)
+      'resources': optional list of (kind, id) tuples the job occupies while
+               it runs, e.g. ('src', 'datastore-12') or ('host', 'host-7')
+    limits maps a resource kind to the maximum number of jobs running on one
+    resource of that kind at the same time (0/None: no limit). Jobs are
+    started in queue order, skipping those whose resources are at the limit.
+    on_progress(job, percent) is called when the progress of a task changes.
+    Steps and 'done' run on a pool of soap_limit threads, so they may run
+    concurrently with each other and with on_progress.
+    Returns the list of failed jobs.
+    """
+    if not jobs:
+        return []
+    runner = JobRunner(si, limit, verbose, limits, on_progress, soap_limit)
+    return asyncio.run(runner.run(jobs))
+
+
+def run_job_stream(si, source, limit, verbose=False, limits=None, on_progress=None, queue_size=None,
+                   soap_limit=SOAP_LIMIT):
+    """Like run_jobs(), but the jobs come from the iterator source while the first ones run
+
+    source is advanced on the SOAP thread pool (it may scan the inventory
+    page by page), and every job it yields can start at once. At most
+    queue_size jobs (default: 2 * limit) wait for a slot; while the queue
+    is full the source is not advanced, so a fast scan does not run ahead
+    of the tasks. Returns the list of failed jobs.
+    """
+    runner = JobRunner(si, limit, verbose, limits, on_progress, soap_limit)
+    return asyncio.run(runner.run([], source, queue_size or 2 * limit))
+
+
+def chain_jobs(jobs, skipped=None):
+    """One job running the jobs of one VM (e.g. the stages of pipeline.py) one after the other
+
+    The 'done' of a job is called as soon as its last step finished, or with
+    the error of the first failed step; the jobs after a failed one do not
+    run, skipped(job) is called for each of them. The chained job occupies
+    the resources of all jobs for its whole run, its 'name' is that of the
+    first job.
+    """
+    # the job whose step runs (None between two jobs), the number of jobs started
+    current = [None]
+    started = [0]
+    steps = []
+    for index, job in enumerate(jobs):
+        for step in job['steps']:
+            def start(job=job, step=step, index=index):
+                current[0] = job
+                started[0] = index + 1
+                return step()
+            steps.append(start)
+        def finish(job=job):
+            current[0] = None
+            if job.get('done'):
+                job['done'](job, None)
+        steps.append(finish)
+    def done(chained, error):
+        if error is None:
+            return
+        if current[0] is not None and current[0].get('done'):
+            current[0]['done'](current[0], error)
+        if skipped:
+            for job in jobs[started[0]:]:
+                skipped(job)
+    resources = []
+    for job in jobs:
+        resources.extend(job.get('resources', []))
+    return {'name': jobs[0]['name'], 'steps': steps, 'done': done, 'resources': resources}
+
+
+def error_message(error):
+    """Message of a MethodFault or another exception"""
+    return getattr(error, 'msg', None) or str(error) or type(error).__name__
+
+
+class JobRunner:
+    """asyncio engine behind run_jobs()"""
+
+    def __init__(self, si, limit, verbose=False, limits=None, on_progress=None, soap_limit=SOAP_LIMIT):
+        self.limit = limit
+        self.verbose = verbose
+        self.limits = limits or {}
+        self.on_progress = on_progress
+        self.monitor = TaskMonitor(si, on_progress and self._progress)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=soap_limit)
+        # WaitForUpdatesEx blocks up to WAIT_SECONDS, it gets its own thread
+        self.wait_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.in_use = collections.Counter()
+        self.failed = []
+        self.added = None
+
+    def _progress(self, data, percent):
+        job, future = data
+        self.on_progress(job, percent)
+
+    async def call(self, fn, *args):
+        """Run a blocking pyVmomi call on the SOAP thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def wait_task(self, task, job):
+        """Wait until task finished, returns (state, error)"""
+        future = asyncio.get_running_loop().create_future()
+        await self.call(self.monitor.add, task, (job, future))
+        self.added.set()
+        return await future
+
+    async def watch(self):
+        # hand the tasks finished in the vCenter to the jobs waiting for them
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self.added.wait()
+                for t, state, error, (job, future) in await loop.run_in_executor(self.wait_executor, self._wait):
+                    if not future.done():
+                        future.set_result((state, error))
+                if not len(self.monitor):
+                    self.added.clear()
+        except Exception as e:
+            for t, (job, future) in list(self.monitor.tasks.values()):
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    def _wait(self):
+        with soap_profile.thread_phase('wait'):
+            return self.monitor.wait()
+
+    def can_start(self, job):
+        for resource in job.get('resources', []):
+            if self.limits.get(resource[0]) and self.in_use[resource] >= self.limits[resource[0]]:
+                return False
+        return True
+
+    async def run_job(self, job):
+        # the resources were reserved by run() when the job was started
+        error = None
+        try:
+            while job['steps']:
+                step = job['steps'].pop(0)
+                try:
+                    t = await self.call(step)
+                except vmodl.MethodFault as e:
+                    error = e
+                    break
+                if t is not None:
+                    try:
+                        state, task_error = await self.wait_task(t, job)
+                    except (vmodl.MethodFault, OSError) as e:
+                        # the task runs on, but its result is unknown
+                        error = e
+                        break
+                    if state == vim.TaskInfo.State.error:
+                        error = task_error
+                        break
+        finally:
+            for resource in set(job.get('resources', [])):
+                self.in_use[resource] -= 1
+        if error is not None:
+            print("  Task failed: " + job['name'] + ": " + error_message(error))
+            self.failed.append(job)
+        if job.get('done'):
+            try:
+                await self.call(job['done'], job, error)
+            except Exception as e:
+                # e.g. MarkAsTemplate or the journal write failed, the other jobs go on
+                print("  Job failed: " + job['name'] + ": " + error_message(e))
+                if error is None:
+                    self.failed.append(job)
+
+    async def produce(self, source, queue, queue_size):
+        # move the jobs of source to the queue, pausing while queue_size jobs wait
+        end = object()
+        jobs = iter(source)
+        while True:
+            while len(queue) >= queue_size:
+                self.room.clear()
+                await self.room.wait()
+            job = await self.call(next, jobs, end)
+            if job is end:
+                return
+            queue.append(job)
+            self.queued.set()
+
+    async def run(self, jobs, source=None, queue_size=None):
+        self.added = asyncio.Event()
+        watcher = asyncio.ensure_future(self.watch())
+        queue = list(jobs)
+        running = set()
+        producer = None
+        queued = None
+        if source is not None:
+            self.queued = asyncio.Event()
+            self.room = asyncio.Event()
+            producer = asyncio.ensure_future(self.produce(source, queue, queue_size))
+        try:
+            while queue or running or (producer and not producer.done()):
+                while queue and len(running) < self.limit:
+                    index = next((i for i, job in enumerate(queue) if self.can_start(job)), None)
+                    if index is None:
+                        break
+                    job = queue.pop(index)
+                    for resource in set(job.get('resources', [])):
+                        self.in_use[resource] += 1
+                    running.add(asyncio.ensure_future(self.run_job(job)))
+                if self.verbose: print("    Running jobs: " + str(len(running)) + "/" + str(self.limit) + ", queued: " + str(len(queue)))
+                waits = running | {watcher}
+                if producer is not None:
+                    # wake up when the source queued a job or ended
+                    self.room.set()
+                    self.queued.clear()
+                    if not producer.done():
+                        queued = asyncio.ensure_future(self.queued.wait())
+                        waits |= {producer, queued}
+                finished, pending = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+                if queued is not None:
+                    queued.cancel()
+                for job_future in finished:
+                    # raises the exception of a job, of the watcher or of the source that crashed
+                    job_future.result()
+                running = running - finished
+        finally:
+            watcher.cancel()
+            for job_future in running:
+                job_future.cancel()
+            if producer is not None:
+                producer.cancel()
+            await asyncio.gather(watcher, *running, *([producer] if producer else []), return_exceptions=True)
+            self.monitor.close()
+            self.executor.shutdown(wait=False)
+            self.wait_executor.shutdown(wait=False)
+        return self.failed
@@ -0,0 +1,183 @@
+"""Throughput telemetry for datastore migrations.
+
+Tracks bytes, duration and throughput of every relocation (per VM and per
+source/destination datastore pair), estimates the remaining time of the
+whole batch from task.info.progress of the running relocations and writes
+the results to a JSONL file and, optionally, a Prometheus textfile.
+"""
+
+import json
+import os
+import threading
+import time
+
+# Seconds between two live status lines
+STATUS_INTERVAL = 30
+
+
+def format_bytes(value):
+    if value >= 1024 ** 4:
+        return "%.2f TB" % (value / 1024.0 ** 4)
+    if value >= 1024 ** 3:
+        return "%.2f GB" % (value / 1024.0 ** 3)
+    return "%.2f MB" % (value / 1024.0 ** 2)
+
+
+def source_label(vm, disks=None):
+    """Names of the datastores the disks with the keys in disks (None: all of the VM's disks) are on"""
+    return '+'.join(sorted(set(disk['datastoreName'] for disk in vm['disks'] if disks is None or disk['key'] in disks)))
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+class MigrationTelemetry:
+    """Collects the throughput of a batch of relocations
+
+    The methods may be called from the worker threads of tasks.run_jobs().
+    """
+
+    def __init__(self, total_bytes, jsonl_path=None, prom_path=None):
+        self.total_bytes = total_bytes
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.started = time.time()
+        self.last_status = 0
+        self.done_bytes = 0
+        self.running = {}
+        # (src, dst) -> {'bytes', 'seconds', 'vms', 'failed'}
+        self.pairs = {}
+        self.lock = threading.RLock()
+
+    def add(self, size):
+        """size more bytes planned, for a batch that grows while it runs"""
+        with self.lock:
+            self.total_bytes += size
+
+    def start(self, vm, src, dst, size):
+        """A relocation of size bytes from datastore src to dst started"""
+        with self.lock:
+            self.running[vm['moid']] = {'name': vm['name'], 'src': src, 'dst': dst,
+                                        'bytes': size, 'start': time.time(), 'progress': 0}
+
+    def progress(self, vm, percent):
+        """task.info.progress of a running relocation changed"""
+        with self.lock:
+            entry = self.running.get(vm['moid'])
+            # percent is info.progress of the task as TaskMonitor delivers it, an
+            # int 0-100; it is not set (None) while the task is queued
+            if entry is not None and isinstance(percent, (int, float)):
+                entry['progress'] = percent
+            self.print_status()
+
+    def finish(self, vm, error=None):
+        with self.lock:
+            self._finish(vm, error)
+
+    def _finish(self, vm, error):
+        entry = self.running.pop(vm['moid'], None)
+        if entry is None:
+            return
+        duration = max(time.time() - entry['start'], 0.001)
+        pair = self.pairs.setdefault((entry['src'], entry['dst']), {'bytes': 0, 'seconds': 0, 'vms': 0, 'failed': 0})
+        if error is None:
+            self.done_bytes += entry['bytes']
+            pair['bytes'] += entry['bytes']
+            pair['seconds'] += duration
+            pair['vms'] += 1
+        else:
+            # the VM is not going to be copied anymore
+            self.total_bytes -= entry['bytes']
+            pair['failed'] += 1
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'vm': entry['name'],
+            'moid': vm['moid'],
+            'src': entry['src'],
+            'dst': entry['dst'],
+            'bytes': entry['bytes'],
+            'seconds': round(duration, 1),
+            'result': 'success' if error is None else 'error',
+        }
+        if error is not None:
+            record['error'] = getattr(error, 'msg', None) or str(error) or type(error).__name__
+        else:
+            record['bytesPerSecond'] = round(entry['bytes'] / duration)
+            print("    VM migrated: %s, %s in %s (%s/h)" % (
+                entry['name'], format_bytes(entry['bytes']), format_duration(duration),
+                format_bytes(entry['bytes'] / duration * 3600)))
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        self.print_status(force=True)
+
+    def copied_bytes(self):
+        """Bytes copied so far, including the progress of running relocations"""
+        copied = self.done_bytes
+        for entry in self.running.values():
+            copied += entry['bytes'] * entry['progress'] / 100.0
+        return copied
+
+    def throughput(self):
+        """Aggregate bytes per second of the whole batch"""
+        return self.copied_bytes() / max(time.time() - self.started, 0.001)
+
+    def eta(self):
+        rate = self.throughput()
+        if rate <= 0:
+            return None
+        return max(self.total_bytes - self.copied_bytes(), 0) / rate
+
+    def print_status(self, force=False):
+        now = time.time()
+        if not force and now - self.last_status < STATUS_INTERVAL:
+            return
+        self.last_status = now
+        eta = self.eta()
+        print("  Progress: %s of %s, %d running, %s/h, ETA %s" % (
+            format_bytes(self.copied_bytes()), format_bytes(self.total_bytes), len(self.running),
+            format_bytes(self.throughput() * 3600), format_duration(eta) if eta is not None else "--:--:--"))
+        self.write_prometheus()
+
+    def write_prometheus(self):
+        """Write the metrics in the Prometheus textfile collector format"""
+        if not self.prom_path:
+            return
+        pairs = sorted(self.pairs.items())
+        lines = ["# TYPE managevms_migration_bytes_total counter"]
+        for (src, dst), pair in pairs:
+            lines.append('managevms_migration_bytes_total{src="%s",dst="%s"} %d' % (src, dst, pair['bytes']))
+        lines.append("# TYPE managevms_migration_seconds_total counter")
+        for (src, dst), pair in pairs:
+            lines.append('managevms_migration_seconds_total{src="%s",dst="%s"} %.1f' % (src, dst, pair['seconds']))
+        lines.append("# TYPE managevms_migration_vms_total counter")
+        for (src, dst), pair in pairs:
+            lines.append('managevms_migration_vms_total{src="%s",dst="%s",result="success"} %d' % (src, dst, pair['vms']))
+            lines.append('managevms_migration_vms_total{src="%s",dst="%s",result="error"} %d' % (src, dst, pair['failed']))
+        eta = self.eta()
+        lines += [
+            "# TYPE managevms_migration_running gauge",
+            "managevms_migration_running %d" % len(self.running),
+            "# TYPE managevms_migration_throughput_bytes_per_second gauge",
+            "managevms_migration_throughput_bytes_per_second %.0f" % self.throughput(),
+            "# TYPE managevms_migration_remaining_bytes gauge",
+            "managevms_migration_remaining_bytes %.0f" % max(self.total_bytes - self.copied_bytes(), 0),
+            "# TYPE managevms_migration_eta_seconds gauge",
+            "managevms_migration_eta_seconds %.0f" % (eta if eta is not None else -1),
+        ]
+        tmp = self.prom_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom_path)
+
+    def print_summary(self):
+        """Throughput per datastore pair"""
+        for (src, dst), pair in sorted(self.pairs.items()):
+            rate = pair['bytes'] / pair['seconds'] * 3600 if pair['seconds'] else 0
+            print("  %s -> %s: %d VMs, %d failed, %s (%s/h per VM)" % (
+                src, dst, pair['vms'], pair['failed'], format_bytes(pair['bytes']), format_bytes(rate)))
+        print("  Total: %s in %s (%s/h)" % (
+            format_bytes(self.done_bytes), format_duration(time.time() - self.started),
+            format_bytes(self.throughput() * 3600)))
@@ -0,0 +1,59 @@
+"""Templates in the scripts that change VMs.
+
+A template can be relocated as it is, so the migrators start the
+Storage vMotion without converting it. A reconfiguration (remove_iso.py)
+needs a VM: to_vm() marks the template as VM in the root resource pool of
+the cluster or host it is registered on, and to_template() marks it as
+template again afterwards. The resource pools of all hosts of a
+datacenter are looked up with one PropertyCollector call the first time
+they are needed and then cached. MarkAsVirtualMachine returns once the
+template is a VM, so there is nothing to wait for.
+"""
+
+import threading
+
+from pyVmomi import vim
+
+import inventory
+
+# datacenter moId -> {host moId: root resource pool moId, None: first pool of the datacenter}
+_pools = {}
+_lock = threading.Lock()
+
+
+def resource_pools(si, datacenter):
+    """Root resource pool of the cluster or host of every host in datacenter (cached)"""
+    with _lock:
+        if datacenter._moId not in _pools:
+            objects = inventory.retrieve_properties(si, {vim.ComputeResource: ['resourcePool', 'host']},
+                                                    container=datacenter.hostFolder)
+            pools = {}
+            for moid, obj in objects.items():
+                pool = obj['props'].get('resourcePool')
+                if pool is None:
+                    continue
+                pools.setdefault(None, pool)
+                for host in obj['props'].get('host') or []:
+                    pools[host._moId] = pool
+            _pools[datacenter._moId] = pools
+        return _pools[datacenter._moId]
+
+
+def to_vm(si, vm, datacenter):
+    """Mark the template vm (inventory record with 'host') as VM, False if there is no resource pool"""
+    pools = resource_pools(si, datacenter)
+    pool = pools.get(vm.get('host')) or pools.get(None)
+    if pool is None:
+        print("No resource pool found")
+        return False
+    stub = vm['obj']._stub
+    host = vim.HostSystem(vm['host'], stub) if vm.get('host') else None
+    print("Converting to VM")
+    vm['obj'].MarkAsVirtualMachine(pool=vim.ResourcePool(pool, stub), host=host)
+    return True
+
+
+def to_template(vm):
+    """Mark vm (inventory record) as template again"""
+    print("Converting to template")
+    vm['obj'].MarkAsTemplate()
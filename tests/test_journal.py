@@ -0,0 +1,58 @@
+import json
+
+import journal
+
+
+def vm(moid):
+    return {'moid': moid, 'name': 'vm-' + moid, 'disks': [], 'obj': object()}
+
+
+def create(path, moids):
+    return journal.MigrationJournal.create(str(path), 'vcenter', [
+        (vm(moid), 'datacenter-1', 'datastore-3', 'ds3', None, True) for moid in moids])
+
+
+def states(run_journal):
+    return dict((entry['vm']['moid'], entry['state']) for entry in run_journal.entries())
+
+
+def test_replay(tmp_path):
+    path = tmp_path / 'run.journal'
+    run_journal = create(path, ['vm-1', 'vm-2', 'vm-3'])
+    run_journal.update('vm-1', state=journal.RUNNING, task='task-1')
+    run_journal.update('vm-1', state=journal.DONE)
+    run_journal.update('vm-2', state=journal.FAILED, error='InvalidState')
+    loaded = journal.MigrationJournal.load(str(path))
+    assert states(loaded) == {'vm-1': journal.DONE, 'vm-2': journal.FAILED, 'vm-3': journal.QUEUED}
+    assert loaded.entries()[1]['error'] == 'InvalidState'
+    assert 'obj' not in loaded.entries()[0]['vm']
+    assert [entry['vm']['moid'] for entry in loaded.pending()] == ['vm-3']
+
+
+def test_replay_added_entries(tmp_path):
+    # a streaming run plans the VMs while it runs
+    path = tmp_path / 'run.journal'
+    run_journal = create(path, [])
+    run_journal.add(vm('vm-1'), 'datacenter-1', 'datastore-3', 'ds3', [2000], False)
+    run_journal.update('vm-1', state=journal.RUNNING, task='task-1')
+    loaded = journal.MigrationJournal.load(str(path))
+    entry = loaded.entries()[0]
+    assert (entry['state'], entry['task'], entry['disks'], entry['moveHome']) == (journal.RUNNING, 'task-1', [2000], False)
+
+
+def test_replay_after_partial_append(tmp_path):
+    path = tmp_path / 'run.journal'
+    run_journal = create(path, ['vm-1', 'vm-2'])
+    run_journal.update('vm-1', state=journal.RUNNING, task='task-1')
+    # the run crashed while it appended the next change
+    with open(str(path), 'a') as f:
+        f.write(json.dumps({'moid': 'vm-2', 'state': journal.RUNNING})[:20])
+    loaded = journal.MigrationJournal.load(str(path))
+    assert states(loaded) == {'vm-1': journal.RUNNING, 'vm-2': journal.QUEUED}
+    # the journal was rewritten without the cut off line, the next change is read again
+    loaded.update('vm-2', state=journal.DONE)
+    assert states(journal.MigrationJournal.load(str(path))) == {'vm-1': journal.RUNNING, 'vm-2': journal.DONE}
+
+
+def test_missing_journal(tmp_path):
+    assert journal.MigrationJournal.load(str(tmp_path / 'none.journal')) is None
@@ -0,0 +1,49 @@
+import rename_plan
+
+
+def vm(moid, name, parent='group-v1'):
+    return {'moid': moid, 'name': name, 'parent': parent}
+
+
+VMS = [vm('vm-1', 'web'), vm('vm-2', 'db'), vm('vm-3', 'app'), vm('vm-4', 'web-1'), vm('vm-5', 'web', 'group-v2')]
+
+
+def names(planned):
+    return [(record['moid'], new_name) for record, new_name in planned]
+
+
+def test_free_name():
+    assert rename_plan.free_name({'web', 'web-1', 'web-3'}, 'web') == 'web-2'
+
+
+def test_suffix_on_conflict_in_the_folder():
+    # web and web-1 are taken, two more VMs of the folder are renamed to web
+    planned, rejected = rename_plan.plan(VMS, [(VMS[1], 'web'), (VMS[2], 'web')], rename_plan.SUFFIX)
+    assert names(planned) == [('vm-2', 'web-2'), ('vm-3', 'web-3')]
+    assert rejected == []
+
+
+def test_reject_on_conflict_in_the_folder():
+    planned, rejected = rename_plan.plan(VMS, [(VMS[1], 'web'), (VMS[2], 'app2')])
+    assert names(planned) == [('vm-3', 'app2')]
+    assert names(rejected) == [('vm-2', 'web')]
+
+
+def test_two_renames_to_the_same_new_name():
+    planned, rejected = rename_plan.plan(VMS, [(VMS[1], 'new'), (VMS[2], 'new')], rename_plan.SUFFIX)
+    assert names(planned) == [('vm-2', 'new'), ('vm-3', 'new-1')]
+    planned, rejected = rename_plan.plan(VMS, [(VMS[1], 'new'), (VMS[2], 'new')], rename_plan.REJECT)
+    assert names(planned) == [('vm-2', 'new')]
+    assert names(rejected) == [('vm-3', 'new')]
+
+
+def test_names_of_other_folders_are_free():
+    planned, rejected = rename_plan.plan(VMS, [(VMS[4], 'db')])
+    assert names(planned) == [('vm-5', 'db')]
+    assert rejected == []
+
+
+def test_freed_name_counts_as_taken():
+    # db is renamed, but the renames run in parallel: its old name is not free yet
+    planned, rejected = rename_plan.plan(VMS, [(VMS[1], 'db2'), (VMS[2], 'db')], rename_plan.SUFFIX)
+    assert names(planned) == [('vm-2', 'db2'), ('vm-3', 'db-1')]
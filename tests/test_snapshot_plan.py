@@ -0,0 +1,77 @@
+import datetime
+
+import snapshot_plan
+
+
+def snapshot(moid, days_old, *children):
+    # plain snapshot record of inventory.py
+    created = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc) - datetime.timedelta(days=days_old)
+    return {'snapshot': moid, 'name': moid, 'createTime': created, 'children': list(children)}
+
+
+def tree():
+    # s1 -> (s2 -> s4, s3)
+    return [snapshot('s1', 90, snapshot('s2', 60, snapshot('s4', 10)), snapshot('s3', 5))]
+
+
+NOW = datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc)
+
+
+def operations(plan):
+    return [(kind, record and record['snapshot'], children) for kind, record, children in plan]
+
+
+def test_remove_all():
+    snapshots = tree()
+    selected = snapshot_plan.select_all(snapshots)
+    assert selected == {'s1', 's2', 's3', 's4'}
+    assert operations(snapshot_plan.plan(snapshots, selected)) == [(snapshot_plan.REMOVE_ALL, None, None)]
+
+
+def test_remove_subtree():
+    snapshots = tree()
+    selected = snapshot_plan.select_name(snapshots, 's2')
+    assert selected == {'s2', 's4'}
+    assert operations(snapshot_plan.plan(snapshots, selected)) == [(snapshot_plan.REMOVE, 's2', True)]
+
+
+def test_remove_snapshot_keeps_its_children():
+    snapshots = tree()
+    assert operations(snapshot_plan.plan(snapshots, {'s1'})) == [(snapshot_plan.REMOVE, 's1', False)]
+
+
+def test_remove_selected_in_several_branches():
+    snapshots = tree()
+    assert operations(snapshot_plan.plan(snapshots, {'s1', 's4', 's3'})) == [
+        (snapshot_plan.REMOVE, 's1', False),
+        (snapshot_plan.REMOVE, 's4', False),
+        (snapshot_plan.REMOVE, 's3', False),
+    ]
+
+
+def test_nothing_selected():
+    assert snapshot_plan.plan(tree(), set()) == []
+    assert snapshot_plan.plan([], set()) == []
+
+
+def test_select_older():
+    assert snapshot_plan.select_older(tree(), 30, NOW) == {'s1', 's2'}
+    # older than 30 days but with a younger child: removed without its children
+    assert operations(snapshot_plan.plan(tree(), snapshot_plan.select_older(tree(), 30, NOW))) == [
+        (snapshot_plan.REMOVE, 's1', False),
+        (snapshot_plan.REMOVE, 's2', False),
+    ]
+
+
+def test_select_name_not_unique():
+    snapshots = [snapshot('s1', 1), snapshot('s2', 1)]
+    snapshots[1]['name'] = 's1'
+    assert snapshot_plan.select_name(snapshots, 's1') == set()
+
+
+def test_removed_bytes():
+    vm = {'snapshotSizes': {'s1': 100, 's2': 20, 's4': 3}}
+    assert snapshot_plan.removed_bytes(vm, {'s2', 's4'}) == 23
+    # a snapshot without delta files in layoutEx counts 0
+    assert snapshot_plan.removed_bytes(vm, {'s3'}) == 0
+    assert snapshot_plan.removed_bytes(vm, snapshot_plan.select_all(tree())) == 123
@@ -0,0 +1,63 @@
+"""Compiled VM filters for --folder, --vm, --path, --exclude and --exclude-path.
+
+The patterns are compiled once (regular expressions, case insensitive) and
+matched against the plain inventory records, so filtering needs no SOAP
+calls:
+  --folder        folder string of the VM (parent/grandparent folder name)
+  --vm            VM name
+  --path          full inventory path of the VM, e.g. /DC1/vm/kunde1/web/web01
+  --exclude       VM name to skip
+  --exclude-path  inventory path to skip
+A VM is selected if it matches all given include patterns and none of the
+exclude patterns.
+"""
+
+import re
+
+
+def _compile(option, pattern):
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise SystemExit("Invalid regular expression for " + option + ": " + pattern + " (" + str(e) + ")")
+
+
+class VMFilter:
+    """Include and exclude patterns against the fields of a VM record"""
+
+    def __init__(self, folder=None, vm=None, exclude=None, path=None, exclude_path=None):
+        # (record field, compiled pattern)
+        self.include = []
+        self.exclude = []
+        if folder:
+            self.include.append(('folder', _compile('--folder', folder)))
+        if vm:
+            self.include.append(('name', _compile('--vm', vm)))
+        if path:
+            self.include.append(('path', _compile('--path', path)))
+        if exclude:
+            self.exclude.append(('name', _compile('--exclude', exclude)))
+        if exclude_path:
+            self.exclude.append(('path', _compile('--exclude-path', exclude_path)))
+
+    def matches(self, vm):
+        """True if vm matches all include patterns"""
+        for field, pattern in self.include:
+            if not pattern.search(vm[field]):
+                return False
+        return True
+
+    def excluded(self, vm):
+        """True if vm matches one of the exclude patterns"""
+        for field, pattern in self.exclude:
+            if pattern.search(vm[field]):
+                return True
+        return False
+
+    def __call__(self, vm):
+        return self.matches(vm) and not self.excluded(vm)
+
+
+def from_args(args):
+    """VMFilter of the filter options of a script"""
+    return VMFilter(args.folder, args.vm, args.exclude, args.path, args.exclude_path)